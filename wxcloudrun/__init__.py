@@ -1,4 +1,6 @@
 # wxcloudrun/__init__.py
+# 冷启动计时从这里开始（须在 Flask / SQLAlchemy 等重模块之前导入）
+from .observability.startup import startup
 import logging, os, threading
 import pymysql
 from flask import Flask
@@ -6,22 +8,24 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_sock import Sock
 
 # ---- 全局扩展（与原来一致）----
-db = SQLAlchemy()
+# 提交后不让实例过期：调度器每轮 step 使用独立的应用上下文（会话），DialogueContext 里缓存的
+# 分身 / 伙伴 / 设置在会话关闭后仍需可读
+db = SQLAlchemy(session_options={"expire_on_commit": False})
 sock = Sock()
 
-# 你的进程内结构保持不变（单 worker 即可）
+# 进程内结构：每个 worker 一份，多 worker 时只调度本 worker 拥有的用户（见 agent/coordination.py）
 from .agent.users_set import RoundRobinSet
 alive_chat_users = RoundRobinSet()
 
 def create_app():
+    startup.mark("import")
+
     # 1) 实例化 Flask
     app = Flask(__name__, instance_relative_config=True)
 
-    # 2) 日志（只设置一次全局级别/格式）
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
+    # 2) 日志（只设置一次）：文本格式（LOG_FORMAT=json 输出 JSON 行）+ 采样 / 限流，由原生后台线程异步写出，不阻塞 gevent 事件循环
+    from .observability.logs import configure_logging
+    configure_logging()
     logger = logging.getLogger(__name__)
 
     # 3) 数据库：用 PyMySQL 作为 MySQLdb
@@ -56,6 +60,19 @@ def create_app():
     sock.init_app(app)
     app.extensions["alive_chat_users"] = alive_chat_users
 
+    # 4.0) SQL 统计：每个请求一个作用域，记录语句数 / DB 耗时并检测重复语句（N+1）
+    from .observability import sql_stats
+    sql_stats.install()
+
+    @app.before_request
+    def begin_sql_scope():
+        from flask import request
+        sql_stats.begin_scope("request", request.url_rule.rule if request.url_rule else request.path)
+
+    @app.teardown_request
+    def end_sql_scope(exception=None):
+        sql_stats.end_scope()
+
     # 4.1) teardown：断连时释放连接池；其他情况仅记录日志（不要再抛异常）
     @app.teardown_appcontext
     def shutdown_session(exception=None):
@@ -94,13 +111,21 @@ def create_app():
     from .views.user_views import user_bp
     from .views.test_views import test_bp
     from .views.wechat_views import wechat_bp
+    from .views.admin_views import admin_bp
     from .agent.scheduler import start_dispatch
+    from .agent.dialogue_controller import DialogueController
+    from .agent.opening_turn import opening_store_from_env
+
+    # 调度器与开场白预生成共用的对话控制器、预生成开场消息缓存
+    app.extensions["dialogue_controller"] = DialogueController()
+    app.extensions["opening_turns"] = opening_store_from_env()
 
     register_api_routes(app)
     register_websocket_routes(app, sock)
     app.register_blueprint(user_bp)
     app.register_blueprint(test_bp)
     app.register_blueprint(wechat_bp)
+    app.register_blueprint(admin_bp)
 
     # 6) 后台调度线程（轻量任务 OK；重任务建议放到队列）
     # gevent 已在 run.py 里 monkey.patch_all()，这里的 threading 会被协作化
@@ -108,11 +133,25 @@ def create_app():
         with app.app_context():
             start_dispatch(stop_event)
 
+    def _start_dispatcher():
+        threading.Thread(
+            target=_run_dispatch_in_ctx,
+            args=(app.dispatcher_stop,),
+            daemon=True
+        ).start()
+
+    # 事件循环阻塞检测（gevent worker 中启动；LOOP_BLOCK_THRESHOLD=0 关闭）
+    from .observability.loop_monitor import start_loop_monitor
+    start_loop_monitor()
+
+    # 多 worker / 多实例协调：用户归属（文件锁或 presence 租约）、交接、leader 选举与全局定时任务
+    from .agent.coordination import start_coordination
+    start_coordination(alive_chat_users, app.extensions["dialogue_controller"])
+
+    # 7) 预热连接池与 LLM 客户端后再启动调度器并标记就绪（/ready），create_app 本身不等待
+    from .warmup import start_warmup
     app.dispatcher_stop = threading.Event()
-    threading.Thread(
-        target=_run_dispatch_in_ctx,
-        args=(app.dispatcher_stop,),
-        daemon=True
-    ).start()
+    start_warmup(app, _start_dispatcher)
 
+    startup.mark("create_app")
     return app
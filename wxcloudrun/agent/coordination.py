@@ -0,0 +1,482 @@
+"""
+多 worker（gunicorn -w N）下的跨进程协调，基于同一容器内共享目录里的 flock 文件锁：
+
+- UserAffinity：用户归属。某个 worker 持有用户的归属锁，只有它为该用户调度 step；
+  同一用户落在其他 worker 上的连接进入 standby（不生成），归属方全部下线、锁释放后自动接管。
+  同一用户的 step 锁（step_lock）保证开场白预生成与实时调度不会跨进程并发执行。
+  standby 连接经归属 worker 转发收到同样的帧（见 relay.py）。
+- 跨实例：配置 PRESENCE_BACKEND 后归属改由 presence 注册表（租约 + 一致性哈希 + 交接协议，见 presence.py）决定。
+- LeaderElection：全局任务（过期缓存清理、锁文件清理等）只在当选的 leader worker 上运行；
+  leader 进程退出时内核释放 flock，其他 worker 在下一次轮询时接任。
+
+flock 从不阻塞等待（LOCK_NB），需要等待时用 gevent.sleep 轮询，不会卡住事件循环。
+锁文件在持锁状态下才会被删除，获取锁后校验 inode，避免与清理任务竞争时拿到已被删除的旧文件。
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import gevent
+
+from ..observability.runtime import worker_count
+from .presence import LOST, PresenceRegistry, PresenceUnavailable, presence_from_env
+from .relay import FrameRelay
+
+logger = logging.getLogger(__name__)
+
+# 用户在本节点转为 standby、且本连接收不到转发时发给客户端的帧：连接保持，消息由其他节点上的连接接收
+STANDBY_FRAME = json.dumps({"type": "standby"})
+
+COORDINATION_DIR = os.environ.get("COORDINATION_DIR", "/tmp/parallel-world")
+
+
+class FileLock:
+    """非阻塞的 flock 文件锁；同一进程内对同一路径只持有一个文件描述符"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: Optional[int] = None
+
+    def try_acquire(self) -> bool:
+        if self.fd is not None:
+            return True
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                os.close(fd)
+                if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                    return False
+                raise
+            try:
+                same = os.fstat(fd).st_ino == os.stat(self.path).st_ino
+            except FileNotFoundError:
+                same = False
+            if same:
+                self.fd = fd
+                os.ftruncate(fd, 0)
+                os.write(fd, str(os.getpid()).encode())
+                return True
+            os.close(fd)   # 文件在加锁前被清理任务删除，重新创建后再试
+
+    def acquire(self, timeout: float, poll: float = 0.1) -> bool:
+        """轮询获取，最多等待 timeout 秒（等待期间让出事件循环）"""
+        deadline = time.monotonic() + timeout
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                return False
+            gevent.sleep(poll)
+        return True
+
+    def release(self, unlink: bool = False) -> None:
+        if self.fd is None:
+            return
+        try:
+            if unlink:
+                try:
+                    os.unlink(self.path)
+                except FileNotFoundError:
+                    pass
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    @property
+    def held(self) -> bool:
+        return self.fd is not None
+
+
+def _user_lock_path(kind: str, user_id: str) -> str:
+    digest = hashlib.sha1(str(user_id).encode("utf-8")).hexdigest()[:20]
+    return os.path.join(COORDINATION_DIR, "users", f"{kind}-{digest}.lock")
+
+
+class UserAffinity:
+    """
+    线程安全：本 worker 持有的用户归属。
+    - 容器内多 worker：用户归属文件锁（worker 数为 1 时不访问文件系统）；
+    - 配置了 presence 注册表（多实例）：归属改为注册表中的租约，按一致性哈希与交接协议在节点间转移，
+      由 sync_presence() 定期续约并处理其他节点的交接请求。
+    """
+
+    def __init__(self, enabled: Optional[bool] = None):
+        self.enabled = worker_count() > 1 if enabled is None else enabled
+        self.presence: Optional[PresenceRegistry] = None
+        self._lock = threading.Lock()
+        self._owned: Dict[str, Optional[FileLock]] = {}   # presence 模式下值为 None
+        self._on_yield: List[Callable[[str], Any]] = []
+        self.handoffs_out = 0
+        self.handoffs_declined = 0
+        if self.enabled:
+            os.makedirs(os.path.join(COORDINATION_DIR, "users"), exist_ok=True)
+
+    def use_presence(self, presence: PresenceRegistry) -> None:
+        self.presence = presence
+
+    def on_yield(self, callback: Callable[[str], Any]) -> None:
+        """登记交出用户归属后的回调（例如丢弃本地缓存的对话上下文，重新归属时从数据库重建）"""
+        self._on_yield.append(callback)
+
+    @property
+    def active(self) -> bool:
+        return self.enabled or self.presence is not None
+
+    def claim(self, user_id: str) -> bool:
+        """尝试成为该用户的归属 worker；已持有或获取成功返回 True，被其他 worker / 节点持有返回 False"""
+        if not self.active:
+            return True
+        with self._lock:
+            if user_id in self._owned:
+                return True
+        if self.presence is not None:
+            return self._claim_presence(user_id)
+        with self._lock:
+            if user_id in self._owned:
+                return True
+            lock = FileLock(_user_lock_path("owner", user_id))
+            if not lock.try_acquire():
+                return False
+            self._owned[user_id] = lock
+            return True
+
+    def _claim_presence(self, user_id: str) -> bool:
+        try:
+            owner = self.presence.claim(user_id)
+        except PresenceUnavailable as e:
+            # 存储不可用时放行：宁可短暂重复调度，也不让用户收不到消息
+            logger.warning(f"[AFFINITY] presence unavailable, serving user={user_id} locally: {e}")
+            owner = self.presence.node_id
+        if owner != self.presence.node_id:
+            return False
+        with self._lock:
+            self._owned[user_id] = None
+        return True
+
+    def release(self, user_id: str) -> None:
+        """用户在本 worker 上全部下线后释放归属，其他 worker / 节点上的 standby 连接随即可以接管"""
+        if not self.active:
+            return
+        with self._lock:
+            if user_id not in self._owned:
+                return
+            lock = self._owned.pop(user_id)
+        if lock is not None:
+            lock.release()
+        if self.presence is not None:
+            try:
+                self.presence.release(user_id)
+            except PresenceUnavailable as e:
+                logger.warning(f"[AFFINITY] release user={user_id} failed, lease will expire: {e}")
+
+    def owns(self, user_id: str) -> bool:
+        if not self.active:
+            return True
+        with self._lock:
+            return user_id in self._owned
+
+    def owner_pid(self, user_id: str) -> Optional[int]:
+        """持有该用户归属锁的 worker pid（取自锁文件内容）；无人持有或读不到时返回 None"""
+        if not self.enabled:
+            return None
+        lock = FileLock(_user_lock_path("owner", user_id))
+        if lock.try_acquire():
+            lock.release()   # 无人持有
+            return None
+        try:
+            with open(lock.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+    def owned_count(self) -> int:
+        with self._lock:
+            return len(self._owned)
+
+    @contextmanager
+    def step_lock(self, user_id: str, timeout: float = 0.0) -> Iterator[bool]:
+        """
+        跨进程的单用户 step 互斥：with 块内得到是否拿到锁；timeout=0 时不等待。
+        拿不到说明另一个进程正在为该用户生成（例如其他 worker 上的开场白预生成）。
+        """
+        if not self.enabled:
+            yield True
+            return
+        lock = FileLock(_user_lock_path("step", user_id))
+        acquired = lock.try_acquire() if timeout <= 0 else lock.acquire(timeout)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+
+    def promote_standby(self, registry: Any) -> int:
+        """为本 worker 上处于 standby 的用户尝试接管归属；返回接管的用户数"""
+        promoted = 0
+        for user_id in registry.standby_users():
+            if self.claim(user_id):
+                registry.set_standby(user_id, False)
+                promoted += 1
+                logger.info(f"[AFFINITY] took ownership of user={user_id} (pid={os.getpid()})")
+        return promoted
+
+    def sync_presence(self, registry: Any) -> None:
+        """续约本节点持有的全部用户（一次往返），并处理租约丢失与其他节点的交接请求"""
+        with self._lock:
+            owned = [user_id for user_id, lock in self._owned.items() if lock is None]
+        statuses = self.presence.renew(owned)
+        for user_id, status in statuses.items():
+            if status is None:
+                continue
+            if status == LOST or self.presence.should_yield(user_id, status, registry.idle_seconds(user_id)):
+                self._hand_off(registry, user_id, status)
+            else:
+                self.handoffs_declined += 1
+                self.presence.decline_handoff(user_id, status)
+                logger.info(f"[AFFINITY] declined handoff of user={user_id} to {status}")
+
+    def _hand_off(self, registry: Any, user_id: str, status: str) -> None:
+        """停止在本节点调度该用户：转为 standby（取消进行中的 step）、通知本地连接，再交出租约"""
+        with self._lock:
+            self._owned.pop(user_id, None)
+        registry.set_standby(user_id, True)
+        for ws in registry.get_conns(user_id):
+            try:
+                ws.send(STANDBY_FRAME)
+            except Exception as e:
+                logger.warning(f"[AFFINITY] notify standby failed user={user_id}: {e}")
+        for callback in self._on_yield:
+            callback(user_id)
+        if status != LOST:
+            self.presence.release(user_id)
+            self.handoffs_out += 1
+        logger.info(f"[AFFINITY] handed off user={user_id} ({'lease lost' if status == LOST else 'to ' + status})")
+
+
+class LeaderElection:
+    """
+    基于 leader.lock 的选主；只有 leader 运行 register() 登记的全局任务。
+    未当选的 worker 每 poll_interval 秒重试一次，leader 退出后自动接任。
+    """
+
+    def __init__(self, path: Optional[str] = None, poll_interval: float = 5.0):
+        self.path = path or os.path.join(COORDINATION_DIR, "leader.lock")
+        self.poll_interval = poll_interval
+        self._lock = FileLock(self.path)
+        self._jobs: List[Dict[str, Any]] = []
+        self._running = False
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lock.held
+
+    def register(self, name: str, interval: float, fn: Callable[[], Any]) -> None:
+        """登记全局定时任务；同名任务重复登记时以最后一次为准"""
+        self._jobs = [job for job in self._jobs if job["name"] != name]
+        self._jobs.append({"name": name, "interval": interval, "fn": fn, "next_run": 0.0, "runs": 0,
+                           "last_error": None})
+
+    def start(self) -> None:
+        if self._running:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._running = True
+        gevent.spawn(self._loop)
+
+    def stop(self) -> None:
+        self._running = False
+        self._lock.release()
+
+    def _loop(self) -> None:
+        while self._running:
+            if not self._lock.held and self._lock.try_acquire():
+                logger.info(f"[LEADER] worker pid={os.getpid()} elected leader")
+            if self._lock.held:
+                self._run_due_jobs()
+            gevent.sleep(self.poll_interval)
+
+    def _run_due_jobs(self) -> None:
+        now = time.monotonic()
+        for job in self._jobs:
+            if now < job["next_run"]:
+                continue
+            job["next_run"] = now + job["interval"]
+            try:
+                job["fn"]()
+                job["runs"] += 1
+                job["last_error"] = None
+            except Exception as e:
+                job["last_error"] = str(e)
+                logger.error(f"[LEADER] job {job['name']} failed: {e}", exc_info=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pid": os.getpid(),
+            "is_leader": self.is_leader,
+            "jobs": [{k: job[k] for k in ("name", "interval", "runs", "last_error")} for job in self._jobs],
+        }
+
+
+def purge_stale_user_locks(max_age: float = 24 * 3600) -> int:
+    """删除长时间未使用且当前无人持有的用户锁文件（leader 任务）；返回删除数"""
+    directory = os.path.join(COORDINATION_DIR, "users")
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    cutoff = time.time() - max_age
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if os.stat(path).st_mtime > cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        lock = FileLock(path)
+        if lock.try_acquire():
+            lock.release(unlink=True)
+            removed += 1
+    if removed:
+        logger.info(f"[LEADER] purged {removed} stale user lock files")
+    return removed
+
+
+def purge_stale_relay_sockets() -> int:
+    """删除已退出 worker 留下的转发套接字文件（leader 任务）；返回删除数"""
+    directory = frame_relay.directory
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        pid_str, _, ext = name.partition(".")
+        if ext != "sock" or not pid_str.isdigit():
+            continue
+        try:
+            os.kill(int(pid_str), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue   # 进程存在但属于其他用户
+        try:
+            os.unlink(os.path.join(directory, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        logger.info(f"[LEADER] purged {removed} stale relay sockets")
+    return removed
+
+
+user_affinity = UserAffinity()
+leader = LeaderElection()
+frame_relay = FrameRelay(os.path.join(COORDINATION_DIR, "relay"), user_affinity.owner_pid)
+
+AFFINITY_POLL_SECONDS = 2.0
+
+
+LLM_CACHE_PURGE_SECONDS = 600.0
+
+
+def _purge_llm_cache_disk() -> None:
+    """leader：清理各 worker 共用的 sqlite 落盘缓存"""
+    from ..llm.response_cache import get_response_cache
+
+    cache = get_response_cache()
+    if cache is not None:
+        purged = cache.purge_expired(memory=False)
+        if purged:
+            logger.info(f"[LEADER] purged {purged} expired LLM cache entries from disk")
+
+
+def _purge_llm_cache_memory_loop() -> None:
+    """每个 worker：内存 LRU 是进程私有的，各自清理过期条目"""
+    from ..llm.response_cache import get_response_cache
+
+    while True:
+        gevent.sleep(LLM_CACHE_PURGE_SECONDS)
+        try:
+            cache = get_response_cache()
+            if cache is not None:
+                purged = cache.purge_expired(disk=False)
+                if purged:
+                    logger.info(f"[COORD] purged {purged} expired in-memory LLM cache entries")
+        except Exception as e:
+            logger.error(f"[COORD] LLM cache purge failed: {e}", exc_info=True)
+
+
+def _affinity_loop(registry: Any) -> None:
+    presence = user_affinity.presence
+    next_sync = 0.0
+    while True:
+        gevent.sleep(AFFINITY_POLL_SECONDS)
+        try:
+            if presence is not None and time.monotonic() >= next_sync:
+                # 租约 TTL 内至少续约三次
+                next_sync = time.monotonic() + max(presence.ttl / 3.0, AFFINITY_POLL_SECONDS)
+                user_affinity.sync_presence(registry)
+            user_affinity.promote_standby(registry)
+            if frame_relay.active:
+                # 仍为 standby 的用户：向（可能已更换的）归属 worker 续订帧转发
+                for user_id in registry.standby_users():
+                    frame_relay.subscribe(user_id)
+        except PresenceUnavailable as e:
+            logger.warning(f"[AFFINITY] presence sync failed: {e}")
+        except Exception as e:
+            logger.error(f"[AFFINITY] promote standby users failed: {e}", exc_info=True)
+
+
+def start_coordination(registry: Any, controller: Any = None) -> None:
+    """
+    在每个 worker 中调用：按 PRESENCE_* 配置接入跨实例 presence 注册表，启动 standby 用户接管 / 续约轮询
+    （多 worker 或多实例时），以及 leader 选举与全局任务
+    """
+    presence = presence_from_env()
+    if presence is not None:
+        user_affinity.use_presence(presence)
+        if controller is not None:
+            user_affinity.on_yield(controller.evict_context)
+        try:
+            presence.heartbeat()
+        except PresenceUnavailable as e:
+            logger.warning(f"[COORD] presence heartbeat failed: {e}")
+    if user_affinity.enabled and presence is None:
+        frame_relay.start(registry)   # 容器内多 worker：standby 连接经归属 worker 转发收到消息
+    if user_affinity.active:
+        gevent.spawn(_affinity_loop, registry)
+    gevent.spawn(_purge_llm_cache_memory_loop)
+    leader.register("llm_cache_purge", LLM_CACHE_PURGE_SECONDS, _purge_llm_cache_disk)
+    leader.register("user_lock_purge", 3600.0, purge_stale_user_locks)
+    leader.register("relay_socket_purge", 3600.0, purge_stale_relay_sockets)
+    leader.start()
+    logger.info(f"[COORD] worker pid={os.getpid()} workers={worker_count()} affinity={user_affinity.enabled} "
+                f"presence={presence.node_id if presence else None}")
+
+
+def coordination_stats() -> Dict[str, Any]:
+    stats = {
+        "workers": worker_count(),
+        "affinity_enabled": user_affinity.enabled,
+        "owned_users": user_affinity.owned_count(),
+        "handoffs_out": user_affinity.handoffs_out,
+        "handoffs_declined": user_affinity.handoffs_declined,
+        "relay": frame_relay.stats(),
+        "leader": leader.stats(),
+    }
+    if user_affinity.presence is not None:
+        try:
+            stats["presence"] = user_affinity.presence.stats()
+        except PresenceUnavailable as e:
+            stats["presence"] = {"error": str(e)}
+    return stats
@@ -0,0 +1,68 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class DeliveryWindow:
+    """
+    单个用户的“已发送未确认”消息窗口（非线程安全，由 RoundRobinSet 加锁访问）。
+
+    - 调度器发送每条消息前调用 on_sent（一个设备都没送达时 forget 撤销），客户端渲染后回 ack（累计确认：确认某条即确认它之前的所有消息）
+    - 未确认数达到窗口大小时 is_full() 为真，调度器跳过该用户，不再为其调用 LLM
+    - 窗口大小按客户端实际阅读速率自适应：size ≈ LOOKAHEAD_SECONDS / 平均阅读间隔
+    """
+    MIN_SIZE = 1
+    MAX_SIZE = 6
+    INITIAL_SIZE = 2
+    LOOKAHEAD_SECONDS = 12.0    # 希望提前生成多少秒的阅读量
+    MAX_READ_INTERVAL = 60.0    # 单次阅读间隔采样上限，避免长时间离开后窗口长期缩到最小
+    EWMA_ALPHA = 0.3
+
+    def __init__(self):
+        self.size = self.INITIAL_SIZE
+        self.read_interval: Optional[float] = None   # 平均阅读间隔（秒/条，EWMA）
+        self.acked_total = 0
+        self._unacked: "OrderedDict[str, float]" = OrderedDict()  # {message_id: sent_at}
+        self._last_ack_at: Optional[float] = None
+
+    def on_sent(self, message_id: str, now: Optional[float] = None) -> None:
+        """记录一条已发送、待确认的消息"""
+        if message_id:
+            self._unacked[message_id] = time.monotonic() if now is None else now
+
+    def forget(self, message_id: str) -> None:
+        """撤销 on_sent 登记（消息最终没有送达任何设备）"""
+        self._unacked.pop(message_id, None)
+
+    def on_ack(self, message_id: str, now: Optional[float] = None) -> int:
+        """确认 message_id 及其之前的所有消息；返回本次确认的条数（未知 id 返回 0）"""
+        if message_id not in self._unacked:
+            return 0
+        now = time.monotonic() if now is None else now
+        acked = 0
+        while self._unacked:
+            mid, _ = self._unacked.popitem(last=False)
+            acked += 1
+            if mid == message_id:
+                break
+        self._observe_read_rate(acked, now)
+        self.acked_total += acked
+        return acked
+
+    def is_full(self) -> bool:
+        return len(self._unacked) >= self.size
+
+    def unacked_count(self) -> int:
+        return len(self._unacked)
+
+    def _observe_read_rate(self, acked: int, now: float) -> None:
+        if self._last_ack_at is not None:
+            interval = min((now - self._last_ack_at) / acked, self.MAX_READ_INTERVAL)
+            if self.read_interval is None:
+                self.read_interval = interval
+            else:
+                self.read_interval += self.EWMA_ALPHA * (interval - self.read_interval)
+            target = math.ceil(self.LOOKAHEAD_SECONDS / max(self.read_interval, 0.1))
+            self.size = max(self.MIN_SIZE, min(self.MAX_SIZE, target))
+        self._last_ack_at = now
@@ -61,7 +61,7 @@ class DialogueContext:
         self.session_id = get_user_session_id(self.user_id)
         if not self.session_id:
             raise ValueError(f"No session_id found for user {self.user_id}")
-        logger.info(f"Loaded session_id for user {self.user_id}: {self.session_id}")
+        logger.debug("Loaded session_id for user %s: %s", self.user_id, self.session_id)
 
     def load_recent_history_from_db(self, limit: int = 10):
         """从ChatMessages表加载最近的对话历史"""
@@ -85,9 +85,10 @@ class DialogueContext:
                 self.history.append(history_item)
             
             if recent_messages:
-                logger.info(f"从数据库加载了 {len(recent_messages)} 条对话历史")
-                for i, msg in enumerate(recent_messages[:3]):  # 只打印前3条作为示例
-                    logger.info(f"  历史记录 {i+1}: {msg.speaker_type} - {msg.message[:50]}...")
+                logger.info("从数据库加载了 %d 条对话历史: user_id=%s", len(recent_messages), self.user_id)
+                if logger.isEnabledFor(logging.DEBUG):
+                    for i, msg in enumerate(recent_messages[:3]):  # 只打印前3条作为示例
+                        logger.debug("  历史记录 %d: %s - %s...", i + 1, msg.speaker_type, msg.message[:50])
             else:
                 logger.warning(f"未找到用户 {self.user_id} 的对话历史记录")
         except Exception as e:
@@ -120,56 +121,20 @@ class DialogueContext:
                 if topic_text not in self.topic_history[destination]:
                     self.topic_history[destination].append(topic_text)
             
-            logger.info(f"从数据库加载了 {len(recent_topics)} 个话题，当前话题: {self.current_topic}")
-            for dest, topics in self.topic_history.items():
-                logger.info(f"  目的地 [{dest}]: {topics[:3]}")  # 只显示前3个话题
+            logger.info("从数据库加载了 %d 个话题: user_id=%s, 当前话题: %s",
+                        len(recent_topics), self.user_id, self.current_topic)
+            if logger.isEnabledFor(logging.DEBUG):
+                for dest, topics in self.topic_history.items():
+                    logger.debug("  目的地 [%s]: %s", dest, topics[:3])  # 只显示前3个话题
         except Exception as e:
             logger.error(f"从数据库加载话题失败: {e}")
 
     def load_digital_avatar_from_db(self):
         """从数据库加载用户个人资料数据"""
         try:
-            logger.info(f"开始查询用户 {self.user_id} 的数字分身数据")
-            
-            # 详细的数据库调试信息
-            from sqlalchemy import text, inspect
-            from .. import db
-            
-            engine = db.get_engine()
-            logger.info(f"[DB] engine.url = {engine.url!s}")   # e.g. sqlite:////app/instance/app.db
-            
-            with engine.connect() as conn:
-                # SQLite: 看看当前 attach 的文件路径
-                try:
-                    rows = conn.execute(text("PRAGMA database_list")).all()
-                    logger.info(f"[DB] PRAGMA database_list = {rows}")  # 包含 main 的绝对路径
-                except Exception as _:
-                    pass
-                
-                # 列出当前库的表
-                tables = inspect(engine).get_table_names()
-                logger.info(f"[DB] tables = {tables}")
-                
-                # 直接裸查计数，绕过 ORM
-                try:
-                    cnt = conn.execute(text('SELECT COUNT(*) FROM `DigitalAvatar`')).scalar_one()
-                    logger.info(f'[DB] COUNT(`DigitalAvatar`) = {cnt}')
-                except Exception as e:
-                    logger.error(f'[DB] COUNT 出错: {e}')
-            
-            # 先查询所有记录看看
-            all_avatars = DigitalAvatar.query.all()
-            logger.info(f"数据库中总共有 {len(all_avatars)} 条 DigitalAvatar 记录")
-            
-            # 打印前几条记录的user_id用于对比
-            for i, avatar in enumerate(all_avatars[:3]):
-                logger.info(f"记录 {i+1}: user_id='{avatar.user_id}', name='{avatar.name}'")
-            
-            # 查询特定用户的所有记录
-            user_avatars = DigitalAvatar.query.filter(
-                DigitalAvatar.user_id == self.user_id
-            ).all()
-            logger.info(f"用户 {self.user_id} 有 {len(user_avatars)} 条数字分身记录")
+            # 详细的数据库调试信息（整表扫描，仅在 DEBUG 级别执行）
+            if logger.isEnabledFor(logging.DEBUG):
+                self._debug_avatar_tables()
             
             # 加载数字分身数据（获取最近一条）
             self.digital_avatar = DigitalAvatar.query.filter(
@@ -177,15 +142,42 @@ class DialogueContext:
             ).order_by(DigitalAvatar.created_at.desc()).first()
             
             if self.digital_avatar:
-                logger.info(f"成功加载数字分身数据: avatar_id={self.digital_avatar.avatar_id}, "
-                           f"name={self.digital_avatar.name}, "
-                           f"description={self.digital_avatar.description}, "
-                           f"avatar_url={self.digital_avatar.avatar_url}, "
-                           f"created_at={self.digital_avatar.created_at}")
+                logger.info("成功加载数字分身数据: user_id=%s, avatar_id=%s",
+                            self.user_id, self.digital_avatar.avatar_id)
+                logger.debug("数字分身: name=%s, description=%s, avatar_url=%s, created_at=%s",
+                             self.digital_avatar.name, self.digital_avatar.description,
+                             self.digital_avatar.avatar_url, self.digital_avatar.created_at)
             else:
                 logger.warning(f"未找到用户 {self.user_id} 的数字分身数据")
         except Exception as e:
             logger.error(f"加载用户数据失败: {e}", exc_info=True)
+
+    def _debug_avatar_tables(self):
+        """排查“查不到分身”问题用：打印库地址、表、DigitalAvatar 总数与前几条记录"""
+        from sqlalchemy import text, inspect
+        from .. import db
+
+        engine = db.get_engine()
+        logger.debug("[DB] engine.url = %s", engine.url)   # e.g. sqlite:////app/instance/app.db
+        with engine.connect() as conn:
+            # SQLite: 看看当前 attach 的文件路径
+            try:
+                logger.debug("[DB] PRAGMA database_list = %s", conn.execute(text("PRAGMA database_list")).all())
+            except Exception as _:
+                pass
+            # 列出当前库的表
+            logger.debug("[DB] tables = %s", inspect(engine).get_table_names())
+            # 直接裸查计数，绕过 ORM
+            try:
+                cnt = conn.execute(text('SELECT COUNT(*) FROM `DigitalAvatar`')).scalar_one()
+                logger.debug("[DB] COUNT(`DigitalAvatar`) = %s", cnt)
+            except Exception as e:
+                logger.error(f'[DB] COUNT 出错: {e}')
+        # 打印前几条记录的user_id用于对比
+        for i, avatar in enumerate(DigitalAvatar.query.limit(3).all()):
+            logger.debug("记录 %d: user_id='%s', name='%s'", i + 1, avatar.user_id, avatar.name)
+        count = DigitalAvatar.query.filter(DigitalAvatar.user_id == self.user_id).count()
+        logger.debug("用户 %s 有 %d 条数字分身记录", self.user_id, count)
     
     def load_travel_partner_from_db(self):
         """从数据库加载用户个人资料数据"""
@@ -196,11 +188,11 @@ class DialogueContext:
             ).order_by(TravelPartner.created_at.desc()).first()
             
             if self.travel_partner:
-                logger.info(f"成功加载旅行伙伴数据: partner_id={self.travel_partner.partner_id}, "
-                           f"partner_name={self.travel_partner.partner_name}, "
-                           f"partner_description={self.travel_partner.partner_description}, "
-                           f"partner_avatar_url={self.travel_partner.partner_avatar_url}, "
-                           f"created_at={self.travel_partner.created_at}")
+                logger.info("成功加载旅行伙伴数据: user_id=%s, partner_id=%s",
+                            self.user_id, self.travel_partner.partner_id)
+                logger.debug("旅行伙伴: partner_name=%s, partner_description=%s, partner_avatar_url=%s, created_at=%s",
+                             self.travel_partner.partner_name, self.travel_partner.partner_description,
+                             self.travel_partner.partner_avatar_url, self.travel_partner.created_at)
             else:
                 logger.warning(f"未找到用户 {self.user_id} 的旅行伙伴数据")
         except Exception as e:
@@ -215,11 +207,10 @@ class DialogueContext:
             ).order_by(TravelSettings.created_at.desc()).first()
             
             if self.travel_settings:
-                logger.info(f"成功加载旅行设置数据: settings_id={self.travel_settings.settings_id}, "
-                           f"destination={self.travel_settings.destination}, "
-                           f"days={self.travel_settings.days}, "
-                           f"preference={self.travel_settings.preference}, "
-                           f"created_at={self.travel_settings.created_at}")
+                logger.info("成功加载旅行设置数据: user_id=%s, settings_id=%s, destination=%s",
+                            self.user_id, self.travel_settings.settings_id, self.travel_settings.destination)
+                logger.debug("旅行设置: days=%s, preference=%s, created_at=%s", self.travel_settings.days,
+                             self.travel_settings.preference, self.travel_settings.created_at)
             else:
                 logger.warning(f"未找到用户 {self.user_id} 的旅行设置数据")
         except Exception as e:
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Optional, Callable, Any
 import time
 import logging
 
@@ -7,7 +7,11 @@ from .dialogue_context import DialogueContext
 from .digital_avatar import DigitalAvatar
 from .digital_partner import DigitalPartner
 from .agent_data import TurnAction
+from .step_context import StepContext, StepCancelled
+from ..dbops.dao import get_user_session_id
 from ..idgeneration.id_gen import new_message_id
+from ..observability.tracing import span, trace_of
+from ..observability.profiler import step_profiler
 
 logger = logging.getLogger(__name__)
 
@@ -17,28 +21,54 @@ class DialogueController:
         self.user_context: Dict[str, DialogueContext] = {}
 
 
-    def step(self, user_id: str):
+    def step(self, user_id: str, on_typing: Optional[Callable[[Dict[str, Any]], Any]] = None,
+             step_ctx: Optional[StepContext] = None):
+        """
+        生成一轮对话。
+        on_typing: 可选回调；Thought 结果校验通过、确定发言者后立即以“正在输入”帧调用，
+                   让客户端在 speak 的 LLM 调用期间就能显示输入状态。
+        step_ctx: 可选的截止时间与取消令牌；取消后抛出 StepCancelled，不再继续调用 LLM。
+        管理接口为该用户布置了 cProfile 时，本轮在剖析下执行。
+        """
+        if step_profiler.armed:
+            return step_profiler.run(user_id, self._step, user_id, on_typing, step_ctx)
+        return self._step(user_id, on_typing, step_ctx)
+
+    def _step(self, user_id: str, on_typing: Optional[Callable[[Dict[str, Any]], Any]],
+              step_ctx: Optional[StepContext]):
+        trace = trace_of(step_ctx)
+
         # 构建完整的用户上下文
-        context = self.build_user_context(user_id)
+        with span(trace, "context_build"):
+            context = self.build_user_context(user_id)
         if not context:
             logger.error(f"Failed to build context for user {user_id}")
             return None
         
         # 思考
-        thought_result = self.thought(user_id)
+        thought_result = self.thought(user_id, step_ctx)
         
         if thought_result is None:
             logger.error(f"Thought failed for user {user_id}")
             return None
 
+        if step_ctx is not None:
+            step_ctx.check()
+
+        # 预告发言者（不影响本轮生成）
+        if on_typing is not None:
+            self.announce_typing(user_id, thought_result, on_typing)
+
         # 调用工具
         speak_result = None
         try:
-            speak_result = self.act(user_id, thought_result)
+            speak_result = self.act(user_id, thought_result, step_ctx)
             
             if not speak_result or "text" not in speak_result:
                 logger.error(f"Act failed for user {user_id}")
                 return None
+        except StepCancelled:
+            raise
         except Exception as e:
             logger.error(f"Act method failed for user {user_id}: {e}, speak_result: {speak_result}")
             return None
@@ -47,7 +77,8 @@ class DialogueController:
         self.reflect(user_id)
 
         # 更新用户上下文
-        self.update_user_context(user_id, thought_result, speak_result)
+        with span(trace, "context_update"):
+            self.update_user_context(user_id, thought_result, speak_result)
 
         # 构建回复消息
         reply = {
@@ -70,7 +101,15 @@ class DialogueController:
         return reply
 
     def build_user_context(self, user_id: str):
-        """从字典中获取context实例，如果没有则创建一个"""
+        """
+        从字典中获取context实例，如果没有则创建一个。
+        已有实例的 session_id 与用户当前会话不一致时（其他 worker 处理了 new_session 登录）丢弃重建；
+        当前会话走 session_cache，其他 worker 开启的新会话最多在缓存 TTL 后生效。
+        """
+        context = self.user_context.get(user_id)
+        if context is not None and context.session_id != get_user_session_id(user_id):
+            logger.info("Session changed for user %s (was %s), rebuilding context", user_id, context.session_id)
+            self.evict_context(user_id)
         if user_id not in self.user_context:
             try:
                 self.user_context[user_id] = DialogueContext(user_id)
@@ -81,47 +120,90 @@ class DialogueController:
         
         return self.user_context[user_id]
 
+    def has_context(self, user_id: str) -> bool:
+        return user_id in self.user_context
+
+    def evict_context(self, user_id: str) -> bool:
+        """丢弃用户的上下文，下次 step 时从数据库重建；返回是否存在"""
+        return self.user_context.pop(user_id, None) is not None
+
     def update_user_context(self, user_id: str, thought_result, speak_result):
         # 更新用户上下文
         self.user_context[user_id].update(thought_result, speak_result)
 
-    def thought(self, user_id: str):
+    def thought(self, user_id: str, step_ctx: Optional[StepContext] = None):
         context = self.user_context[user_id]
-        thought = Thought(context)
+        thought = Thought(context, step_ctx)
         return thought.thought()
 
-    def act(self, user_id: str, thought_result):
+    def speaker_info(self, user_id: str, turn_action) -> Optional[Dict[str, str]]:
+        """根据 turn_action 从用户资料中取出发言者信息；资料缺失时返回 None"""
+        context = self.user_context[user_id]
+        if turn_action == TurnAction.SPEAK_USER_DIGITAL_AVATAR:
+            avatar = context.digital_avatar
+            if not avatar:
+                return None
+            return {
+                "speaker_id": avatar.avatar_id,
+                "speaker_type": "avatar",
+                "agent_name": avatar.name,
+                "agent_photo_url": avatar.avatar_url,
+            }
+        if turn_action == TurnAction.SPEAK_TRAVEL_PARTNER:
+            partner = context.travel_partner
+            if not partner:
+                return None
+            return {
+                "speaker_id": partner.partner_id,
+                "speaker_type": "partner",
+                "agent_name": partner.partner_name,
+                "agent_photo_url": partner.partner_avatar_url,
+            }
+        return None
+
+    def announce_typing(self, user_id: str, thought_result, on_typing: Callable[[Dict[str, Any]], Any]) -> None:
+        """推送“正在输入”帧：{"type": "typing", "user_id", "agent_info"}；失败只记录日志"""
+        info = self.speaker_info(user_id, thought_result.turn_action)
+        if info is None:
+            return
+        try:
+            on_typing({
+                "type": "typing",
+                "user_id": user_id,
+                "agent_info": {
+                    "agent_id": info["speaker_id"],
+                    "agent_type": info["speaker_type"],
+                    "agent_name": info["agent_name"],
+                    "agent_photo_url": info["agent_photo_url"]
+                }
+            })
+        except Exception as e:
+            logger.warning(f"Typing announce failed for user {user_id}: {e}")
+
+    def act(self, user_id: str, thought_result, step_ctx: Optional[StepContext] = None):
         speak_result = {}
 
         if thought_result.turn_action == TurnAction.SPEAK_USER_DIGITAL_AVATAR:
-            avatar = DigitalAvatar()
-            speak_text = avatar.speak(self.user_context[user_id], thought_result)
-            speak_result = {"text": speak_text}
-            
             # 检查digital_avatar是否存在
             if not self.user_context[user_id].digital_avatar:
                 logger.error(f"Digital avatar not found for user {user_id}")
                 raise ValueError(f"Digital avatar not found for user {user_id}")
-            
-            speak_result["speaker_id"] = self.user_context[user_id].digital_avatar.avatar_id
-            speak_result["agent_name"] = self.user_context[user_id].digital_avatar.name
-            speak_result["agent_photo_url"] = self.user_context[user_id].digital_avatar.avatar_url
-            speak_result["speaker_type"] = "avatar"
-            
-        elif thought_result.turn_action == TurnAction.SPEAK_TRAVEL_PARTNER:
-            partner = DigitalPartner()
-            speak_text = partner.speak(self.user_context[user_id], thought_result)
+
+            avatar = DigitalAvatar()
+            speak_text = avatar.speak(self.user_context[user_id], thought_result, step_ctx)
             speak_result = {"text": speak_text}
+            speak_result.update(self.speaker_info(user_id, thought_result.turn_action))
             
+        elif thought_result.turn_action == TurnAction.SPEAK_TRAVEL_PARTNER:
             # 检查travel_partner是否存在
             if not self.user_context[user_id].travel_partner:
                 logger.error(f"Travel partner not found for user {user_id}")
                 raise ValueError(f"Travel partner not found for user {user_id}")
-            
-            speak_result["speaker_id"] = self.user_context[user_id].travel_partner.partner_id
-            speak_result["agent_name"] = self.user_context[user_id].travel_partner.partner_name
-            speak_result["agent_photo_url"] = self.user_context[user_id].travel_partner.partner_avatar_url
-            speak_result["speaker_type"] = "partner"
+
+            partner = DigitalPartner()
+            speak_text = partner.speak(self.user_context[user_id], thought_result, step_ctx)
+            speak_result = {"text": speak_text}
+            speak_result.update(self.speaker_info(user_id, thought_result.turn_action))
 
         speak_result["message_id"] = new_message_id()
         return speak_result
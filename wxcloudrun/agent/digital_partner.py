@@ -1,6 +1,8 @@
 from ..llm.ai_service import DeepSeekV3Service
 from .dialogue_context import DialogueContext
 from .agent_data import ThoughtResult
+from .step_context import StepContext
+from typing import Optional
 from string import Template
 import json
 
@@ -8,15 +10,16 @@ import json
 class DigitalPartner:
 
     def __init__(self):
-        self.ai_service = DeepSeekV3Service()
+        self.ai_service = DeepSeekV3Service(route="speak")
         
-    def speak(self, context: DialogueContext, thought_result: ThoughtResult) -> str:
+    def speak(self, context: DialogueContext, thought_result: ThoughtResult, step_ctx: Optional[StepContext] = None) -> str:
         """生成伙伴回复"""
         messages = [{"role": "user", "content": self.my_prompt(context, thought_result)}]
         api_response = self.ai_service.chat_completion(
                 messages=messages,
                 temperature=0.7,
-                max_tokens=500
+                max_tokens=500,
+                step_ctx=step_ctx
             )
         response_text = self.ai_service.extract_response_text(api_response)
         obj = json.loads(response_text)   # -> dict
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from ..dbops.dao import get_user_session_id, insert_chat_message
+from ..dbops.model import ChatMessages
+from ..observability.sql_stats import sql_scope
+from .coordination import COORDINATION_DIR, leader, user_affinity
+
+logger = logging.getLogger(__name__)
+
+# 多 worker 部署时等待该用户进行中 step 的最长时间
+OPENING_LOCK_TIMEOUT = 60.0
+
+
+class OpeningTurnStore:
+    """线程安全：保存每个用户预生成的开场消息（已编码前的 reply 字典），首次握手时取走"""
+    TTL_SECONDS = 6 * 3600  # 过期的开场白不再投递，交给实时调度生成
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._turns: Dict[str, Tuple[Dict[str, Any], float]] = {}  # {user_id: (reply, created_at)}
+
+    def put(self, user_id: str, reply: Dict[str, Any]) -> None:
+        with self._lock:
+            self._turns[user_id] = (reply, time.monotonic())
+
+    def pop(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """取走并删除开场消息；不存在或已过期返回 None"""
+        with self._lock:
+            item = self._turns.pop(user_id, None)
+        if item is None:
+            return None
+        reply, created_at = item
+        if time.monotonic() - created_at > self.TTL_SECONDS:
+            return None
+        return reply
+
+    def discard(self, user_id: str) -> None:
+        with self._lock:
+            self._turns.pop(user_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._turns)
+
+
+class FileOpeningTurnStore(OpeningTurnStore):
+    """
+    同一容器内多 worker 共享的开场消息：每个用户一个 JSON 文件，由处理 /api/save-all 的 worker 写入，
+    用户连到哪个 worker 就由哪个 worker 取走；取走用 rename，并发握手时只有一个能拿到
+    """
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id: str) -> str:
+        digest = hashlib.sha1(str(user_id).encode("utf-8")).hexdigest()[:20]
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def _scratch(self, path: str, suffix: str) -> str:
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.{suffix}"
+
+    def put(self, user_id: str, reply: Dict[str, Any]) -> None:
+        path = self._path(user_id)
+        tmp = self._scratch(path, "tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"reply": reply, "created_at": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def pop(self, user_id: str) -> Optional[Dict[str, Any]]:
+        path = self._path(user_id)
+        claimed = self._scratch(path, "claim")
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(claimed, encoding="utf-8") as f:
+                item = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"[OPENING] 读取开场消息失败 user={user_id}: {e}")
+            return None
+        finally:
+            try:
+                os.unlink(claimed)
+            except FileNotFoundError:
+                pass
+        if time.time() - item["created_at"] > self.TTL_SECONDS:
+            return None
+        return item["reply"]
+
+    def discard(self, user_id: str) -> None:
+        try:
+            os.unlink(self._path(user_id))
+        except FileNotFoundError:
+            pass
+
+    def __len__(self) -> int:
+        try:
+            return sum(1 for name in os.listdir(self.directory) if name.endswith(".json"))
+        except FileNotFoundError:
+            return 0
+
+    def purge_expired(self) -> int:
+        """删除过期未取走的开场消息与中断写入 / 取走留下的临时文件（leader 任务）；返回删除数"""
+        cutoff = time.time() - self.TTL_SECONDS
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        if removed:
+            logger.info(f"[LEADER] purged {removed} expired opening turns")
+        return removed
+
+
+def opening_store_from_env() -> OpeningTurnStore:
+    """多 worker 时开场消息放在各 worker 共享的目录里（任一 worker 生成、任一 worker 投递），否则放在进程内"""
+    if not user_affinity.enabled:
+        return OpeningTurnStore()
+    store = FileOpeningTurnStore(os.path.join(COORDINATION_DIR, "openings"))
+    leader.register("opening_purge", 3600.0, store.purge_expired)
+    return store
+
+
+def schedule_opening_turn(app: Any, user_id: str) -> None:
+    """在后台线程中为刚保存资料的用户预生成开场消息（gevent 下为协程，不阻塞请求）"""
+    app.extensions["opening_turns"].discard(user_id)  # 资料已变更，旧开场白作废
+    threading.Thread(
+        target=_run_in_ctx,
+        args=(app, user_id),
+        daemon=True
+    ).start()
+
+
+def _run_in_ctx(app: Any, user_id: str) -> None:
+    with app.app_context():
+        try:
+            generate_opening_turn(app, user_id)
+        except Exception as e:
+            logger.error(f"[OPENING] 预生成开场消息失败 user={user_id}: {e}", exc_info=True)
+
+
+def generate_opening_turn(app: Any, user_id: str) -> Optional[Dict[str, Any]]:
+    """
+    跑一次完整的 Thought + speak，放入 OpeningTurnStore；握手送达后才落库（见 persist_opening_turn）。
+    使用独立的 DialogueController，避免与实时调度器共享尚未构建完成的上下文。
+    """
+    from .dialogue_controller import DialogueController
+
+    live_controller = app.extensions["dialogue_controller"]
+    # 资料已更新：丢弃调度器里基于旧资料构建的上下文，下次 step 从数据库重建
+    live_controller.evict_context(user_id)
+
+    start = time.monotonic()
+    controller = DialogueController()
+    # 与实时调度跨进程互斥：该用户正由某个 worker 生成时等它这一轮结束
+    with user_affinity.step_lock(user_id, timeout=OPENING_LOCK_TIMEOUT) as locked:
+        if not locked:
+            logger.warning(f"[OPENING] 等待用户 step 锁超时，跳过开场消息 user={user_id}")
+            return None
+        with sql_scope("step", "opening"):
+            reply = controller.step(user_id)
+    if reply is None:
+        logger.warning(f"[OPENING] 开场消息生成失败 user={user_id}")
+        return None
+
+    if live_controller.has_context(user_id):
+        # 用户已在线且调度器已开始生成，开场白不再需要
+        logger.info(f"[OPENING] 用户已在线，丢弃开场消息 user={user_id}")
+        return None
+
+    # 先不落库：用户可能永远收不到（进程重启、过期、连到其他 worker），未送达的开场白不能进入历史
+    app.extensions["opening_turns"].put(user_id, reply)
+    logger.info(f"[OPENING] 开场消息已就绪 user={user_id}, 耗时 {time.monotonic() - start:.2f}秒")
+    return reply
+
+
+def persist_opening_turn(user_id: str, reply: Dict[str, Any]) -> None:
+    """开场消息已送达：记入用户当前会话，调度器重建上下文时把它纳入历史，从它继续往下聊"""
+    session_id = get_user_session_id(user_id)
+    agent_info = reply["agent_info"]
+    for content in reply["contents"]:
+        insert_chat_message(ChatMessages(
+            user_id=user_id,
+            session_id=session_id,
+            speaker_id=agent_info["agent_id"],
+            speaker_type=agent_info["agent_type"],
+            message_id=content["message_id"],
+            message=content["text"],
+        ))
@@ -0,0 +1,221 @@
+"""
+跨实例的在线状态（presence）注册表：记录每个用户当前由哪个节点（实例中的 worker 进程）负责调度。
+
+- 归属是带 TTL 的租约 owner:<user_id>，持有方定期续约；节点心跳 node:<node_id> 同样带 TTL，
+  节点宕机后租约与心跳自然过期，其他节点可直接接管。
+- 一致性哈希（HashRing）给出用户在节点间的稳定偏好：同一用户同时在两个节点上有活跃连接时，
+  由环上更靠前的节点负责，节点增减只影响少量用户，不会来回抢占。
+- 交接协议：连接落在非归属节点 R 上时，R 写入交接请求 handoff:<user_id>=R 并进入 standby；
+  归属节点 H 续约时看到请求，若 H 上的连接已闲置（断线重连后旧连接尚未被发现）或环偏好 R，
+  就取消进行中的 step、把本地连接转为 standby 并交出租约；否则拒绝，R 保持 standby。
+  R 的接管轮询随后通过 SET NX 拿到租约，恢复调度。
+
+实现：InProcessPresence（进程内，单机验证用）与 NetworkPresence（HTTP 访问 presence_store 替身存储，
+多实例共用），两者共享同一套基于批量原子操作的逻辑。
+"""
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from ..observability.runtime import worker_count
+from .presence_store import MemoryKV, PresenceStoreServer
+
+logger = logging.getLogger(__name__)
+
+LOST = "lost"   # renew() 结果：租约已失效或被其他节点持有
+
+
+class PresenceUnavailable(Exception):
+    """presence 存储不可达或返回错误"""
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """一致性哈希环：每个节点 vnodes 个虚拟节点；owner() 沿环顺时针找第一个（可限定候选集合的）节点"""
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = 64):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._keys = [p[0] for p in points]
+        self._owners = [p[1] for p in points]
+
+    def owner(self, key: str, among: Optional[Iterable[str]] = None) -> Optional[str]:
+        if not self._keys:
+            return None
+        allowed = set(among) if among is not None else None
+        start = bisect.bisect(self._keys, _hash(key))
+        for i in range(len(self._keys)):
+            node = self._owners[(start + i) % len(self._keys)]
+            if allowed is None or node in allowed:
+                return node
+        return None
+
+
+class PresenceRegistry:
+    """
+    presence 注册表接口与公共逻辑；子类实现 _execute(ops)，按 presence_store 的操作格式原子执行一批操作。
+    所有方法在存储不可用时抛 PresenceUnavailable。
+    """
+
+    def __init__(self, node_id: str, ttl: float = 15.0, handoff_idle: float = 45.0):
+        self.node_id = node_id
+        self.ttl = ttl
+        self.handoff_idle = handoff_idle   # 归属节点上的连接闲置超过该秒数时，无条件同意交接
+        self._ring_lock = threading.Lock()
+        self._ring = HashRing([node_id])
+
+    def _execute(self, ops: List[List[Any]]) -> List[Any]:
+        raise NotImplementedError
+
+    # ----- 节点 -----
+    def heartbeat(self) -> None:
+        self._execute([["set", f"node:{self.node_id}", self.node_id, self.ttl, None]])
+
+    def live_nodes(self) -> List[str]:
+        nodes = sorted(self._execute([["scan", "node:"]])[0].values())
+        with self._ring_lock:
+            if nodes and nodes != self._ring.nodes:
+                self._ring = HashRing(nodes)
+        return nodes
+
+    def home_node(self, user_id: str) -> Optional[str]:
+        """一致性哈希下用户的首选节点（基于最近一次 live_nodes() 看到的节点集合）"""
+        with self._ring_lock:
+            return self._ring.owner(user_id)
+
+    # ----- 归属租约 -----
+    def owner(self, user_id: str) -> Optional[str]:
+        return self._execute([["get", f"owner:{user_id}"]])[0]
+
+    def claim(self, user_id: str) -> Optional[str]:
+        """
+        尝试取得用户租约，返回当前归属节点（等于 node_id 即成功）。
+        归属节点已失联时直接接管；否则登记交接请求，由归属节点在续约时决定是否交出。
+        """
+        key = f"owner:{user_id}"
+        _, holder = self._execute([["set", key, self.node_id, self.ttl, "nx"], ["get", key]])
+        if holder is None or holder == self.node_id:
+            return holder
+        alive, = self._execute([["get", f"node:{holder}"]])
+        if alive is None:
+            took, = self._execute([["set", key, self.node_id, self.ttl, ["eq", holder]]])
+            if took:
+                logger.info(f"[PRESENCE] took over user={user_id} from dead node {holder}")
+                return self.node_id
+        self._execute([["set", f"handoff:{user_id}", self.node_id, self.ttl, None]])
+        return holder
+
+    def renew(self, user_ids: List[str]) -> Dict[str, Optional[str]]:
+        """
+        续约本节点持有的用户（同时发送节点心跳），一次往返完成。
+        返回 {user_id: 状态}：None 正常；LOST 租约已丢失；其他值为请求交接的节点 id。
+        """
+        ops: List[List[Any]] = [["set", f"node:{self.node_id}", self.node_id, self.ttl, None]]
+        for user_id in user_ids:
+            ops.append(["set", f"owner:{user_id}", self.node_id, self.ttl, ["eq", self.node_id]])
+            ops.append(["get", f"handoff:{user_id}"])
+        results = self._execute(ops)
+        statuses: Dict[str, Optional[str]] = {}
+        for i, user_id in enumerate(user_ids):
+            renewed, requester = results[1 + 2 * i], results[2 + 2 * i]
+            if not renewed:
+                statuses[user_id] = LOST
+            elif requester and requester != self.node_id:
+                statuses[user_id] = requester
+            else:
+                statuses[user_id] = None
+        return statuses
+
+    def should_yield(self, user_id: str, requester: str, idle_seconds: Optional[float]) -> bool:
+        """交接决策：请求方在线，且本地连接已闲置或一致性哈希偏好请求方"""
+        if requester not in self.live_nodes():
+            return False
+        if idle_seconds is None or idle_seconds >= self.handoff_idle:
+            return True
+        with self._ring_lock:
+            return self._ring.owner(user_id, among=(self.node_id, requester)) == requester
+
+    def decline_handoff(self, user_id: str, requester: str) -> None:
+        self._execute([["del", f"handoff:{user_id}", ["eq", requester]]])
+
+    def release(self, user_id: str) -> bool:
+        """交出租约（仅当仍由本节点持有）；交接请求保留给请求方"""
+        released, = self._execute([["del", f"owner:{user_id}", ["eq", self.node_id]]])
+        return released
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__, "node_id": self.node_id, "ttl": self.ttl,
+                "handoff_idle": self.handoff_idle, "live_nodes": self.live_nodes()}
+
+
+class InProcessPresence(PresenceRegistry):
+    """进程内实现：多个实例共享同一个 MemoryKV 即可在单进程里模拟多个节点"""
+
+    def __init__(self, node_id: str, ttl: float = 15.0, handoff_idle: float = 45.0, kv: Optional[MemoryKV] = None):
+        super().__init__(node_id, ttl=ttl, handoff_idle=handoff_idle)
+        self.kv = kv if kv is not None else MemoryKV()   # 空的 MemoryKV 为假值（__len__），不能用 or
+
+    def _execute(self, ops: List[List[Any]]) -> List[Any]:
+        try:
+            return self.kv.execute(ops)
+        except ValueError as e:
+            raise PresenceUnavailable(str(e)) from e
+
+
+class NetworkPresence(PresenceRegistry):
+    """通过 HTTP 访问 presence_store（或兼容服务）的实现，多个实例共用同一个存储"""
+
+    def __init__(self, url: str, node_id: str, ttl: float = 15.0, handoff_idle: float = 45.0,
+                 timeout: float = 2.0):
+        import requests
+
+        super().__init__(node_id, ttl=ttl, handoff_idle=handoff_idle)
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def _execute(self, ops: List[List[Any]]) -> List[Any]:
+        try:
+            resp = self._session.post(f"{self.url}/ops", json={"ops": ops}, timeout=self.timeout)
+            resp.raise_for_status()
+            return resp.json()["results"]
+        except Exception as e:
+            raise PresenceUnavailable(f"presence store {self.url} failed: {e}") from e
+
+
+def presence_from_env() -> Optional[PresenceRegistry]:
+    """
+    按环境变量创建 presence 注册表；未配置时返回 None（只在容器内用文件锁协调）。
+      PRESENCE_BACKEND=memory|network
+      PRESENCE_URL=http://host:8002   network 时的存储地址；留空则在进程内启动替身存储（仅单进程验证用）
+      PRESENCE_NODE_ID=               节点名前缀，默认主机名；实际节点 id 会追加进程号
+      PRESENCE_TTL=15                 租约 / 心跳 TTL（秒）
+      PRESENCE_HANDOFF_IDLE=45        归属节点连接闲置多久后无条件同意交接（应大于客户端心跳间隔）
+    memory 与未配置 PRESENCE_URL 的 network 都是每个进程一份存储，多 worker 时各自认为拥有全部用户、
+    重复调度，因此 GUNICORN_WORKERS>1 时拒绝这两种配置（抛 ValueError）。
+    """
+    backend = os.environ.get("PRESENCE_BACKEND", "").lower()
+    if not backend:
+        return None
+    if worker_count() > 1 and (backend == "memory" or (backend == "network" and not os.environ.get("PRESENCE_URL"))):
+        raise ValueError(f"PRESENCE_BACKEND={backend} without a shared PRESENCE_URL keeps a per-process store; "
+                         f"it cannot coordinate {worker_count()} workers")
+    node_id = f"{os.environ.get('PRESENCE_NODE_ID') or socket.gethostname()}-{os.getpid()}"
+    ttl = float(os.environ.get("PRESENCE_TTL", "15"))
+    handoff_idle = float(os.environ.get("PRESENCE_HANDOFF_IDLE", "45"))
+    if backend == "memory":
+        return InProcessPresence(node_id, ttl=ttl, handoff_idle=handoff_idle)
+    if backend == "network":
+        url = os.environ.get("PRESENCE_URL")
+        if not url:
+            url = PresenceStoreServer().start().url
+            logger.info(f"[PRESENCE] PRESENCE_URL 未配置，使用进程内替身存储: {url}")
+        return NetworkPresence(url, node_id, ttl=ttl, handoff_idle=handoff_idle)
+    raise ValueError(f"unknown PRESENCE_BACKEND: {backend}")
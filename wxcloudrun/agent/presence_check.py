@@ -0,0 +1,80 @@
+"""
+用两个节点验证 presence 注册表的归属租约、续约、交接与释放（进程内共享存储与 HTTP 替身存储各跑一遍）：
+
+    python -m wxcloudrun.agent.presence_check
+"""
+import time
+
+from .presence import LOST, HashRing, InProcessPresence, NetworkPresence, PresenceRegistry
+from .presence_store import MemoryKV, PresenceStoreServer
+
+TTL = 0.5
+
+
+def _user_preferring(node: str, other: str, prefix: str) -> str:
+    """找一个一致性哈希在 {node, other} 之间偏好 node 的用户 id"""
+    ring = HashRing([node, other])
+    for i in range(1000):
+        user_id = f"{prefix}-{i}"
+        if ring.owner(user_id) == node:
+            return user_id
+    raise AssertionError("no user id prefers the node")
+
+
+def check(a: PresenceRegistry, b: PresenceRegistry, label: str) -> None:
+    a.heartbeat()
+    b.heartbeat()
+    assert a.live_nodes() == b.live_nodes() == sorted([a.node_id, b.node_id]), "both nodes must be live"
+
+    # 1) 两个节点争同一用户：先到者拿到租约，后到者登记交接请求
+    user = _user_preferring(a.node_id, b.node_id, f"{label}-keep")
+    assert a.claim(user) == a.node_id
+    assert b.claim(user) == a.node_id, "second node must not win a held lease"
+    assert a.renew([user]) == {user: b.node_id}, "owner must see the handoff request"
+    print(f"[{label}] claim: owner={a.owner(user)} handoff requested by {b.node_id}")
+
+    # 2) 拒绝交接：请求方在线，但本地连接仍活跃且一致性哈希偏好归属方
+    assert not a.should_yield(user, b.node_id, idle_seconds=1.0)
+    a.decline_handoff(user, b.node_id)
+    assert a.renew([user]) == {user: None}, "declined request must be cleared"
+    assert a.owner(user) == a.node_id
+    print(f"[{label}] handoff declined, owner stays {a.node_id}")
+
+    # 3) 同意交接：本地连接闲置；交出后请求方拿到租约，原归属方续约得到 LOST
+    assert b.claim(user) == a.node_id
+    assert a.should_yield(user, b.node_id, idle_seconds=a.handoff_idle)
+    assert a.release(user)
+    assert b.claim(user) == b.node_id
+    assert a.renew([user]) == {user: LOST}
+    print(f"[{label}] handoff granted, owner now {b.owner(user)}")
+
+    # 4) 节点失联：b 停止心跳与续约，TTL 过后 a 直接接管，b 续约得到 LOST
+    user2 = f"{label}-dead"
+    assert b.claim(user2) == b.node_id
+    time.sleep(TTL * 1.5)
+    a.heartbeat()
+    assert a.claim(user2) == a.node_id, "lease of a dead node must be taken over"
+    assert b.renew([user2]) == {user2: LOST}
+    print(f"[{label}] dead node takeover: owner={a.owner(user2)}")
+
+    # 5) 释放：只能释放自己持有的租约
+    assert not b.release(user2)
+    assert a.release(user2) and a.owner(user2) is None
+    print(f"[{label}] release ok")
+
+
+def main() -> None:
+    kv = MemoryKV()
+    check(InProcessPresence("node-a", ttl=TTL, kv=kv), InProcessPresence("node-b", ttl=TTL, kv=kv), "memory")
+
+    server = PresenceStoreServer().start()
+    try:
+        check(NetworkPresence(server.url, "node-a", ttl=TTL), NetworkPresence(server.url, "node-b", ttl=TTL),
+              "network")
+    finally:
+        server.stop()
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
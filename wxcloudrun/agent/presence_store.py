@@ -0,0 +1,173 @@
+"""
+在线状态（presence）存储的本地替身：带 TTL 的键值表 + 批量原子操作，语义对齐 Redis 的
+SET NX PX / 比较后删除，用于在没有共享存储的环境里验证多实例的归属与交接逻辑。
+
+操作（一个批次在同一把锁内按顺序执行，整体原子）：
+    ["get", key]                      -> value | None
+    ["set", key, value, ttl, cond]    -> bool；cond 为 None（无条件）/ "nx"（不存在或已过期）/ ["eq", v]（当前值等于 v）
+    ["del", key, cond]                -> bool；cond 为 None / ["eq", v]
+    ["scan", prefix]                  -> {key: value}
+
+单独起进程供多个实例共用：
+    python -m wxcloudrun.agent.presence_store --port 8002
+    PRESENCE_BACKEND=network PRESENCE_URL=http://10.0.0.5:8002 gunicorn ...
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class MemoryKV:
+    """线程安全的 TTL 键值表；过期键在访问时惰性删除，并每 SWEEP_EVERY 次操作整体清扫一次"""
+    SWEEP_EVERY = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}   # {key: (value, expires_at)}
+        self._ops = 0
+
+    def _live(self, key: str, now: float) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= now:
+            del self._data[key]
+            return None
+        return value
+
+    @staticmethod
+    def _matches(current: Any, cond: Any) -> bool:
+        if cond is None:
+            return True
+        if cond == "nx":
+            return current is None
+        if isinstance(cond, (list, tuple)) and len(cond) == 2 and cond[0] == "eq":
+            return current == cond[1]
+        raise ValueError(f"unknown condition: {cond!r}")
+
+    def _apply(self, op: List[Any], now: float) -> Any:
+        name = op[0]
+        if name == "get":
+            return self._live(op[1], now)
+        if name == "set":
+            _, key, value, ttl, cond = op
+            if not self._matches(self._live(key, now), cond):
+                return False
+            self._data[key] = (value, now + ttl if ttl else None)
+            return True
+        if name == "del":
+            _, key, cond = op
+            current = self._live(key, now)
+            if current is None or not self._matches(current, cond):
+                return False
+            del self._data[key]
+            return True
+        if name == "scan":
+            found = {}
+            for key in [k for k in self._data if k.startswith(op[1])]:
+                value = self._live(key, now)
+                if value is not None:
+                    found[key] = value
+            return found
+        raise ValueError(f"unknown op: {name}")
+
+    def execute(self, ops: List[List[Any]]) -> List[Any]:
+        """原子执行一批操作，按顺序返回各操作结果"""
+        now = time.time()
+        with self._lock:
+            self._ops += len(ops)
+            if self._ops >= self.SWEEP_EVERY:
+                self._ops = 0
+                for key in list(self._data):
+                    self._live(key, now)
+            return [self._apply(op, now) for op in ops]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+
+    def log_message(self, format: str, *args: Any) -> None:  # 静默默认访问日志
+        pass
+
+    def do_POST(self) -> None:
+        if self.path != "/ops":
+            return self._send_json(404, {"error": "not found"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            results = self.server.kv.execute(body["ops"])
+        except (KeyError, ValueError, TypeError) as e:
+            return self._send_json(400, {"error": str(e)})
+        self._send_json(200, {"results": results})
+
+    def do_GET(self) -> None:
+        if self.path != "/stats":
+            return self._send_json(404, {"error": "not found"})
+        self._send_json(200, {"keys": len(self.server.kv)})
+
+    def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    kv: MemoryKV
+
+
+class PresenceStoreServer:
+    """可在进程内启动的替身存储服务：start() 后通过 url 访问（POST /ops、GET /stats）"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.kv = MemoryKV()
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.kv = self.kv
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "PresenceStoreServer":
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self) -> None:
+        self._httpd.serve_forever()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Stand-in presence store (TTL key-value over HTTP)")
+    parser.add_argument("--host", default=os.environ.get("PRESENCE_STORE_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PRESENCE_STORE_PORT", "8002")))
+    args = parser.parse_args(argv)
+
+    server = PresenceStoreServer(args.host, args.port)
+    print(f"presence store listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
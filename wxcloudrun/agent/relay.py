@@ -0,0 +1,170 @@
+"""
+同一容器内多 worker 之间的帧转发：用户的 WebSocket 连接可能分散在多个 worker 上（多设备、重连时旧连接未断），
+只有归属 worker 为其生成消息；其他 worker 上的 standby 连接通过归属 worker 转发收到同样的帧。
+
+- 每个 worker 在 COORDINATION_DIR/relay/<pid>.sock 绑定一个 unix 数据报套接字；
+- standby worker 向归属 worker 订阅该用户（归属 pid 取自归属锁文件），随 standby 接管轮询定期续订，
+  超过 SUBSCRIPTION_TTL 未续订即失效（standby 连接全部下线后无需显式退订）；
+- 归属 worker 在 fan_out 时把已编码的帧原样转发给订阅者，订阅者发给本地的 standby 连接；
+- 发送不等待：接收方缓冲区满或已退出时丢弃并计数，不拖慢归属方的 step。
+
+ack 窗口与前后台停放仍按归属 worker 上的连接计算。跨实例（PRESENCE_BACKEND）的 standby 连接不经此转发。
+
+数据报格式（utf-8）：b"F" + user_id + b"\\n" + 帧；b"S" + user_id + b"\\n" + 订阅方 pid。
+"""
+import atexit
+import errno
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import gevent
+from gevent import socket
+
+logger = logging.getLogger(__name__)
+
+MAX_DATAGRAM = 256 * 1024
+
+
+class FrameRelay:
+    """线程安全：本 worker 的帧转发端点（订阅表 + 收发套接字）"""
+    SUBSCRIPTION_TTL = 6.0   # 约为 standby 接管轮询间隔的 3 倍
+
+    def __init__(self, directory: str, owner_pid: Callable[[str], Optional[int]]):
+        self.directory = directory
+        self.path: Optional[str] = None   # start() 时按本 worker 的 pid 确定
+        self._owner_pid = owner_pid
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Dict[int, float]] = {}   # {user_id: {pid: expires_at}}
+        self._recv_sock: Optional[socket.socket] = None
+        self._send_sock: Optional[socket.socket] = None
+        self.forwarded = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    @property
+    def active(self) -> bool:
+        return self._recv_sock is not None
+
+    def start(self, registry: Any) -> None:
+        """绑定本 worker 的套接字并启动接收协程；registry 为本 worker 的 RoundRobinSet"""
+        if self.active:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        try:
+            os.unlink(self.path)   # 同 pid 的旧进程留下的文件
+        except FileNotFoundError:
+            pass
+        recv_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        recv_sock.bind(self.path)
+        send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        send_sock.settimeout(0)   # 不等待：对方缓冲区满时立即失败
+        self._recv_sock, self._send_sock = recv_sock, send_sock
+        gevent.spawn(self._recv_loop, registry)
+        atexit.register(self.stop)   # 异常退出留下的文件由 leader 任务清理
+
+    def stop(self) -> None:
+        for sock in (self._recv_sock, self._send_sock):
+            if sock is not None:
+                sock.close()
+        self._recv_sock = self._send_sock = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    # === 归属方 ===
+    def forward(self, user_id: str, payload: str) -> int:
+        """把发给用户的帧转发给订阅了该用户的其他 worker；返回转发的 worker 数"""
+        if not self.active:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            subs = self._subscribers.get(user_id)
+            if not subs:
+                return 0
+            for pid in [pid for pid, expires_at in subs.items() if expires_at <= now]:
+                del subs[pid]
+            pids = list(subs)
+            if not subs:
+                del self._subscribers[user_id]
+        if not pids:
+            return 0
+        datagram = b"F" + user_id.encode("utf-8") + b"\n" + payload.encode("utf-8")
+        sent = sum(1 for pid in pids if self._send(pid, datagram))
+        with self._lock:
+            self.forwarded += sent
+        return sent
+
+    # === standby 方 ===
+    def subscribe(self, user_id: str) -> bool:
+        """向该用户当前的归属 worker 订阅（或续订）帧转发；找不到归属 worker 时返回 False"""
+        if not self.active:
+            return False
+        pid = self._owner_pid(user_id)
+        if pid is None or pid == os.getpid():
+            return False
+        return self._send(pid, b"S" + user_id.encode("utf-8") + b"\n" + str(os.getpid()).encode())
+
+    # === 内部 ===
+    def _send(self, pid: int, datagram: bytes) -> bool:
+        try:
+            self._send_sock.sendto(datagram, os.path.join(self.directory, f"{pid}.sock"))
+            return True
+        except OSError as e:
+            with self._lock:
+                self.dropped += 1
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN, errno.EWOULDBLOCK):
+                logger.warning("[RELAY] send to worker pid=%s failed: %s", pid, e)
+            return False
+
+    def _recv_loop(self, registry: Any) -> None:
+        sock = self._recv_sock
+        while self._recv_sock is sock:
+            try:
+                datagram = sock.recv(MAX_DATAGRAM)
+            except OSError as e:
+                if self._recv_sock is not sock:
+                    return   # stop() 关闭了套接字
+                logger.warning("[RELAY] receive failed: %s", e)
+                continue
+            try:
+                self._handle(registry, datagram)
+            except Exception as e:
+                logger.error("[RELAY] bad datagram: %s", e, exc_info=True)
+
+    def _handle(self, registry: Any, datagram: bytes) -> None:
+        kind, rest = datagram[:1], datagram[1:]
+        user, _, body = rest.partition(b"\n")
+        user_id = user.decode("utf-8")
+        if kind == b"S":
+            with self._lock:
+                self._subscribers.setdefault(user_id, {})[int(body)] = time.monotonic() + self.SUBSCRIPTION_TTL
+        elif kind == b"F":
+            if not registry.is_standby(user_id):
+                return   # 本 worker 已接管该用户或已无其连接
+            payload = body.decode("utf-8")
+            for ws in registry.get_conns(user_id):
+                try:
+                    ws.send(payload)
+                    with self._lock:
+                        self.delivered += 1
+                except Exception as e:
+                    logger.warning("[RELAY] send to standby connection failed user=%s: %s", user_id, e)
+                    registry.remove(user_id, ws)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "active": self.active,
+                "subscribed_users": sum(1 for subs in self._subscribers.values()
+                                        if any(t > now for t in subs.values())),
+                "forwarded": self.forwarded,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+            }
@@ -1,46 +1,290 @@
 import json
 import logging
-from typing import Any
+import os
+import threading
+import time
+import gevent
+from gevent import sleep
+from typing import Any, Dict, List, Optional
 from flask import current_app
 
+from .step_context import StepContext, StepCancelled, StepDeadlineExceeded, abort_stats
+from .coordination import frame_relay, user_affinity
+from ..llm.errors import LLMServiceError
+from ..llm.ai_service import rate_limit_delay
+from ..llm.resilience import LatencyTracker
+from ..observability.tracing import span
+from ..observability.sql_stats import sql_scope
+from ..observability.startup import startup
+
 
 logger = logging.getLogger(__name__)
 
+# LLM 暂时不可用时调度器单次最长退避
+MAX_BACKOFF_SECONDS = 5.0
+# 用户的 step 锁被其他进程持有（如其他 worker 上的开场白预生成）时，隔多久再调度该用户
+STEP_LOCK_BACKOFF_SECONDS = 0.5
+
+
+class DispatchStats:
+    """线程安全：调度器完成的 step 数、已投递回复数与 step 耗时分布（压测报告使用）"""
+
+    def __init__(self, window: int = 10000):
+        self._lock = threading.Lock()
+        self.step_latency = LatencyTracker(window=window)
+        self._since = time.monotonic()
+        self.steps = 0
+        self.delivered = 0
+
+    def observe_step(self, seconds: float, delivered: bool) -> None:
+        self.step_latency.observe(seconds)
+        with self._lock:
+            self.steps += 1
+            if delivered:
+                self.delivered += 1
+
+    def reset(self) -> None:
+        self.step_latency.reset()
+        with self._lock:
+            self._since = time.monotonic()
+            self.steps = 0
+            self.delivered = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = max(time.monotonic() - self._since, 1e-9)
+            counters = {"steps": self.steps, "delivered": self.delivered,
+                        "turns_per_second": round(self.delivered / elapsed, 3)}
+        for p in (50, 95, 99):
+            value = self.step_latency.percentile(p)
+            counters[f"step_p{p}"] = round(value, 4) if value is not None else None
+        return counters
+
+
+dispatch_stats = DispatchStats()
+
+
+class DispatchControl:
+    """
+    线程安全：调度器的运行时控制——同时进行的 step 上限（并发度）与全局暂停。
+    暂停只是不再发起新的 step，进行中的 step 照常完成；用户与连接保持不变。
+    """
+    MAX_CONCURRENCY = 64
+
+    def __init__(self, concurrency: int = 1):
+        self._cv = threading.Condition()
+        self.concurrency = self._clamp(concurrency)
+        self.inflight = 0
+        self.paused = False
+        self.paused_reason: Optional[str] = None
+
+    def _clamp(self, n: int) -> int:
+        return max(1, min(int(n), self.MAX_CONCURRENCY))
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """等待未暂停且有空闲并发名额；超时返回 False"""
+        with self._cv:
+            if not self._cv.wait_for(lambda: not self.paused and self.inflight < self.concurrency, timeout=timeout):
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self) -> None:
+        with self._cv:
+            self.inflight -= 1
+            self._cv.notify_all()
+
+    def set_concurrency(self, n: int) -> int:
+        """调大立即生效；调小时不打断进行中的 step，完成后自然回落"""
+        with self._cv:
+            self.concurrency = self._clamp(n)
+            self._cv.notify_all()
+            return self.concurrency
+
+    def pause(self, reason: str = "admin") -> None:
+        with self._cv:
+            self.paused = True
+            self.paused_reason = reason
+
+    def resume(self) -> None:
+        with self._cv:
+            self.paused = False
+            self.paused_reason = None
+            self._cv.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cv:
+            return {"concurrency": self.concurrency, "inflight": self.inflight,
+                    "paused": self.paused, "paused_reason": self.paused_reason}
+
+
+dispatch_control = DispatchControl(int(os.environ.get("DISPATCH_CONCURRENCY", "1")))
+
 
 def start_dispatch(stop_event: Any) -> None:
     """Consume events from the global WebSocket queue and dispatch work.
 
     Simplified dispatcher: ignores event type entirely.
-    For any dict event containing a "user_id", it will:
-      1) call DialogueController.step(user_id)
-      2) if a "ws" is present on the event, send the reply to that ws
+    For every user handed out by the round-robin registry, it will:
+      1) call DialogueController.step(user_id) once (cost is per user, not per device),
+         pushing a "typing" frame to all devices as soon as the speaker is known
+      2) encode the reply once and fan it out to all of the user's live connections
+      3) record the reply's message ids in the user's ack window before sending
+         (rolled back if no device got it); users whose window is full are not
+         handed out again until the client acks
+    Each step runs under a StepContext (deadline + cancel token). The token is
+    registered with the registry, so a user going fully offline aborts the
+    in-flight LLM request instead of letting the step run to completion.
+    When the provider rate limit is under pressure (429 back-off or a queued
+    quota backlog) the loop slows down before picking the next user instead
+    of starting steps that would only queue or fail.
+    Steps run in their own greenlet (and app context), at most
+    dispatch_control.concurrency at a time (DISPATCH_CONCURRENCY, default 1);
+    a user with a step in flight is not handed out again until it finishes.
+    dispatch_control.pause() stops new steps globally.
+    With several gunicorn workers each worker only dispatches the users it
+    owns (see coordination.UserAffinity); a per-user file lock keeps steps
+    for the same user from running in two processes at once.
     """
-    from .dialogue_controller import DialogueController
-
-    controller = DialogueController()
+    app = current_app._get_current_object()
 
     while not getattr(stop_event, "is_set", lambda: False)():
-        # 获取轮询队列
-        alive_chat_users = current_app.extensions["alive_chat_users"]
-        user_id, ws = alive_chat_users.next()   # 空则阻塞
-        if not user_id or not ws:
-            logger.warning("[DISPATCH] event without user_id: %s, ws: %s", user_id, ws)
+        # 暂停中或并发名额已满时等待（定期醒来检查 stop_event）
+        if not dispatch_control.acquire(timeout=1.0):
             continue
-
-        # 生成回复
+        started = False
         try:
-            reply = controller.step(user_id)
-        except Exception as e:
-            logger.error("[DISPATCH] error generating reply for user %s: %s", user_id, e)
-            # 生成回复失败时移除用户，避免无限重试
+            # 上游限流压力下先放慢节奏，用户保留在轮询队列中
+            delay = rate_limit_delay()
+            if delay > 0:
+                logger.info("[DISPATCH] provider rate limited, pausing dispatch %.1fs", delay)
+                sleep(min(delay, MAX_BACKOFF_SECONDS))
+
+            # 获取轮询队列
+            alive_chat_users = app.extensions["alive_chat_users"]
+            user_id, conns = alive_chat_users.next()   # 空则阻塞
+            if not user_id or not conns:
+                logger.warning("[DISPATCH] event without user_id: %s, conns: %s", user_id, conns)
+                continue
+
+            step_ctx = StepContext(user_id)
+            if not alive_chat_users.begin_step(user_id, step_ctx.token):
+                continue  # 取出后已下线
+            gevent.spawn(_run_step, app, alive_chat_users, user_id, conns, step_ctx)
+            started = True
+        finally:
+            if not started:
+                dispatch_control.release()
+
+
+def _run_step(app: Any, alive_chat_users: Any, user_id: str, conns: List[Any], step_ctx: StepContext) -> None:
+    """在独立 greenlet 中执行一轮 step 并投递回复；结束时把用户放回轮询并释放并发名额"""
+    released = False
+    try:
+        with user_affinity.step_lock(user_id) as locked:
+            if not locked:
+                # 其他进程正在为该用户生成：先交还并发名额，退避后再放回轮询（不计入 step 数）
+                dispatch_control.release()
+                released = True
+                step_ctx.trace.finish("busy")
+                sleep(STEP_LOCK_BACKOFF_SECONDS)
+                alive_chat_users.end_step(user_id, step_ctx.token, counted=False)
+                return
+            with app.app_context():
+                _step_and_deliver(app.extensions["dialogue_controller"], alive_chat_users, user_id, conns, step_ctx)
+    finally:
+        # 回复发出并登记到 ack 窗口之后才放回轮询：发送会让出执行权，提前放回时并发调度会在
+        # 窗口计数前再次取出该用户，越过窗口上限（busy 分支已按不计数放回，这里是空操作）
+        alive_chat_users.end_step(user_id, step_ctx.token)
+        if not released:
+            dispatch_control.release()
+
+
+def _step_and_deliver(controller: Any, alive_chat_users: Any, user_id: str, conns: List[Any],
+                      step_ctx: StepContext) -> None:
+    # 生成回复；Thought 完成后先推送“正在输入”帧
+    def _on_typing(frame):
+        fan_out(alive_chat_users, user_id, conns, json.dumps(frame, ensure_ascii=False))
+
+    step_started = time.monotonic()
+    try:
+        with sql_scope("step", "dispatch"):
+            reply = controller.step(user_id, on_typing=_on_typing, step_ctx=step_ctx)
+    except StepDeadlineExceeded as e:
+        # 超时：LLM 耗时已经花掉，不算取消节省；保留用户，下一轮重试
+        step_ctx.trace.finish("timeout")
+        abort_stats.record_timed_out_step()
+        logger.warning("[DISPATCH] step deadline exceeded for user %s: %s (%.1fs)",
+                       user_id, e, time.monotonic() - step_started)
+        return
+    except StepCancelled as e:
+        step_ctx.trace.finish("cancelled")
+        saved = abort_stats.record_aborted_step(step_ctx)
+        logger.info("[DISPATCH] step aborted for user %s: %s (saved ~%.1fs LLM, total %s)",
+                    user_id, e, saved, abort_stats.snapshot())
+        return
+    except LLMServiceError as e:
+        step_ctx.trace.finish("error")
+        if not e.transient:
+            logger.error("[DISPATCH] LLM error for user %s: %s", user_id, e)
             alive_chat_users.remove(user_id)
-            continue
+            return
+        # 超时 / 5xx / 429 / 熔断：保留用户，下一轮重试；有 retry_after 时放慢调度，避免空转
+        logger.warning("[DISPATCH] transient LLM error for user %s: %s", user_id, e)
+        if e.retry_after:
+            sleep(min(e.retry_after, MAX_BACKOFF_SECONDS))
+        return
+    except Exception as e:
+        step_ctx.trace.finish("error")
+        logger.error("[DISPATCH] error generating reply for user %s: %s", user_id, e)
+        # 生成回复失败时移除用户，避免无限重试
+        alive_chat_users.remove(user_id)
+        return
+
+    if step_ctx.token.cancelled:
+        step_ctx.trace.finish("cancelled")
+        return  # 生成完成前用户已下线，不再发送
+
+    # 发送回复：只编码一次，所有设备共用同一份缓冲
+    delivered = False
+    if reply is not None:
+        with span(step_ctx.trace, "ws_send"):
+            payload = json.dumps(reply, ensure_ascii=False)
+            delivered = deliver(alive_chat_users, user_id, conns, payload, reply, source="dispatch")
+    step_ctx.trace.finish("ok" if delivered else "empty")
+    dispatch_stats.observe_step(time.monotonic() - step_started, delivered)
 
-        # 发送回复
-        if reply is not None:
-            try:
-                ws.send(json.dumps(reply, ensure_ascii=False))
-            except Exception as send_err:
-                logger.error("[DISPATCH] send failed for user %s: %s", user_id, send_err)
-                # 移除失效的连接，等待前端重连
-                alive_chat_users.remove(user_id)
+
+def fan_out(alive_chat_users: Any, user_id: str, conns: List[Any], payload: str) -> int:
+    """
+    把同一份已编码的帧发送给用户的所有连接，并转发给持有该用户 standby 连接的其他 worker；
+    发送失败的连接会被剔除，返回本 worker 成功发送数
+    """
+    frame_relay.forward(user_id, payload)
+    delivered = 0
+    for ws in conns:
+        try:
+            ws.send(payload)
+            delivered += 1
+        except Exception as send_err:
+            logger.error("[DISPATCH] send failed for user %s: %s", user_id, send_err)
+            # 移除失效的连接，等待前端重连；其他设备不受影响
+            alive_chat_users.remove(user_id, ws)
+    return delivered
+
+
+def deliver(alive_chat_users: Any, user_id: str, conns: List[Any], payload: str, reply: dict, source: str) -> bool:
+    """
+    投递一轮回复：先把消息登记到 ack 窗口再发送（发送中途到达的 ack 能找到对应消息），
+    一个设备都没送达时撤销登记；送达后若是上线后的首条消息，记录首条消息耗时（TTFM）。返回是否送达
+    """
+    message_ids = [content.get("message_id") for content in reply.get("contents", [])]
+    alive_chat_users.mark_sent(user_id, message_ids)
+    if not fan_out(alive_chat_users, user_id, conns, payload):
+        alive_chat_users.unmark_sent(user_id, message_ids)
+        return False
+    startup.mark("first_turn")
+    ttfm = alive_chat_users.mark_first_message(user_id)
+    if ttfm is not None:
+        logger.info("[TTFM] user=%s source=%s time_to_first_message=%.3fs", user_id, source, ttfm)
+    return True
@@ -0,0 +1,165 @@
+import threading
+import time
+import logging
+from typing import Callable, Dict, List, Optional
+
+from ..observability.tracing import StepTrace
+
+logger = logging.getLogger(__name__)
+
+# 每轮 step 的 LLM 调用次数（Thought + speak），用于估算节省的调用量与耗时
+LLM_CALLS_PER_STEP = 2
+
+
+class StepCancelled(Exception):
+    """本轮 step 已被取消（用户所有连接都已断开等），不应再继续调用 LLM 或发送"""
+
+
+class StepDeadlineExceeded(StepCancelled):
+    """本轮 step 超出了截止时间（LLM 耗时已花费，调度器按超时统计，不计入取消节省）"""
+
+
+class CancelToken:
+    """线程安全的取消令牌：cancel() 只生效一次，并同步执行已登记的回调（如中断进行中的 HTTP 请求）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.cancelled = False
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """触发取消；返回是否为首次触发"""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.cancelled = True
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception as e:
+                logger.warning(f"[STEP] cancel callback failed: {e}")
+        return True
+
+    def add_callback(self, cb: Callable[[], None]) -> Callable[[], None]:
+        """登记取消回调，返回注销函数；若已取消则立即执行"""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(cb)
+                return lambda: self._discard(cb)
+        cb()
+        return lambda: None
+
+    def _discard(self, cb: Callable[[], None]) -> None:
+        with self._lock:
+            if cb in self._callbacks:
+                self._callbacks.remove(cb)
+
+
+class StepContext:
+    """
+    单轮 DialogueController.step 的执行上下文：截止时间 + 取消令牌 + 阶段 span 记录（trace）。
+    由调度器创建并一路传给 Thought / speak 的 LLM 调用；LLM 超时取 min(默认超时, 剩余时间)。
+    """
+    DEFAULT_BUDGET_SECONDS = 120.0
+
+    def __init__(self, user_id: str, budget: Optional[float] = None, token: Optional[CancelToken] = None,
+                 llm_cache: bool = False):
+        self.user_id = user_id
+        self.llm_cache = llm_cache   # 本轮所有 LLM 调用都允许走响应缓存（QA 回放用）
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + (budget if budget is not None else self.DEFAULT_BUDGET_SECONDS)
+        self.token = token or CancelToken()
+        self.trace = StepTrace(user_id)
+        self.llm_calls_started = 0
+        self._llm_inflight_since: Optional[float] = None
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def check(self) -> None:
+        """已取消或超出截止时间时抛出异常"""
+        if self.token.cancelled:
+            raise StepCancelled(f"step cancelled for user {self.user_id}: {self.token.reason}")
+        if self.remaining() <= 0:
+            raise StepDeadlineExceeded(f"step deadline exceeded for user {self.user_id}")
+
+    def timeout_for(self, default: float) -> float:
+        """本次调用可用的超时时间"""
+        self.check()
+        return min(default, self.remaining())
+
+    # === LLM 调用记录（用于估算取消节省的耗时） ===
+    def on_llm_call_start(self) -> None:
+        self.llm_calls_started += 1
+        self._llm_inflight_since = time.monotonic()
+
+    @property
+    def llm_inflight(self) -> bool:
+        return self._llm_inflight_since is not None
+
+    def on_llm_call_end(self, seconds: Optional[float] = None) -> None:
+        self._llm_inflight_since = None
+        if seconds is not None:
+            abort_stats.observe_llm_call(seconds)
+
+    def estimate_saved_seconds(self) -> float:
+        """估算取消后省下的 LLM 耗时：进行中调用的剩余预期耗时 + 尚未发起的调用"""
+        expected = abort_stats.expected_llm_call_seconds()
+        saved = max(0, LLM_CALLS_PER_STEP - self.llm_calls_started) * expected
+        if self._llm_inflight_since is not None:
+            saved += max(0.0, expected - (time.monotonic() - self._llm_inflight_since))
+        return saved
+
+
+class AbortStats:
+    """线程安全：统计被取消的 step 与节省的 LLM 耗时；超出截止时间的 step 单独计数，不计入节省"""
+    EWMA_ALPHA = 0.2
+    DEFAULT_CALL_SECONDS = 3.0   # 尚无样本时对单次 LLM 调用耗时的估计
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._call_seconds_ewma: Optional[float] = None
+        self.aborted_steps = 0
+        self.aborted_llm_calls = 0
+        self.llm_seconds_saved = 0.0
+        self.timed_out_steps = 0
+
+    def observe_llm_call(self, seconds: float) -> None:
+        with self._lock:
+            if self._call_seconds_ewma is None:
+                self._call_seconds_ewma = seconds
+            else:
+                self._call_seconds_ewma += self.EWMA_ALPHA * (seconds - self._call_seconds_ewma)
+
+    def expected_llm_call_seconds(self) -> float:
+        with self._lock:
+            return self._call_seconds_ewma if self._call_seconds_ewma is not None else self.DEFAULT_CALL_SECONDS
+
+    def record_aborted_step(self, step_ctx: StepContext) -> float:
+        """记录一次被取消的 step，返回估算节省的 LLM 秒数"""
+        saved = step_ctx.estimate_saved_seconds()
+        with self._lock:
+            self.aborted_steps += 1
+            if step_ctx.llm_inflight:
+                self.aborted_llm_calls += 1
+            self.llm_seconds_saved += saved
+        return saved
+
+    def record_timed_out_step(self) -> None:
+        with self._lock:
+            self.timed_out_steps += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "aborted_steps": self.aborted_steps,
+                "aborted_llm_calls": self.aborted_llm_calls,
+                "llm_seconds_saved": round(self.llm_seconds_saved, 3),
+                "timed_out_steps": self.timed_out_steps,
+            }
+
+
+abort_stats = AbortStats()
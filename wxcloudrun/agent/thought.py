@@ -1,6 +1,8 @@
 from ..llm.ai_service import DeepSeekV3Service
 from string import Template
 from .agent_data import ThoughtResult
+from .step_context import StepCancelled
+from ..observability.tracing import span, trace_of
 import logging
 
 logger = logging.getLogger(__name__)
@@ -8,41 +10,47 @@ logger = logging.getLogger(__name__)
 
 class Thought:
 
-    def __init__(self, context):
+    def __init__(self, context, step_ctx=None):
         self.context = context
-        self.ai_service = DeepSeekV3Service()
+        self.step_ctx = step_ctx
+        self.ai_service = DeepSeekV3Service(route="thought")
 
     def thought(self):
-        logger.info("=== Thought.thought() 开始执行 ===")
         try:
             prompt_content = self.my_prompt()
-            logger.info(f"Prompt 生成完成，长度: {len(prompt_content)} 字符")
+            logger.debug("Thought prompt 生成完成，长度: %d 字符", len(prompt_content))
             
             messages = [{"role": "user", "content": prompt_content}]
-            logger.info("准备调用 AI Service")
             
+            # 首个话题（无话题、无历史）只取决于目的地与人设，可复用缓存结果
             api_response = self.ai_service.chat_completion(
                     messages=messages,
                     temperature=0.7,
-                    max_tokens=500
+                    max_tokens=500,
+                    step_ctx=self.step_ctx,
+                    cacheable=self.is_first_turn()
                 )
-            logger.info("AI Service 调用完成")
             
             response_text = self.ai_service.extract_response_text(api_response)
-            logger.info(f"提取响应文本完成，长度: {len(response_text)} 字符")
-            logger.info(f"响应文本内容: {response_text}")
+            logger.debug("Thought 响应文本: %s", response_text)
             
-            result, err = ThoughtResult.try_from_dict(response_text)
+            with span(trace_of(self.step_ctx), "parse_validate"):
+                result, err = ThoughtResult.try_from_dict(response_text)
             if err:
                 logger.error(f"LLM's ThoughtResult validation failed: {err}")
                 return None
             
-            logger.info("ThoughtResult 解析成功")
+            logger.debug("ThoughtResult 解析成功")
             return result
+        except StepCancelled:
+            raise
         except Exception as e:
             logger.error(f"Thought.thought() 执行失败: {e}", exc_info=True)
             raise
 
+    def is_first_turn(self) -> bool:
+        return not self.context.current_topic and not self.context.history
+
     def my_prompt(self):
         prompt = Template("""你是旅行对话系统的“Thought 决策器”。你的任务：
 (1) 决定下一位发言者（数字分身 ${user_digital_avatar_name} 或 旅行伙伴 ${partner_name}），必要时让其连续多条自然表达（1–3 条）。
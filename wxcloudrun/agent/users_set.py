@@ -1,45 +1,299 @@
 import threading
+import time
 from collections import OrderedDict
-from typing import Hashable, Optional, List, Tuple, Any
+from typing import Hashable, Optional, List, Tuple, Any, Dict
+
+from .delivery_window import DeliveryWindow
+from .step_context import CancelToken, LLM_CALLS_PER_STEP
+
+
+def _buffered_bytes(ws: Any) -> int:
+    """simple_websocket 连接已收到、尚未被 receive() 取走的数据量（其他连接类型返回 0）"""
+    total = 0
+    for item in getattr(ws, "input_buffer", None) or ():
+        total += len(item) if isinstance(item, (bytes, str)) else 0
+    incoming = getattr(ws, "incoming_message", None)
+    if isinstance(incoming, (bytes, bytearray, str)):
+        total += len(incoming)
+    return total
+
+
+class _UserSlot:
+    """单个用户在轮询集合中的状态：在线连接 + 发送窗口 + 前后台状态"""
+    __slots__ = ("conns", "ack_conns", "hidden_conns", "window", "connected_at", "first_sent", "step_token",
+                 "step_started", "last_step_at", "last_step_seconds", "steps", "standby",
+                 "last_seen")
+
+    def __init__(self):
+        self.conns: List[Any] = []
+        self.ack_conns: List[Any] = []      # 握手时声明支持 ack 的连接
+        self.hidden_conns: List[Any] = []   # 已上报 pause（小程序 onHide）的连接
+        self.window = DeliveryWindow()
+        self.connected_at = time.monotonic()
+        self.first_sent = False
+        self.step_token: Optional[CancelToken] = None   # 进行中 step 的取消令牌
+        self.step_started: Optional[float] = None
+        self.last_step_at: Optional[float] = None       # 上一轮 step 结束时间（time.time()）
+        self.last_step_seconds: Optional[float] = None
+        self.steps = 0
+        self.standby = False   # 用户归属在其他 worker（多进程部署），本进程不为其调度
+        self.last_seen = self.connected_at   # 最近一次收到该用户任一连接的帧
+
+    def all_hidden(self) -> bool:
+        """所有在线设备都已切到后台"""
+        return bool(self.conns) and len(self.hidden_conns) == len(self.conns)
+
+    def window_enforced(self) -> bool:
+        """仅当所有在线设备都支持 ack 时才按窗口限流，避免老客户端永远收不到消息"""
+        return bool(self.conns) and len(self.ack_conns) == len(self.conns)
+
+    def blocked(self) -> bool:
+        return self.window_enforced() and self.window.is_full()
+
 
 class RoundRobinSet:
-    """线程安全：可增删用户，空时阻塞等待，公平轮询；每个用户仅一个 WebSocket 连接"""
+    """线程安全：可增删用户，空时阻塞等待，公平轮询；同一用户可有多个 WebSocket 连接（多设备）；
+    未确认消息已占满窗口的用户、所有设备都在后台的“停放”用户、step 仍在进行中的用户，
+    以及归属于其他 worker 的 standby 用户暂不参与轮询"""
     def __init__(self):
         self._cv = threading.Condition()
-        self._users: "OrderedDict[Hashable, Any]" = OrderedDict()  # {user_id: ws}
+        self._users: "OrderedDict[Hashable, _UserSlot]" = OrderedDict()  # {user_id: _UserSlot}
+        self._parked: set = set()         # 停放中的用户（保留队列位置与对话上下文）
+        self._skipped_window_full = 0     # 因窗口已满而少生成的轮次
+        self._skipped_parked = 0          # 因停放而少生成的轮次
 
-    def add(self, user: Hashable, ws: Any) -> None:
-        """加入/更新用户的 WebSocket 连接；若此前为空，会唤醒一个等待者"""
+    def add(self, user: Hashable, ws: Any, acks: bool = False, standby: bool = False) -> None:
+        """登记用户的一个 WebSocket 连接；新用户排到队尾，已在线用户仅追加设备、不改变轮询位置；
+        acks=True 表示该连接会回传 ack；standby=True 表示新用户归属于其他 worker，暂不调度；
+        若此前没有可调度用户，会唤醒等待者"""
         with self._cv:
-            was_empty = not self._users
-            # 更新该用户的 ws，并把它刷到队尾
-            self._users[user] = ws
-            self._users.move_to_end(user, last=True)
-            if was_empty:
-                self._cv.notify()  # 空->非空 时叫醒一个等待者
+            slot = self._users.get(user)
+            if slot is None:
+                slot = self._users[user] = _UserSlot()
+                slot.standby = standby
+            if ws not in slot.conns:
+                slot.conns.append(ws)
+                if acks:
+                    slot.ack_conns.append(ws)
+            self._refresh_parked(user, slot)  # 新设备默认在前台，会解除停放
+            self._cv.notify_all()
 
-    def remove(self, user: Hashable) -> None:
-        """删除用户（及其 WebSocket 连接）；不存在则忽略"""
+    def remove(self, user: Hashable, ws: Any = None) -> bool:
+        """
+        删除用户的某个连接；ws 为 None 时删除该用户全部连接；不存在则忽略。
+        用户完全下线时会取消其进行中的 step（中断在途的 LLM 请求）。
+        返回该用户是否已没有任何在线连接（即已从轮询中移除）。
+        """
         with self._cv:
+            slot = self._users.get(user)
+            if slot is None:
+                return True
+            if ws is not None:
+                if ws in slot.conns:
+                    slot.conns.remove(ws)
+                if ws in slot.ack_conns:
+                    slot.ack_conns.remove(ws)
+                if ws in slot.hidden_conns:
+                    slot.hidden_conns.remove(ws)
+                if slot.conns:
+                    self._refresh_parked(user, slot)
+                    # 剩余设备可能都不支持 ack，窗口不再生效，需唤醒调度器
+                    self._cv.notify_all()
+                    return False
             self._users.pop(user, None)
+            self._parked.discard(user)
+            token = slot.step_token
+        if token is not None:
+            token.cancel("user disconnected")  # 锁外执行回调，避免回调中再访问集合时死锁
+        return True
 
     def clear(self) -> None:
         """清空集合"""
         with self._cv:
+            tokens = [slot.step_token for slot in self._users.values() if slot.step_token is not None]
             self._users.clear()
+            self._parked.clear()
+        for token in tokens:
+            token.cancel("registry cleared")
+
+    def next(self, timeout: Optional[float] = None) -> Optional[Tuple[Hashable, List[Any]]]:
+        """
+        轮询返回 (user_id, [ws, ...])，连接列表为快照；跳过停放中、窗口已满和 step 进行中的用户（保留其队列位置）；
+        若没有可调度用户则阻塞直至有用户或超时；返回后把该用户放回队尾；超时返回 None。
+        """
+        with self._cv:
+            picked: List[Hashable] = []
+
+            def _ready() -> bool:
+                user = self._pick()
+                if user is None:
+                    return False
+                picked.append(user)
+                return True
+
+            if not self._cv.wait_for(_ready, timeout=timeout):
+                return None
+            user = picked[-1]
+            self._users.move_to_end(user, last=True)  # 放回队尾
+            return user, list(self._users[user].conns)
+
+    def _pick(self) -> Optional[Hashable]:
+        """返回队列中第一个可调度的用户；排在它前面被跳过的用户计入节省的轮次（需持锁调用）"""
+        skipped_full = skipped_parked = 0
+        for user, slot in self._users.items():
+            if slot.step_token is not None or slot.standby:
+                continue  # 调度器并发执行时，同一用户同时只跑一轮；standby 用户由归属 worker 调度
+            if user in self._parked:
+                skipped_parked += 1
+                continue
+            if slot.blocked():
+                skipped_full += 1
+                continue
+            self._skipped_window_full += skipped_full
+            self._skipped_parked += skipped_parked
+            return user
+        return None
+
+    # === 进行中的 step ===
+    def begin_step(self, user: Hashable, token: CancelToken) -> bool:
+        """登记用户进行中 step 的取消令牌；用户已下线返回 False"""
+        with self._cv:
+            slot = self._users.get(user)
+            if slot is None:
+                return False
+            slot.step_token = token
+            slot.step_started = time.monotonic()
+            return True
+
+    def end_step(self, user: Hashable, token: CancelToken, counted: bool = True) -> None:
+        """清除进行中 step 的登记；用户重新可调度，唤醒调度器。counted=False 表示未实际执行（不计入统计）"""
+        with self._cv:
+            slot = self._users.get(user)
+            if slot is not None and slot.step_token is token:
+                slot.step_token = None
+                if counted:
+                    slot.steps += 1
+                    slot.last_step_at = time.time()
+                    if slot.step_started is not None:
+                        slot.last_step_seconds = time.monotonic() - slot.step_started
+                slot.step_started = None
+                self._cv.notify_all()
+
+    def has_step(self, user: Hashable) -> bool:
+        with self._cv:
+            slot = self._users.get(user)
+            return slot is not None and slot.step_token is not None
+
+    # === 多 worker 归属 ===
+    def set_standby(self, user: Hashable, standby: bool) -> None:
+        """切换用户的 standby 状态；转为 standby 时取消进行中的 step，接管归属后唤醒调度器"""
+        with self._cv:
+            slot = self._users.get(user)
+            if slot is None or slot.standby == standby:
+                return
+            slot.standby = standby
+            token = slot.step_token if standby else None
+            if not standby:
+                self._cv.notify_all()
+        if token is not None:
+            token.cancel("ownership handed off")
 
-    def next(self, timeout: Optional[float] = None) -> Optional[Tuple[Hashable, Any]]:
+    def is_standby(self, user: Hashable) -> bool:
+        with self._cv:
+            slot = self._users.get(user)
+            return slot is not None and slot.standby
+
+    def touch(self, user: Hashable) -> None:
+        """记录收到了该用户的帧（心跳 / ack 等），用于判断连接是否已闲置"""
+        with self._cv:
+            slot = self._users.get(user)
+            if slot is not None:
+                slot.last_seen = time.monotonic()
+
+    def idle_seconds(self, user: Hashable) -> Optional[float]:
+        """距最近一次收到该用户帧的秒数；用户不在线返回 None"""
+        with self._cv:
+            slot = self._users.get(user)
+            return time.monotonic() - slot.last_seen if slot is not None else None
+
+    def standby_users(self) -> List[Hashable]:
+        with self._cv:
+            return [user for user, slot in self._users.items() if slot.standby]
+
+    # === 前后台停放 ===
+    def set_visible(self, user: Hashable, ws: Any, visible: bool) -> bool:
         """
-        轮询返回 (user_id, ws)；
-        若当前为空则阻塞直至有用户或超时；返回后把该用户放回队尾；超时返回 None。
+        记录某连接的前后台状态（小程序 onShow/onHide → resume/pause 帧）。
+        所有设备都在后台时用户进入停放集合；任一设备回到前台立即解除停放并唤醒调度器。
+        返回用户当前是否处于停放状态。
         """
         with self._cv:
-            ok = self._cv.wait_for(lambda: bool(self._users), timeout=timeout)
-            if not ok:
+            slot = self._users.get(user)
+            if slot is None or ws not in slot.conns:
+                return False
+            if visible:
+                if ws in slot.hidden_conns:
+                    slot.hidden_conns.remove(ws)
+            elif ws not in slot.hidden_conns:
+                slot.hidden_conns.append(ws)
+            return self._refresh_parked(user, slot)
+
+    def is_parked(self, user: Hashable) -> bool:
+        with self._cv:
+            return user in self._parked
+
+    def _refresh_parked(self, user: Hashable, slot: _UserSlot) -> bool:
+        """按连接状态更新停放集合；解除停放时唤醒调度器（需持锁调用）"""
+        if slot.all_hidden():
+            self._parked.add(user)
+            return True
+        if user in self._parked:
+            self._parked.discard(user)
+            self._cv.notify_all()
+        return False
+
+    # === 投递确认 ===
+    def mark_sent(self, user: Hashable, message_ids: List[str]) -> None:
+        """发送前登记待客户端确认的消息：发送会让出执行权，某个设备的 ack 可能在其余设备还没发完时就到达"""
+        with self._cv:
+            slot = self._users.get(user)
+            if slot is None:
+                return
+            for message_id in message_ids:
+                slot.window.on_sent(message_id)
+
+    def unmark_sent(self, user: Hashable, message_ids: List[str]) -> None:
+        """撤销 mark_sent 登记（一个设备都没送达）；窗口腾出空间时唤醒调度器"""
+        with self._cv:
+            slot = self._users.get(user)
+            if slot is None:
+                return
+            was_blocked = slot.blocked()
+            for message_id in message_ids:
+                slot.window.forget(message_id)
+            if was_blocked and not slot.blocked():
+                self._cv.notify_all()
+
+    def mark_first_message(self, user: Hashable) -> Optional[float]:
+        """消息已送达：若这是本次上线后的第一条消息，返回从上线到首条消息的耗时（秒），否则返回 None"""
+        with self._cv:
+            slot = self._users.get(user)
+            if slot is None or slot.first_sent:
                 return None
-            user, ws = self._users.popitem(last=False)  # 取队头
-            self._users[user] = ws                      # 放回队尾
-            return user, ws
+            slot.first_sent = True
+            return time.monotonic() - slot.connected_at
+
+    def ack(self, user: Hashable, message_id: str) -> int:
+        """客户端确认已渲染 message_id（累计确认）；窗口腾出空间时唤醒调度器。返回确认条数"""
+        with self._cv:
+            slot = self._users.get(user)
+            if slot is None or not message_id:
+                return 0
+            was_blocked = slot.blocked()
+            acked = slot.window.on_ack(message_id)
+            if was_blocked and not slot.blocked():
+                self._cv.notify_all()
+            return acked
 
     # === 查看与统计 ===
     def get_all(self) -> List[Hashable]:
@@ -47,10 +301,71 @@ class RoundRobinSet:
         with self._cv:
             return list(self._users.keys())
 
-    def get_ws(self, user: Hashable) -> Optional[Any]:
-        """获取某用户当前的 WebSocket 连接"""
+    def get_conns(self, user: Hashable) -> List[Any]:
+        """获取某用户当前全部 WebSocket 连接的快照"""
+        with self._cv:
+            slot = self._users.get(user)
+            return list(slot.conns) if slot else []
+
+    def conn_count(self) -> int:
+        """所有用户的在线连接总数"""
+        with self._cv:
+            return sum(len(slot.conns) for slot in self._users.values())
+
+    def stats(self) -> Dict[str, int]:
+        """
+        轮询集合的统计快照。ready_users 为调度器队列中可立即调度的用户数（队列深度）。
+        llm_calls_saved_* 按“被跳过的轮次 × 每轮 LLM 调用数”估算，只统计调度器实际跳过的轮次，是下限值。
+        """
+        with self._cv:
+            return {
+                "users": len(self._users),
+                "connections": sum(len(slot.conns) for slot in self._users.values()),
+                "parked_users": len(self._parked),
+                "window_blocked_users": sum(1 for slot in self._users.values() if slot.blocked()),
+                "ready_users": sum(1 for user, slot in self._users.items()
+                                   if user not in self._parked and not slot.blocked() and slot.step_token is None
+                                   and not slot.standby),
+                "standby_users": sum(1 for slot in self._users.values() if slot.standby),
+                "inflight_steps": sum(1 for slot in self._users.values() if slot.step_token is not None),
+                "skipped_turns_window_full": self._skipped_window_full,
+                "skipped_turns_parked": self._skipped_parked,
+                "llm_calls_saved_window_full": self._skipped_window_full * LLM_CALLS_PER_STEP,
+                "llm_calls_saved_parked": self._skipped_parked * LLM_CALLS_PER_STEP,
+            }
+
+    def user_states(self) -> List[Dict[str, Any]]:
+        """
+        每个在线用户的调度状态（管理接口使用），按轮询顺序排列：queue_position 为在队列中的位置，
+        ready 表示下一次轮询时可被调度；buffered_bytes 为各连接尚未读取的接收缓冲字节数估算
+        """
+        now = time.monotonic()
         with self._cv:
-            return self._users.get(user)
+            states = []
+            for position, (user, slot) in enumerate(self._users.items()):
+                parked = user in self._parked
+                inflight = slot.step_token is not None
+                states.append({
+                    "user_id": user,
+                    "queue_position": position,
+                    "ready": not parked and not inflight and not slot.blocked() and not slot.standby,
+                    "standby": slot.standby,
+                    "connections": len(slot.conns),
+                    "ack_connections": len(slot.ack_conns),
+                    "hidden_connections": len(slot.hidden_conns),
+                    "parked": parked,
+                    "window_blocked": slot.blocked(),
+                    "unacked": slot.window.unacked_count(),
+                    "inflight": inflight,
+                    "inflight_seconds": round(now - slot.step_started, 3) if inflight and slot.step_started else None,
+                    "steps": slot.steps,
+                    "last_step_at": slot.last_step_at,
+                    "last_step_seconds": round(slot.last_step_seconds, 3) if slot.last_step_seconds is not None else None,
+                    "connected_seconds": round(now - slot.connected_at, 1),
+                    "idle_seconds": round(now - slot.last_seen, 1),
+                    "buffered_bytes": sum(_buffered_bytes(ws) for ws in slot.conns),
+                })
+            return states
 
     def count(self) -> int:
         with self._cv:
@@ -0,0 +1,139 @@
+"""
+冷启动测量：启动一个全新的服务进程，记录
+- listening：进程启动到 /ping 首次返回 200（导入 + create_app 完成、开始接受连接）
+- ready：进程启动到 /ready 首次返回 200（后台预热完成、调度器已启动；旧版本没有 /ready 时等于 listening）
+- first_turn：进程启动到 /ws/chat 首个带 contents 的回复；与负载均衡按就绪探针放流量一致，在 ready 之后才连接
+- turn_latency：客户端连上到收到首个回复（用户实际感受到的冷启动延迟）
+并读取 /ready 返回的服务端分阶段耗时（import、create_app、db_warm 等）。
+
+    LLM_MOCK=1 MYSQL_ADDRESS=127.0.0.1:3306 python -m wxcloudrun.bench.coldstart \\
+        --cmd "gunicorn -k gevent -w 1 -t 0 -b 127.0.0.1:8090 run:app" --url http://127.0.0.1:8090 --runs 5
+
+用户需已有分身 / 伙伴 / 设置（可先跑一次 loadtest --seed），否则 first_turn 会超时。
+"""
+import argparse
+import json
+import os
+import shlex
+import signal
+import subprocess
+import time
+from typing import Any, Dict, List, Optional
+
+import requests
+from simple_websocket import Client, ConnectionClosed
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """与 loadtest.percentile 相同；不从 loadtest 导入，因其导入时会 monkey patch，子进程等待会卡在 gevent hub"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def _wait_for(url: str, started: float, deadline: float, accept_404: bool = False) -> Optional[float]:
+    """轮询 url 直到 200（accept_404 时 404 也算，用于兼容没有该路由的旧版本），返回距 started 的秒数"""
+    while time.monotonic() < deadline:
+        try:
+            resp = requests.get(url, timeout=1)
+            if resp.status_code == 200 or (accept_404 and resp.status_code == 404):
+                return time.monotonic() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def _first_turn(ws_url: str, user_id: str, started: float, deadline: float) -> Optional[float]:
+    """连接并握手，返回距 started 收到首个回复的秒数"""
+    try:
+        ws = Client.connect(ws_url)
+    except Exception:
+        return None
+    try:
+        ws.send(json.dumps({"user_id": user_id, "acks": True}))
+        while time.monotonic() < deadline:
+            msg = ws.receive(timeout=max(deadline - time.monotonic(), 0.01))
+            if msg and json.loads(msg).get("contents"):
+                return time.monotonic() - started
+    except ConnectionClosed:
+        return None
+    finally:
+        try:
+            ws.close()
+        except Exception:
+            pass
+    return None
+
+
+def measure_once(cmd: str, base_url: str, user_id: str, timeout: float) -> Dict[str, Any]:
+    started = time.monotonic()
+    proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    deadline = started + timeout
+    result: Dict[str, Any] = {"listening": None, "ready": None, "first_turn": None, "turn_latency": None,
+                              "server_phases": None}
+    try:
+        result["listening"] = _wait_for(f"{base_url}/ping", started, deadline)
+        if result["listening"] is None:
+            return result
+        result["ready"] = _wait_for(f"{base_url}/ready", started, deadline, accept_404=True)
+        if result["ready"] is None:
+            return result
+        connected = time.monotonic() - started
+        ws_url = base_url.replace("http", "ws", 1) + "/ws/chat"
+        result["first_turn"] = _first_turn(ws_url, user_id, started, deadline)
+        if result["first_turn"] is not None:
+            result["turn_latency"] = result["first_turn"] - connected
+        try:
+            body = requests.get(f"{base_url}/ready", timeout=1).json()
+            result["server_phases"] = (body.get("data") or {}).get("phases")
+        except (requests.RequestException, ValueError):
+            pass
+        return result
+    finally:
+        os.killpg(proc.pid, signal.SIGINT)   # gunicorn 快速退出，不等待长连接
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    runs: List[Dict[str, Any]] = []
+    for i in range(args.runs):
+        result = measure_once(args.cmd, args.url.rstrip("/"), f"{args.user_prefix}-{i}", args.timeout)
+        runs.append(result)
+        print(json.dumps({"run": i, **{k: round(v, 3) if isinstance(v, float) else v for k, v in result.items()}},
+                         ensure_ascii=False))
+    summary: Dict[str, Any] = {}
+    for name in ("listening", "ready", "first_turn", "turn_latency"):
+        samples = [r[name] for r in runs if r[name] is not None]
+        for p in (50, 95):
+            value = percentile(samples, p)
+            summary[f"{name}_p{p}"] = round(value, 3) if value is not None else None
+        summary[f"{name}_failed"] = len(runs) - len(samples)
+    print(json.dumps({"summary": summary}, ensure_ascii=False))
+    report = {"cmd": args.cmd, "runs": runs, "summary": summary}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cold start timing: process spawn -> /ping -> /ready -> first turn")
+    parser.add_argument("--cmd", default="gunicorn -k gevent -w 1 -t 0 -b 127.0.0.1:8090 run:app",
+                        help="server command (run from the repo root)")
+    parser.add_argument("--url", default="http://127.0.0.1:8090", help="server base url")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds per run before giving up")
+    parser.add_argument("--user-prefix", default="loadtest")
+    parser.add_argument("--json", help="write the full report to this file")
+    run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+/ws/chat 端到端压测：逐级打开 N 个 WebSocket 客户端（握手 + ping/pong + ack），统计每个阶段的
+吞吐（turns/s）、回复间隔与 step 耗时分位数，以及服务端内存 / greenlet 数。
+
+先用本地模拟 LLM 与本地 MySQL 启动服务（单个 gevent worker）：
+
+    LLM_MOCK=1 MOCK_LLM_LATENCY=0.8 MOCK_LLM_LATENCY_DIST=lognormal MOCK_LLM_JITTER=0.3 \\
+    MYSQL_ADDRESS=127.0.0.1:3306 gunicorn -k gevent -w 1 -t 0 -b 127.0.0.1:8080 run:app
+
+再运行压测（--seed 会先通过 /api/save-all 为压测用户写入分身 / 伙伴 / 设置）：
+
+    python -m wxcloudrun.bench.loadtest --url http://127.0.0.1:8080 --users 10,100,1000,10000 \\
+        --duration 60 --seed --json loadtest.json
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import resource
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import gevent
+import requests
+from gevent.pool import Pool
+from simple_websocket import Client, ConnectionClosed
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+class Recorder:
+    """线程安全：按阶段收集客户端侧样本，reset() 开始新阶段"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.monotonic()
+            self.replies = 0
+            self.typing = 0
+            self.errors = 0
+            self.inter_arrival: List[float] = []
+            self.typing_to_reply: List[float] = []
+            self.ping_rtt: List[float] = []
+
+    def add(self, field: str, value: Optional[float] = None) -> None:
+        with self._lock:
+            if value is None:
+                setattr(self, field, getattr(self, field) + 1)
+            else:
+                getattr(self, field).append(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            report: Dict[str, Any] = {
+                "elapsed": round(elapsed, 2),
+                "replies": self.replies,
+                "typing_frames": self.typing,
+                "errors": self.errors,
+                "client_turns_per_second": round(self.replies / elapsed, 3),
+            }
+            for name in ("inter_arrival", "typing_to_reply", "ping_rtt"):
+                samples = getattr(self, name)
+                for p in (50, 95, 99):
+                    value = percentile(samples, p)
+                    report[f"{name}_p{p}"] = round(value, 4) if value is not None else None
+            return report
+
+
+class LoadClient:
+    """一个模拟小程序客户端：握手后持续接收回复并 ack，按间隔发送 ping"""
+
+    def __init__(self, ws_url: str, user_id: str, recorder: Recorder, acks: bool, ping_interval: float):
+        self.ws_url = ws_url
+        self.user_id = user_id
+        self.recorder = recorder
+        self.acks = acks
+        self.ping_interval = ping_interval
+        self.ws: Optional[Client] = None
+        self.connected = False
+        self._ping_sent: Optional[float] = None
+        self._last_reply: Optional[float] = None
+        self._last_typing: Optional[float] = None
+        self._greenlets: List[gevent.Greenlet] = []
+
+    def start(self) -> None:
+        self.ws = Client.connect(self.ws_url)
+        self.ws.send(json.dumps({"user_id": self.user_id, "acks": self.acks}))
+        self.connected = True
+        self._last_reply = time.monotonic()
+        self._greenlets = [gevent.spawn(self._recv_loop), gevent.spawn(self._ping_loop)]
+
+    def _recv_loop(self) -> None:
+        while self.connected:
+            try:
+                msg = self.ws.receive(timeout=5)
+            except ConnectionClosed:
+                self.recorder.add("errors")
+                self.connected = False
+                return
+            if not msg:
+                continue
+            now = time.monotonic()
+            frame = json.loads(msg)
+            if frame.get("type") == "pong":
+                if self._ping_sent is not None:
+                    self.recorder.add("ping_rtt", now - self._ping_sent)
+                    self._ping_sent = None
+            elif frame.get("type") == "typing":
+                self._last_typing = now
+                self.recorder.add("typing")
+            elif frame.get("contents"):
+                self.recorder.add("replies")
+                if self._last_reply is not None:
+                    self.recorder.add("inter_arrival", now - self._last_reply)
+                if self._last_typing is not None:
+                    self.recorder.add("typing_to_reply", now - self._last_typing)
+                    self._last_typing = None
+                self._last_reply = now
+                if self.acks:
+                    self.ws.send(json.dumps({"type": "ack", "message_id": frame["contents"][-1].get("message_id")}))
+
+    def _ping_loop(self) -> None:
+        # 错开各客户端的首次 ping，避免整齐的突发
+        gevent.sleep(self.ping_interval * (hash(self.user_id) % 1000) / 1000.0)
+        while self.connected:
+            try:
+                self._ping_sent = time.monotonic()
+                self.ws.send(json.dumps({"type": "ping"}))
+            except ConnectionClosed:
+                self.connected = False
+                return
+            gevent.sleep(self.ping_interval)
+
+    def stop(self) -> None:
+        self.connected = False
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+        gevent.killall(self._greenlets, block=False)
+
+
+def seed_users(base_url: str, user_ids: List[str], concurrency: int = 50) -> int:
+    """通过 /api/save-all 写入压测用户的分身 / 伙伴 / 设置，返回成功数"""
+    ok = {"n": 0}
+
+    def _save(user_id: str) -> None:
+        body = {
+            "user_id": user_id,
+            "avatar": {"name": f"分身{user_id[-4:]}", "description": "喜欢慢节奏旅行，爱拍照", "avatar_url": ""},
+            "partner": {"partner_name": f"伙伴{user_id[-4:]}", "partner_description": "做事有计划，爱吃美食",
+                        "partner_avatar_url": ""},
+            "settings": {"destination": "成都", "days": 3, "preference": "美食、街巷漫步"},
+        }
+        try:
+            resp = requests.post(f"{base_url}/api/save-all", json=body, timeout=30)
+            if resp.ok and resp.json().get("code") == 0:
+                ok["n"] += 1
+        except requests.RequestException:
+            pass
+
+    Pool(concurrency).map(_save, user_ids)
+    return ok["n"]
+
+
+def server_runtime(base_url: str, reset: bool = False) -> Dict[str, Any]:
+    try:
+        resp = requests.get(f"{base_url}/test/runtime", params={"reset": "1"} if reset else None, timeout=30)
+        return resp.json().get("data", {})
+    except (requests.RequestException, ValueError):
+        return {}
+
+
+def raise_fd_limit() -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        target = hard if hard != resource.RLIM_INFINITY else 1 << 20
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    base_url = args.url.rstrip("/")
+    ws_url = base_url.replace("http://", "ws://").replace("https://", "wss://") + "/ws/chat"
+    levels = [int(n) for n in args.users.split(",")]
+    user_ids = [f"{args.user_prefix}-{i:05d}" for i in range(max(levels))]
+    fd_limit = raise_fd_limit()
+    if max(levels) + 100 > fd_limit:
+        print(f"warning: open file limit {fd_limit} is below {max(levels)} clients")
+
+    if args.seed:
+        start = time.monotonic()
+        seeded = seed_users(base_url, user_ids)
+        print(f"seeded {seeded}/{len(user_ids)} users in {time.monotonic() - start:.1f}s")
+
+    recorder = Recorder()
+    clients: List[LoadClient] = []
+    results = []
+    try:
+        for n in levels:
+            # 逐级加压：保留已有连接，按 ramp_rate 补足到 n 个
+            connect_errors = 0
+            while len(clients) < n:
+                batch = [LoadClient(ws_url, user_ids[len(clients) + i], recorder, not args.no_acks, args.ping_interval)
+                         for i in range(min(args.ramp_rate, n - len(clients)))]
+                jobs = [gevent.spawn(c.start) for c in batch]
+                gevent.joinall(jobs, timeout=30)
+                for c, job in zip(batch, jobs):
+                    if job.successful():
+                        clients.append(c)
+                    else:
+                        connect_errors += 1
+                        clients.append(c)  # 保留占位，避免重复使用同一 user_id
+                gevent.sleep(1)
+
+            gevent.sleep(args.warmup)
+            recorder.reset()
+            server_runtime(base_url, reset=True)
+            gevent.sleep(args.duration)
+
+            server = server_runtime(base_url)
+            client = recorder.snapshot()
+            dispatch = server.get("dispatch", {})
+            process = server.get("process", {})
+            row = {
+                "users": n,
+                "connected": sum(1 for c in clients if c.connected),
+                "connect_errors": connect_errors,
+                "client": client,
+                "server": server,
+            }
+            results.append(row)
+            rss = process.get("rss_bytes")
+            print(
+                f"N={n:>6} conn={row['connected']:>6} "
+                f"turns/s={client['client_turns_per_second']:>7} (server {dispatch.get('turns_per_second')}) "
+                f"step p50/p95/p99={dispatch.get('step_p50')}/{dispatch.get('step_p95')}/{dispatch.get('step_p99')}s "
+                f"gap p50/p95={client['inter_arrival_p50']}/{client['inter_arrival_p95']}s "
+                f"ping p95={client['ping_rtt_p95']}s "
+                f"rss={rss / 2 ** 20 if rss else 0:.0f}MB greenlets={process.get('greenlets')} "
+                f"errors={client['errors'] + connect_errors}",
+                flush=True,
+            )
+    finally:
+        for c in clients:
+            c.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="End-to-end /ws/chat load test")
+    parser.add_argument("--url", default="http://127.0.0.1:80", help="server base url")
+    parser.add_argument("--users", default="10,100,1000,10000", help="comma separated client counts per phase")
+    parser.add_argument("--duration", type=float, default=60.0, help="measure seconds per phase")
+    parser.add_argument("--warmup", type=float, default=10.0, help="seconds to wait after ramp before measuring")
+    parser.add_argument("--ramp-rate", type=int, default=200, help="new connections per second")
+    parser.add_argument("--ping-interval", type=float, default=25.0)
+    parser.add_argument("--user-prefix", default="loadtest")
+    parser.add_argument("--seed", action="store_true", help="create user profiles via /api/save-all first")
+    parser.add_argument("--no-acks", action="store_true", help="do not ack messages (exercises the delivery window)")
+    parser.add_argument("--json", help="write the full report to this file")
+    run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
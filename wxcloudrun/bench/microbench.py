@@ -0,0 +1,325 @@
+"""
+agent 热路径微基准：RoundRobinSet（单线程与多线程争用）、Thought / 两个发言者的提示词渲染、
+ThoughtResult 解析校验、id_gen、DialogueContext.update、日志记录开销。结果可写成 JSON，并与另一次提交的结果对比。
+
+    python -m wxcloudrun.bench.microbench --json bench-$(git rev-parse --short HEAD).json
+    python -m wxcloudrun.bench.microbench --compare bench-old.json --threshold 0.10
+    python -m wxcloudrun.bench.microbench --filter prompt --repeat 10
+
+不打 gevent 补丁：多线程争用用例使用真实 OS 线程，测的是锁竞争本身。
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..agent.users_set import RoundRobinSet
+from ..agent.agent_data import ThoughtResult
+from ..agent.dialogue_context import DialogueContext, HistoryItem
+from ..agent.thought import Thought
+from ..agent.digital_avatar import DigitalAvatar as AvatarSpeaker
+from ..agent.digital_partner import DigitalPartner as PartnerSpeaker
+from ..dbops.model import DigitalAvatar, TravelPartner, TravelSettings
+from ..idgeneration import id_gen
+from ..observability.logs import AsyncLogHandler, JsonFormatter, TEXT_FORMAT
+
+# 名称 -> (准备函数；返回 (被测函数, 每次调用包含的操作数))
+BENCHMARKS: Dict[str, Callable[[], Tuple[Callable[[], Any], int]]] = {}
+
+
+def benchmark(name: str):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+# ----- 测试数据 -----
+THOUGHT_JSON = json.dumps({
+    "turn_action": "SPEAK_TRAVEL_PARTNER",
+    "guidance_list": ["提出第一天的路线", "询问对方到达时间"],
+    "topic_action": "CONTINUE_TOPIC",
+    "topic_args": {"topic": "首日路线与到达时间", "new_topic": None},
+    "confidence": 0.82,
+    "rationale": "对方刚提出问题，需要回应并推进",
+}, ensure_ascii=False)
+
+
+def sample_context(history: int = 10) -> DialogueContext:
+    """不访问数据库，直接填充一个典型的对话上下文"""
+    ctx = DialogueContext("bench-user")
+    ctx.session_id = "ses_bench"
+    ctx.digital_avatar = DigitalAvatar(user_id="bench-user", avatar_id="prt_avatar", name="小白",
+                                       description="喜欢慢节奏旅行，爱拍照，说话简短直接，预算中等", avatar_url="")
+    ctx.travel_partner = TravelPartner(user_id="bench-user", partner_id="prt_partner", partner_name="阿青",
+                                       partner_description="做事有计划，爱吃美食，喜欢提前订好餐厅", partner_avatar_url="")
+    ctx.travel_settings = TravelSettings(user_id="bench-user", settings_id="prt_settings", destination="成都",
+                                         days=3, preference="美食、街巷漫步、看熊猫")
+    ctx.current_topic = "首日路线与到达时间"
+    ctx.topic_history = {"成都": ["首日路线与到达时间", "火锅店选择", "熊猫基地预约"]}
+    for i in range(history):
+        speaker = ("prt_avatar", "avatar") if i % 2 == 0 else ("prt_partner", "partner")
+        ctx.history.append(HistoryItem(speaker_id=speaker[0], speaker_type=speaker[1], message_id=f"msg_{i}",
+                                       message_content=f"第{i}条：我们下午先去宽窄巷子，然后晚上吃火锅怎么样？"))
+    return ctx
+
+
+# ----- RoundRobinSet -----
+@benchmark("roundrobin.add_remove")
+def _rr_add_remove():
+    rr = RoundRobinSet()
+    conns = [object() for _ in range(100)]
+
+    def run():
+        for i, ws in enumerate(conns):
+            rr.add(i, ws)
+        for i, ws in enumerate(conns):
+            rr.remove(i, ws)
+    return run, 200
+
+
+@benchmark("roundrobin.next_1k_users")
+def _rr_next():
+    rr = RoundRobinSet()
+    for i in range(1000):
+        rr.add(i, object())
+
+    def run():
+        for _ in range(100):
+            rr.next(timeout=0)
+    return run, 100
+
+
+@benchmark("roundrobin.contention_8_threads")
+def _rr_contention():
+    threads, ops_per_thread = 8, 500
+    rr = RoundRobinSet()
+    for i in range(200):
+        rr.add(f"base-{i}", object())
+
+    def worker(t: int) -> None:
+        for i in range(ops_per_thread // 3):
+            ws = object()
+            rr.add((t, i), ws)
+            rr.next(timeout=0)
+            rr.remove((t, i), ws)
+
+    def run():
+        pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+        for th in pool:
+            th.start()
+        for th in pool:
+            th.join()
+    return run, threads * (ops_per_thread // 3) * 3
+
+
+# ----- 提示词渲染 -----
+@benchmark("prompt.thought")
+def _prompt_thought():
+    thought = Thought(sample_context())
+    return thought.my_prompt, 1
+
+
+@benchmark("prompt.avatar")
+def _prompt_avatar():
+    ctx, speaker = sample_context(), AvatarSpeaker()
+    result, _ = ThoughtResult.try_from_dict(THOUGHT_JSON)
+    return (lambda: speaker.my_prompt(ctx, result)), 1
+
+
+@benchmark("prompt.partner")
+def _prompt_partner():
+    ctx, speaker = sample_context(), PartnerSpeaker()
+    result, _ = ThoughtResult.try_from_dict(THOUGHT_JSON)
+    return (lambda: speaker.my_prompt(ctx, result)), 1
+
+
+# ----- ThoughtResult -----
+@benchmark("thought_result.parse_valid")
+def _parse_valid():
+    return (lambda: ThoughtResult.try_from_dict(THOUGHT_JSON)), 1
+
+
+@benchmark("thought_result.parse_invalid")
+def _parse_invalid():
+    bad = json.dumps({"turn_action": "SPEAK_TRAVEL_PARTNER", "guidance_list": [], "topic_action": "CONTINUE_TOPIC"})
+    return (lambda: ThoughtResult.try_from_dict(bad)), 1
+
+
+# ----- id_gen -----
+@benchmark("id_gen.message_id")
+def _id_message():
+    return id_gen.new_message_id, 1
+
+
+@benchmark("id_gen.message_id_block")
+def _id_message_block():
+    ids = id_gen.OrderedIdGenerator(block_size=256)
+    return ids.next, 1
+
+
+@benchmark("id_gen.name_id")
+def _id_name():
+    return (lambda: id_gen.new_name_id("小白", "prod")), 1
+
+
+# ----- DialogueContext.update -----
+@benchmark("context.update")
+def _context_update():
+    ctx = sample_context()
+    result, _ = ThoughtResult.try_from_dict(THOUGHT_JSON)
+    speak = {"speaker_id": "prt_partner", "speaker_type": "partner", "message_id": "msg_bench", "text": "好呀，几点出发？"}
+
+    def run():
+        for _ in range(100):
+            ctx.update(result, speak)
+        del ctx.history[10:]  # 保持历史长度稳定，避免越跑越慢
+    return run, 100
+
+
+# ----- 日志 -----
+def _bench_logger(name: str, handler: logging.Handler) -> logging.Logger:
+    bench_logger = logging.getLogger(f"bench.{name}")
+    bench_logger.handlers[:] = [handler]
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.INFO)
+    return bench_logger
+
+
+@benchmark("logging.sync_stream_record")
+def _log_sync():
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    bench_logger = _bench_logger("sync", handler)
+    return (lambda: bench_logger.info(f"[AI_SERVICE] 请求参数: route={'speak'}, temperature={0.8}, max_tokens={800}")), 1
+
+
+@benchmark("logging.async_json_record")
+def _log_async():
+    handler = AsyncLogHandler(open(os.devnull, "w"), max_queue=1 << 30)
+    handler.setFormatter(JsonFormatter())
+    bench_logger = _bench_logger("async", handler)
+
+    # 写线程与调用方争用 GIL，耗时里已包含后台格式化的开销；只有 stream 写入阻塞离开了调用方
+    return (lambda: bench_logger.info("[AI_SERVICE] 请求参数: route=%s, temperature=%s, max_tokens=%s",
+                                      "speak", 0.8, 800)), 1
+
+
+@benchmark("logging.filtered_debug")
+def _log_filtered():
+    bench_logger = _bench_logger("filtered", logging.NullHandler())
+    return (lambda: bench_logger.debug("[AI_SERVICE] 内容预览: %s...", "好呀，几点出发？")), 1
+
+
+# ----- 运行与对比 -----
+def measure(fn: Callable[[], Any], ops: int, repeat: int, min_time: float) -> Dict[str, Any]:
+    """先自动校准循环次数使单轮耗时 >= min_time，再重复 repeat 轮，报告每次操作的耗时"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1 << 20:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    per_op = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        per_op.append((time.perf_counter() - start) / (loops * ops))
+    median = statistics.median(per_op)
+    return {
+        "ns_per_op": round(median * 1e9, 1),
+        "ns_per_op_min": round(min(per_op) * 1e9, 1),
+        "ns_per_op_stdev": round(statistics.pstdev(per_op) * 1e9, 1),
+        "ops_per_sec": round(1.0 / median, 1) if median > 0 else None,
+        "loops": loops,
+        "ops_per_loop": ops,
+        "repeat": repeat,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names: List[str], repeat: int, min_time: float) -> Dict[str, Any]:
+    results = {}
+    for name in names:
+        fn, ops = BENCHMARKS[name]()
+        results[name] = measure(fn, ops, repeat, min_time)
+        r = results[name]
+        print(f"{name:<34} {r['ns_per_op']:>12,.1f} ns/op  (min {r['ns_per_op_min']:,.1f}, ±{r['ns_per_op_stdev']:,.1f})",
+              flush=True)
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """打印与基线的差异，返回变慢超过 threshold（比例）的用例名"""
+    regressions = []
+    print(f"\ncompare {baseline.get('revision')} -> {current.get('revision')} (threshold {threshold:.0%})")
+    for name, cur in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            print(f"{name:<34} new")
+            continue
+        change = cur["ns_per_op"] / base["ns_per_op"] - 1.0 if base["ns_per_op"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:<34} {base['ns_per_op']:>12,.1f} -> {cur['ns_per_op']:>12,.1f} ns/op  {change:+7.1%}{flag}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the agent hot paths")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measured round")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline JSON to compare against; exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown counted as regression")
+    parser.add_argument("--list", action="store_true")
+    args = parser.parse_args(argv)
+
+    names = [n for n in BENCHMARKS if args.filter in n]
+    if args.list:
+        print("\n".join(names))
+        return
+    report = run(names, args.repeat, args.min_time)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
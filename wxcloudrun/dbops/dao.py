@@ -1,11 +1,14 @@
 import logging
+import os
 import time
+from datetime import datetime, timezone
 from functools import wraps
 
 from sqlalchemy.exc import OperationalError, DisconnectionError
 
 from wxcloudrun import db
 from wxcloudrun.dbops.model import Users, DigitalAvatar, TravelPartner, TravelSettings, ChatMessages, ChatTopics
+from wxcloudrun.dbops.session_cache import session_cache
 
 # 初始化日志
 logger = logging.getLogger(__name__)
@@ -71,26 +74,70 @@ def retry_db_operation(max_retries=5, delay=2):
 
 
 # 用户相关DAO函数
+# Users 表每行是一个会话（行程）；登录 / 保存资料时复用最近活跃的会话，显式开启新行程时才新建
+SESSION_TTL_SECONDS = float(os.environ.get("SESSION_TTL_HOURS", "24")) * 3600
+
+
+def _as_utc(value):
+    """TIMESTAMP 读出为 naive datetime（按 UTC 写入），统一成带时区的 UTC 时间"""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def _active_session(user_id):
+    """
+    用户最近的会话，若其最后活跃时间（最后一条消息，无消息时为创建时间）在 SESSION_TTL_SECONDS 内则返回，否则 None
+    """
+    user = Users.query.filter(Users.user_id == user_id).order_by(Users.created_at.desc()).first()
+    if user is None:
+        return None
+    last_message_at = db.session.query(db.func.max(ChatMessages.created_at)).filter(
+        ChatMessages.user_id == user_id,
+        ChatMessages.session_id == user.session_id
+    ).scalar()
+    last_active = max(_as_utc(t) for t in (user.created_at, last_message_at) if t is not None)
+    if (datetime.now(timezone.utc) - last_active).total_seconds() > SESSION_TTL_SECONDS:
+        return None
+    return user
+
+
 @retry_db_operation(max_retries=3, delay=1)
-def insert_user(user_id):
+def insert_user(user_id, new_session=False):
     """
-    插入用户实体，自动生成session_id
+    获取或创建用户会话：默认复用最近活跃的会话（见 _active_session），否则新建一行并生成 session_id
     :param user_id: 用户ID
-    :return: 创建的用户实体
+    :param new_session: True 时无条件开启新会话（新行程）
+    :return: 当前会话的用户实体
     """
     try:
+        if not new_session:
+            user = _active_session(user_id)
+            if user is not None:
+                session_cache.put(user_id, user.session_id)
+                return user
+
         from ..idgeneration import id_gen
         session_id = id_gen.new_session_id()
         user = Users(user_id=user_id, session_id=session_id)
         
         db.session.add(user)
         db.session.commit()
+        session_cache.put(user_id, session_id)
+        logger.info(f"新会话: user={user_id}, session_id={session_id}, explicit={new_session}")
         return user
     except Exception as e:
         db.session.rollback()
         raise e
 
 
+def start_new_session(user_id):
+    """
+    显式开启新行程：新建会话，之后的对话与话题都记在新 session_id 下
+    :param user_id: 用户ID
+    :return: 新会话的用户实体
+    """
+    return insert_user(user_id, new_session=True)
+
+
 @retry_db_operation(max_retries=3, delay=1)
 def get_user_by_user_id(user_id):
     """
@@ -110,13 +157,22 @@ def get_user_by_user_id_and_session_id(user_id, session_id):
     """
     return Users.query.filter(Users.user_id == user_id, Users.session_id == session_id).first()
 
-@retry_db_operation(max_retries=3, delay=1)
 def get_user_session_id(user_id):
     """
-    从 Users 表获取用户的最新 session_id
+    获取用户当前的 session_id：优先读进程内缓存，未命中时查 Users 表最新记录并写入缓存
     :param user_id: 用户ID
     :return: session_id 字符串，如果用户不存在返回 None
     """
+    session_id = session_cache.get(user_id)
+    if session_id is not None:
+        return session_id
+    session_id = _load_user_session_id(user_id)
+    if session_id:
+        session_cache.put(user_id, session_id)
+    return session_id
+
+@retry_db_operation(max_retries=3, delay=1)
+def _load_user_session_id(user_id):
     user = Users.query.filter(Users.user_id == user_id).order_by(Users.created_at.desc()).first()
     return user.session_id if user else None
 
@@ -0,0 +1,61 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class SessionCache:
+    """
+    线程安全：每个用户当前 session_id 的进程内缓存（LRU + TTL），get_user_session_id 热路径直接命中内存。
+    本进程开启 / 复用会话时立即更新；其他 worker / 实例开启新会话后，本进程最多在 ttl_seconds 后看到。
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # {user_id: (session_id, cached_at)}
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, user_id: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is not None and now - item[1] < self.ttl_seconds:
+                self._entries.move_to_end(user_id)
+                self._hits += 1
+                return item[0]
+            if item is not None:
+                del self._entries[user_id]
+            self._misses += 1
+            return None
+
+    def put(self, user_id: str, session_id: str) -> None:
+        with self._lock:
+            self._entries[user_id] = (session_id, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 4) if total else None,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+
+session_cache = SessionCache(
+    max_entries=int(os.environ.get("SESSION_CACHE_MAX", "10000")),
+    ttl_seconds=float(os.environ.get("SESSION_CACHE_TTL", "60")),
+)
@@ -1,26 +1,127 @@
-import uuid, base64, hashlib
+"""
+ID 生成：会话 / 消息 ID 为按时间排序的定长 ID（前缀 + 26 位 Crockford base32，与 ULID 同长度）。
+
+    ses_01JAB3KZ7M  XK4P2R  000000001F
+        时间 10 位   进程 6 位  计数 10 位
+
+- 时间：毫秒时间戳（50 位），ID 按字典序即按生成时间排序，message_id / session_id 索引的插入
+  集中在 B-tree 最右侧的页，不再像 uuid4 那样随机分裂页、把整棵索引拖进缓冲池。
+- 进程：每个进程（fork 后重新生成）30 位随机标识，多 worker / 多实例之间不冲突。
+- 计数：进程内单调递增（50 位），同一毫秒内、以及时钟回拨时仍严格递增。
+- 块模式：ID_BLOCK_SIZE>0 时一次加锁预分配一块 ID，之后无锁弹出（块空时在锁内补充）；块内 ID 的时间为分配时刻。
+"""
+import base64
+import hashlib
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"   # Crockford base32，ASCII 升序，字典序 = 数值序
+_DECODE = {c: i for i, c in enumerate(_ALPHABET)}
+_PAIRS = [a + b for a in _ALPHABET for b in _ALPHABET]   # 10 位 → 2 字符，热路径查表
+ID_LENGTH = 26
+
+
+def _b32(value: int, width: int) -> str:
+    return "".join(_ALPHABET[(value >> shift) & 31] for shift in range(5 * (width - 1), -1, -5))
+
+
+def _b32_10(value: int) -> str:
+    """50 位整数 → 10 字符"""
+    p = _PAIRS
+    return p[value >> 40 & 1023] + p[value >> 30 & 1023] + p[value >> 20 & 1023] + p[value >> 10 & 1023] + p[value & 1023]
+
+
+class OrderedIdGenerator:
+    """线程安全的时间有序 ID 生成器（不含前缀）"""
+
+    def __init__(self, block_size: int = 0):
+        self.block_size = block_size
+        self._block: Deque[str] = deque()
+        self._reseed()
+
+    def _reseed(self) -> None:
+        """新进程标识、计数清零；fork 后在子进程里调用，避免父子进程生成相同 ID"""
+        self._lock = threading.Lock()
+        self._node = _b32(secrets.randbits(30), 6)
+        self._counter = 0
+        self._last_ms = 0
+        self._time_part = _b32_10(0)
+        self._block.clear()
+
+    def _reserve(self, n: int) -> Tuple[str, int]:
+        """预留 n 个计数（调用方持有 self._lock），返回 (时间 + 进程前缀, 起始计数)"""
+        now_ms = time.time_ns() // 1_000_000
+        if now_ms > self._last_ms:   # 时钟回拨时沿用上次的时间，保持单调
+            self._last_ms = now_ms
+            self._time_part = _b32_10(now_ms)
+        start = self._counter
+        self._counter += n
+        return self._time_part + self._node, start
+
+    def _take(self, n: int) -> List[str]:
+        with self._lock:
+            head, start = self._reserve(n)
+        return [head + _b32_10(c) for c in range(start + 1, start + n + 1)]
+
+    def next(self) -> str:
+        if self.block_size > 0:
+            try:
+                return self._block.popleft()
+            except IndexError:
+                pass
+            # 补充与弹出都在锁内：并发发现块已空时只补充一块，发出的 ID 保持递增
+            with self._lock:
+                if not self._block:
+                    head, start = self._reserve(self.block_size)
+                    self._block.extend(head + _b32_10(c) for c in range(start + 1, start + self.block_size + 1))
+                return self._block.popleft()
+        return self._take(1)[0]
+
+    def many(self, n: int) -> List[str]:
+        """一次加锁生成 n 个连续 ID（批量写入用）"""
+        return self._take(n) if n > 0 else []
+
+
+_ids = OrderedIdGenerator(block_size=int(os.environ.get("ID_BLOCK_SIZE", "0")))
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_ids._reseed)
+
+
+def id_timestamp(value: str) -> Optional[float]:
+    """从时间有序 ID（可带前缀）解析生成时间（秒）；旧的随机 ID 返回 None"""
+    body = value.rsplit("_", 1)[-1]
+    if len(body) != ID_LENGTH:
+        return None
+    try:
+        ms = 0
+        for c in body[:10]:
+            ms = ms * 32 + _DECODE[c]
+    except KeyError:
+        return None
+    return ms / 1000.0
 
-def _short_id() -> str:
-    """uuid4 → 22字符的urlsafe短ID（去掉'='）"""
-    return base64.urlsafe_b64encode(uuid.uuid4().bytes).decode().rstrip('=')
 
 def new_session_id() -> str:
-    return f"ses_{_short_id()}"            # 形如: ses_VfWlY7ZlQy2TqU6cM0m8rQ
+    return f"ses_{_ids.next()}"            # 形如: ses_01JAB3KZ7MXK4P2R000000001F
 
 def new_message_id() -> str:
-    return f"msg_{_short_id()}"            # 形如: msg_Ys7x1b6ZQK25b1V7v1bI8A
+    return f"msg_{_ids.next()}"            # 形如: msg_01JAB3KZ7NXK4P2R000000001G
 
 def new_name_id(name: str, salt: str = "") -> str:
     """
     name提供→生成“稳定ID”（同name+salt恒定）；
-    name不提供→随机ID。
+    name不提供→时间有序ID。
     """
     if name:
         # 8字节哈希→urlsafe base64 → 11~12字符
         h = hashlib.blake2s(f"{name}#{salt}".encode(), digest_size=8).digest()
         sid = base64.urlsafe_b64encode(h).decode().rstrip('=')
         return f"prt_{sid}"                 # 形如: prt_X3Pz1y8Kc2Y
-    return f"prt_{_short_id()}"            # 随机: prt_...
+    return f"prt_{_ids.next()}"            # 时间有序: prt_...
 
 # 示例
 if __name__ == "__main__":
@@ -1,27 +1,110 @@
-import requests
 import logging
+import gevent
+import hashlib
+import json
+import threading
+import time
 from datetime import datetime
-from typing import List, Dict
+from typing import TYPE_CHECKING, Any, List, Dict, Optional, Tuple
+
+from ..agent.step_context import StepContext, StepCancelled, StepDeadlineExceeded
+from .singleflight import SingleFlight, WaitAborted
+from .response_cache import cache_key, get_response_cache
+from .rate_governor import GovernorWaitAborted, estimate_tokens, parse_retry_after
+from .resilience import EndpointHealth
+from .router import LLMEndpoint, LLMRouter, endpoints_from_env
+from ..observability.tracing import span, trace_of
+from .errors import (LLMServiceError, LLMTimeoutError, LLMUpstreamError, LLMCircuitOpenError,
+                     LLMRateLimitedError)
+
+if TYPE_CHECKING:
+    import requests
 
 # 初始化日志
 logger = logging.getLogger(__name__)
 
+# 进程内共享：合并相同的进行中请求（各调用点各自 new 出来的 service 实例共用）
+_inflight = SingleFlight()
+
+
+def request_key(payload: Dict) -> str:
+    """按 (model, messages, temperature, max_tokens) 计算请求指纹"""
+    raw = json.dumps(
+        [payload["model"], payload["messages"], payload["temperature"], payload["max_tokens"]],
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# 进程内共享：端点路由（每个端点各自的健康状态、限流器与延迟 EWMA），首次使用时按环境变量构建
+_router: Optional[LLMRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> LLMRouter:
+    global _router
+    if _router is None:
+        # 构建过程可能让出（LLM_MOCK 会启动本地服务），加锁避免调度器与请求并发首次使用时重复构建
+        with _router_lock:
+            if _router is None:
+                _router = LLMRouter(endpoints_from_env(max_timeout=DeepSeekV3Service.DEFAULT_TIMEOUT))
+    return _router
+
+
+def set_router(router: Optional[LLMRouter]) -> None:
+    """替换进程内路由（None 表示下次使用时按环境变量重建）"""
+    global _router
+    _router = router
+
+
+def endpoint_health_stats() -> Dict[str, Dict]:
+    """各端点的延迟 EWMA / 分位数、超时、对冲、熔断与限流统计"""
+    return get_router().stats()
+
+
+def rate_governor_stats() -> Dict[str, Dict]:
+    """各端点的限流排队与 429 统计"""
+    return {ep.name: ep.governor.stats() for ep in get_router().endpoints}
+
+
+def rate_limit_delay() -> float:
+    """调度器发起新 step 前建议等待的秒数；只有全部端点都在限流时才大于 0"""
+    return get_router().suggested_delay()
+
+
+def inflight_stats() -> Dict[str, int]:
+    """请求合并统计：calls / upstream / coalesced / inflight"""
+    return _inflight.stats()
+
+
+def response_cache_stats() -> Optional[Dict]:
+    """响应缓存命中统计；未开启缓存时返回 None"""
+    cache = get_response_cache()
+    return cache.stats() if cache is not None else None
+
 
 class DeepSeekV3Service:
-    """DeepSeek V3 API服务类"""
+    """DeepSeek V3 API服务类；route 指定调用点（如 "thought" / "speak"），由路由在多个 OpenAI 兼容端点间选择"""
+
+    DEFAULT_TIMEOUT = 300
+    MAX_SHARED_RETRIES = 2   # 共享的请求被其发起方取消时，自己重新发起的次数上限
+    MAX_RATE_LIMIT_RETRIES = 2   # 收到 429 后按 Retry-After 等待并重发的次数上限
+    MAX_QUOTA_WAIT = 60.0        # 无 step 截止时间时，排队等待限流配额的最长秒数
     
-    def __init__(self):
-        self.api_key = "sk-9109dab67ad949048268d64c72486bb7"
-        self.base_url = "https://api.deepseek.com"
-        self.model = "deepseek-chat"
-        
-        if not self.api_key:
-            raise ValueError("DEEPSEEK_API_KEY environment variable is required")
+    def __init__(self, route: str = "default"):
+        self.route = route
+        self.router = get_router()
+        for endpoint in self.router.endpoints:
+            if not endpoint.api_key:
+                raise ValueError(f"API key is required for LLM endpoint {endpoint.name} "
+                                 f"(DEEPSEEK_API_KEY, or api_key / api_key_env in LLM_ENDPOINTS)")
     
     def chat_completion(self, 
                         messages: List[Dict[str, str]], 
                         temperature: float = 0.7,
-                        max_tokens: int = 1000) -> Dict:
+                        max_tokens: int = 1000,
+                        step_ctx: Optional[StepContext] = None,
+                        cacheable: bool = False) -> Dict:
         """
         调用DeepSeek V3聊天完成API
         
@@ -29,62 +112,267 @@ class DeepSeekV3Service:
             messages: 消息列表，格式为 [{"role": "user", "content": "消息内容"}]
             temperature: 温度参数，控制随机性
             max_tokens: 最大token数
-            stream: 是否流式响应
+            step_ctx: 所属 step 的上下文；超时取其剩余时间，取消时中断进行中的 HTTP 请求
+            cacheable: 调用点声明结果可复用（相同提示词可直接返回缓存），需同时开启 LLM_CACHE_ENABLED
             
         Returns:
             API响应字典
+
+        Raises:
+            StepCancelled: step 已取消或超出截止时间
+            LLMServiceError: 上游失败；transient=True 的（超时、5xx、429、熔断）可稍后重试
         """
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
+        # model 先填调用点名，用于请求合并的 key；发送时替换为所选端点的真实模型（响应缓存按真实模型计算 key）
         payload = {
-            "model": self.model,
+            "model": self.route,
             "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens,
             "stream": False
         }
-        
+
+        # 整个调用（含缓存命中、合并等待、故障转移）计入 step 的 <route>_llm 阶段
+        with span(trace_of(step_ctx), f"{self.route}_llm"):
+            return self._complete(payload, step_ctx, cacheable)
+
+    def _complete(self, payload: Dict, step_ctx: Optional[StepContext], cacheable: bool) -> Dict:
+        """查响应缓存 → 合并相同的进行中请求 → 发往上游"""
+        # 可缓存的调用先查响应缓存
+        cache = get_response_cache() if (cacheable or (step_ctx is not None and step_ctx.llm_cache)) else None
+        if cache is not None:
+            # 缓存 key 用当前首选端点的真实模型而非调用点名：路由调整或故障转移到备用模型后，
+            # 不把另一个模型的回答当作本调用点常用模型的返回
+            ckey = cache_key(dict(payload, model=self.router.select(self.route, explore=False).model))
+            cached = cache.get(ckey)
+            if cached is not None:
+                logger.info("[AI_SERVICE] 命中响应缓存: key=%s", ckey[:12])
+                return cached
+
+        # 相同 (model, messages, temperature, max_tokens) 的并发请求只发一次上游，结果共享
+        key = request_key(payload)
+        token = step_ctx.token if step_ctx is not None else None
+        for attempt in range(self.MAX_SHARED_RETRIES + 1):
+            try:
+                (result, model), shared = _inflight.do(
+                    key,
+                    lambda: self._request(payload, step_ctx),
+                    token=token,
+                    timeout=step_ctx.remaining() if step_ctx is not None else None,
+                )
+                if shared:
+                    logger.info("[AI_SERVICE] 复用进行中的相同请求: key=%s", key[:12])
+                elif cache is not None:
+                    cache.put(cache_key(dict(payload, model=model)), result)   # 按实际应答的模型入缓存
+                return result
+            except WaitAborted:
+                step_ctx.check()  # 自己的 step 被取消/超时
+                raise StepDeadlineExceeded("wait for shared LLM request aborted")
+            except StepCancelled:
+                # 若是共享请求的发起方被取消，而本调用方仍有效，则自己重新发起
+                if step_ctx is not None:
+                    step_ctx.check()
+                if attempt == self.MAX_SHARED_RETRIES:
+                    raise
+                logger.info("[AI_SERVICE] 共享请求被其发起方取消，重新发起: key=%s", key[:12])
+
+    def _request(self, payload: Dict, step_ctx: Optional[StepContext]) -> Tuple[Dict, str]:
+        """
+        按路由顺序尝试候选端点，返回 (响应, 实际应答的模型)：可重试的失败（超时、5xx、429、熔断）自动切换到下一个端点，
+        不可重试的失败（4xx）或全部端点失败时抛出最后一个错误
+        """
+        candidates = self.router.candidates(self.route)
+        for i, endpoint in enumerate(candidates):
+            try:
+                return self._request_endpoint(endpoint, payload, step_ctx), endpoint.model
+            except LLMServiceError as e:
+                if not e.transient or i == len(candidates) - 1:
+                    raise
+                if step_ctx is not None:
+                    step_ctx.check()
+                logger.warning(f"[AI_SERVICE] 端点 {endpoint.name} 失败，切换到 {candidates[i + 1].name}: {str(e)}")
+
+    def _request_endpoint(self, endpoint: LLMEndpoint, payload: Dict, step_ctx: Optional[StepContext]) -> Dict:
+        """向一个端点发起请求并解析 JSON；失败统一抛 LLMServiceError 子类（取消除外）"""
+        import requests  # 延迟导入：冷启动时由后台预热加载（warmup.llm_warm），不占用导入时间
+
+        payload = dict(payload, model=endpoint.model)
         try:
-            logger.info(f"[AI_SERVICE] 开始调用DeepSeek API")
-            logger.info(f"[AI_SERVICE] 请求参数: model={self.model}, temperature={temperature}, max_tokens={max_tokens}")
-            logger.info(f"[AI_SERVICE] 消息数量: {len(messages)}")
-            logger.info(f"[AI_SERVICE] 请求URL: {self.base_url}/chat/completions")
-            
-            start_time = datetime.now()
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=300
-            )
-            end_time = datetime.now()
-            duration = (end_time - start_time).total_seconds()
+            # 热路径：参数合并为一行，按 % 延迟格式化（被过滤 / 采样掉的记录不产生格式化开销）
+            logger.debug("[AI_SERVICE] 开始调用DeepSeek API: route=%s, endpoint=%s, model=%s, temperature=%s, "
+                         "max_tokens=%s, 消息数量=%d, url=%s", self.route, endpoint.name, endpoint.model,
+                         payload['temperature'], payload['max_tokens'], len(payload['messages']), endpoint.url)
             
-            logger.info(f"[AI_SERVICE] API调用完成，耗时: {duration:.2f}秒")
-            logger.info(f"[AI_SERVICE] 响应状态码: {response.status_code}")
-            
-            response.raise_for_status()
+            response = self._send_within_quota(endpoint, payload, step_ctx)
             result = response.json()
+            usage = result.get("usage") or {}
+            endpoint.governor.settle(estimate_tokens(payload), usage.get("total_tokens"))
             
-            logger.info(f"[AI_SERVICE] 响应内容长度: {len(str(result))}")
-            if 'choices' in result and len(result['choices']) > 0:
+            if logger.isEnabledFor(logging.DEBUG) and result.get('choices'):
                 content_length = len(result['choices'][0].get('message', {}).get('content', ''))
-                logger.info(f"[AI_SERVICE] 生成内容长度: {content_length}字符")
+                logger.debug("[AI_SERVICE] 生成内容长度: %d字符, usage=%s", content_length, usage)
             
             return result
+        except StepCancelled as e:
+            logger.info("[AI_SERVICE] API调用已取消: %s", e)
+            raise
+        except LLMServiceError as e:
+            logger.error(f"[AI_SERVICE] API调用失败: {str(e)}")
+            raise
         except requests.exceptions.Timeout as e:
             logger.error(f"[AI_SERVICE] API调用超时: {str(e)}")
-            raise Exception(f"DeepSeek API调用超时: {str(e)}")
+            raise LLMTimeoutError(f"DeepSeek API调用超时: {str(e)}")
+        except ValueError as e:
+            # 200 但响应体不是合法 JSON（截断等），视为上游临时故障
+            logger.error(f"[AI_SERVICE] 响应解析失败: {str(e)}")
+            raise LLMUpstreamError(f"DeepSeek API返回无法解析的响应: {str(e)}")
         except requests.exceptions.RequestException as e:
             logger.error(f"[AI_SERVICE] API调用失败: {str(e)}")
-            raise Exception(f"DeepSeek API调用失败: {str(e)}")
+            raise LLMUpstreamError(f"DeepSeek API调用失败: {str(e)}")
         except Exception as e:
             logger.error(f"[AI_SERVICE] 未知错误: {str(e)}")
-            raise Exception(f"DeepSeek API调用异常: {str(e)}")
+            raise LLMServiceError(f"DeepSeek API调用异常: {str(e)}")
     
+    def _send_within_quota(self, endpoint: LLMEndpoint, payload: Dict, step_ctx: Optional[StepContext]) -> "requests.Response":
+        """
+        在限流配额内发送：先按 RPM / TPM 排队取得配额再发请求；
+        收到 429 时按 Retry-After 暂停本端点的所有放行，截止时间允许则重发，否则抛 LLMRateLimitedError
+        """
+        governor = endpoint.governor
+        est_tokens = estimate_tokens(payload)
+        for attempt in range(self.MAX_RATE_LIMIT_RETRIES + 1):
+            try:
+                governor.acquire(
+                    est_tokens,
+                    token=step_ctx.token if step_ctx is not None else None,
+                    timeout=step_ctx.remaining() if step_ctx is not None else self.MAX_QUOTA_WAIT,
+                )
+            except GovernorWaitAborted as e:
+                if step_ctx is not None:
+                    step_ctx.check()
+                raise LLMRateLimitedError(f"DeepSeek API限流排队超时: {e}", retry_after=governor.suggested_delay())
+
+            start_time = datetime.now()
+            response = self._post(endpoint, payload, step_ctx)
+            duration = (datetime.now() - start_time).total_seconds()
+            if step_ctx is not None:
+                step_ctx.on_llm_call_end(duration)
+
+            logger.info("[AI_SERVICE] API调用完成: route=%s, endpoint=%s, 状态码=%d, 耗时=%.2f秒",
+                        self.route, endpoint.name, response.status_code, duration)
+
+            if response.status_code == 429:
+                pause = governor.on_rate_limited(parse_retry_after(response.headers.get("Retry-After")))
+                can_wait = step_ctx is None or step_ctx.remaining() > pause
+                if attempt < self.MAX_RATE_LIMIT_RETRIES and can_wait:
+                    logger.warning(f"[AI_SERVICE] DeepSeek API限流(429)，{pause:.1f}秒后重试")
+                    continue
+                raise LLMRateLimitedError("DeepSeek API限流(429)", retry_after=pause)
+            if response.status_code >= 400:
+                raise LLMUpstreamError(
+                    f"DeepSeek API返回错误状态码: {response.status_code}",
+                    status=response.status_code,
+                )
+            return response
+
+    def _post(self, endpoint: LLMEndpoint, payload: Dict, step_ctx: Optional[StepContext]) -> "requests.Response":
+        """
+        发送请求（带熔断、自适应超时与对冲）：
+        - 熔断器打开时直接抛 LLMCircuitOpenError；429 属于配额问题，不计入熔断失败
+        - 超时取端点的自适应超时，并受 step 截止时间约束
+        - 请求在独立协程中发起；超过 p95 仍未返回时再发一份对冲请求，先返回者胜出，其余被 kill
+        - 取消令牌触发时 kill 所有进行中的请求协程，中断阻塞中的 socket 读写并释放连接
+        """
+        import requests
+
+        health = endpoint.health
+        timeout = health.timeout()
+        if step_ctx is not None:
+            timeout = step_ctx.timeout_for(timeout)
+        if not health.breaker.allow():
+            raise LLMCircuitOpenError(
+                f"DeepSeek API熔断中: {endpoint.name}", retry_after=health.breaker.retry_after()
+            )
+
+        url = endpoint.url
+        headers = {
+            "Authorization": f"Bearer {endpoint.api_key}",
+            "Content-Type": "application/json"
+        }
+        if step_ctx is not None:
+            step_ctx.on_llm_call_start()
+        health.on_call()
+
+        started: Dict[Any, float] = {}
+
+        def _attempt() -> "requests.Response":
+            return requests.post(url, headers=headers, json=payload, timeout=timeout)
+
+        def _spawn() -> gevent.Greenlet:
+            g = gevent.spawn(_attempt)
+            started[g] = time.monotonic()
+            return g
+
+        attempts = [_spawn()]
+        unregister = (step_ctx.token.add_callback(lambda: gevent.killall(attempts, block=False))
+                      if step_ctx is not None else (lambda: None))
+        settled = False
+        try:
+            winner = self._first_answer(health, attempts, _spawn, timeout, step_ctx)
+            elapsed = time.monotonic() - started[winner]
+            response = winner.value
+            if winner is not attempts[0]:
+                health.on_hedge_win()
+            if response.status_code >= 500:
+                health.breaker.record_failure()
+            else:
+                if response.status_code != 429:  # 429 的快速拒绝不代表真实生成延迟
+                    health.latency.observe(elapsed)
+                    endpoint.observe_latency(elapsed)
+                health.breaker.record_success()
+            settled = True
+            return response
+        except StepCancelled:
+            raise
+        except Exception:
+            health.breaker.record_failure()
+            settled = True
+            raise
+        finally:
+            unregister()
+            gevent.killall([g for g in attempts if not g.ready()], block=False)
+            if not settled:
+                health.breaker.record_release()
+
+    def _first_answer(self, health: EndpointHealth, attempts: List[gevent.Greenlet], spawn, timeout: float,
+                      step_ctx: Optional[StepContext]) -> gevent.Greenlet:
+        """等待第一个可用的应答（状态码 < 500）；全部失败时返回 5xx 应答或抛出首个异常"""
+        deadline = time.monotonic() + timeout
+        hedge_after = health.hedge_delay()
+        if hedge_after is not None and hedge_after < timeout:
+            gevent.wait(attempts, timeout=hedge_after, count=1)
+            if not attempts[0].ready() and health.try_hedge():
+                logger.info("[AI_SERVICE] 请求超过 p95=%.2f秒未返回，发起对冲请求", hedge_after)
+                attempts.append(spawn())
+        while True:
+            if step_ctx is not None:
+                step_ctx.check()
+            for g in attempts:
+                if g.ready() and g.successful() and g.value.status_code < 500:
+                    return g
+            pending = [g for g in attempts if not g.ready()]
+            if not pending:
+                for g in attempts:
+                    if g.successful():
+                        return g
+                attempts[0].get()  # 全部异常：抛出首个异常
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if step_ctx is not None:
+                    step_ctx.check()
+                health.on_timeout()
+                raise LLMTimeoutError(f"DeepSeek API调用超时（{timeout:.1f}秒）")
+            gevent.wait(pending, timeout=remaining, count=1)
+
     def extract_response_text(self, api_response: Dict) -> str:
         """
         从API响应中提取文本内容
@@ -96,10 +384,9 @@ class DeepSeekV3Service:
             响应文本
         """
         try:
-            logger.info(f"[AI_SERVICE] 开始解析API响应")
             content = api_response['choices'][0]['message']['content']
-            logger.info(f"[AI_SERVICE] 解析成功，内容长度: {len(content)}字符")
-            logger.info(f"[AI_SERVICE] 内容预览: {content[:100]}...")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[AI_SERVICE] 解析成功，内容长度: %d字符, 预览: %s...", len(content), content[:100])
             return content
         except (KeyError, IndexError) as e:
             logger.error(f"[AI_SERVICE] 解析API响应失败: {str(e)}")
@@ -0,0 +1,34 @@
+from typing import Optional
+
+
+class LLMServiceError(Exception):
+    """LLM 调用失败的基类；transient 表示可稍后重试（调度器不应因此移除用户）"""
+    transient = False
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMTimeoutError(LLMServiceError):
+    """上游在超时时间内没有返回"""
+    transient = True
+
+
+class LLMUpstreamError(LLMServiceError):
+    """上游返回错误状态码或连接失败；status 为 None 表示连接层错误"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message, retry_after)
+        self.status = status
+        self.transient = status is None or status >= 500
+
+
+class LLMRateLimitedError(LLMServiceError):
+    """上游返回 429 或本地限流排队超时；retry_after 为建议等待秒数"""
+    transient = True
+
+
+class LLMCircuitOpenError(LLMServiceError):
+    """熔断器打开，快速失败；retry_after 为距离下次半开探测的秒数"""
+    transient = True
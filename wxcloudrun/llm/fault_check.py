@@ -0,0 +1,132 @@
+"""
+用本地故障注入模拟服务验证 LLM 客户端的自适应超时、对冲请求、熔断恢复、429 限流退避与格式错误响应：
+
+    python -m wxcloudrun.llm.fault_check
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import random
+import time
+
+from .mock_server import MockLLMServer
+from .errors import LLMCircuitOpenError, LLMTimeoutError, LLMUpstreamError, LLMRateLimitedError
+
+
+def _call(svc, tag: str):
+    # 每次内容不同，避免被请求合并 / 响应缓存影响
+    return svc.chat_completion([{"role": "user", "content": f"fault-check {tag} {time.monotonic()}"}], max_tokens=16)
+
+
+def main() -> None:
+    server = MockLLMServer(latency=0.05, jitter=0.01).start()
+    os.environ["DEEPSEEK_BASE_URL"] = server.url
+    os.environ["DEEPSEEK_API_KEY"] = "sk-mock"
+    from .ai_service import DeepSeekV3Service
+
+    svc = DeepSeekV3Service()
+    endpoint = svc.router.endpoints[0]
+    health = endpoint.health
+    health.MIN_TIMEOUT = 0.5          # 放宽下限，便于快速验证
+    health.HEDGE_BUDGET = 0.5
+    health.breaker.reset_timeout = 1.0
+
+    # 1) 预热：积累延迟样本后超时从默认值收敛到 p99 × 3
+    for i in range(30):
+        _call(svc, f"warm-{i}")
+    print(f"[warm] p95={health.latency.percentile(95):.3f}s adaptive_timeout={health.timeout():.3f}s")
+    assert health.timeout() < svc.DEFAULT_TIMEOUT
+
+    # 2) 对冲：30% 请求挂起 3 秒，对冲后整体仍快速返回
+    server.configure(hang_rate=0.3, hang_seconds=3.0)
+    random.seed(7)
+    start = time.monotonic()
+    for i in range(30):
+        try:
+            _call(svc, f"hedge-{i}")
+        except LLMTimeoutError:
+            pass  # 原请求与对冲请求都挂起（约 9% 概率）时按自适应超时失败
+    elapsed = time.monotonic() - start
+    stats = health.stats()
+    print(f"[hedge] 30 calls in {elapsed:.2f}s hedged={stats['hedged']} hedge_wins={stats['hedge_wins']}")
+    assert stats["hedge_wins"] >= 1 and elapsed < 30 * 0.5 + 3.0
+
+    # 3) 超时：全部挂起，按自适应超时失败而不是等待 300 秒
+    server.configure(hang_rate=1.0, hang_seconds=5.0)
+    start = time.monotonic()
+    try:
+        _call(svc, "timeout")
+        raise AssertionError("expected timeout")
+    except LLMTimeoutError:
+        pass
+    print(f"[timeout] failed after {time.monotonic() - start:.2f}s")
+    assert time.monotonic() - start < 3.0
+
+    # 4) 熔断：持续 5xx 后打开，之后快速失败
+    server.configure(hang_rate=0.0, error_rate=1.0)
+    for i in range(health.breaker.failure_threshold):
+        try:
+            _call(svc, f"outage-{i}")
+        except (LLMUpstreamError, LLMCircuitOpenError):
+            pass
+    served = server.requests_served
+    start = time.monotonic()
+    try:
+        _call(svc, "open")
+        raise AssertionError("expected circuit open")
+    except LLMCircuitOpenError as e:
+        print(f"[breaker] open, failed fast in {(time.monotonic() - start) * 1000:.1f}ms retry_after={e.retry_after:.2f}s")
+    assert server.requests_served == served, "open breaker must not hit upstream"
+
+    # 5) 恢复：半开探测成功后闭合
+    server.configure(error_rate=0.0)
+    time.sleep(health.breaker.reset_timeout + 0.1)
+    _call(svc, "probe")
+    assert health.breaker.state == "closed"
+    print(f"[breaker] recovered via half-open probe: {health.breaker.stats()}")
+
+    # 6) 限流：429 + Retry-After 暂停放行，不触发熔断；重试次数用尽后抛可重试的 LLMRateLimitedError
+    from .ai_service import rate_limit_delay
+    governor = endpoint.governor
+    server.configure(error_rate=1.0, error_status=429, retry_after=0.3)
+    start = time.monotonic()
+    try:
+        _call(svc, "throttled")
+        raise AssertionError("expected rate limited")
+    except LLMRateLimitedError as e:
+        assert e.transient and e.retry_after == 0.3
+    elapsed = time.monotonic() - start
+    print(f"[429] gave up after {elapsed:.2f}s governor={governor.stats()} dispatch_delay={rate_limit_delay():.2f}s")
+    assert elapsed >= svc.MAX_RATE_LIMIT_RETRIES * 0.3 and health.breaker.state == "closed"
+    assert rate_limit_delay() > 0
+    server.configure(error_rate=0.0, error_status=500, retry_after=None)
+    _call(svc, "after-429")
+
+    # 7) 本地 RPM 配额：超出后按 FIFO 排队等待而不是打到上游
+    from .rate_governor import RateGovernor
+    endpoint.governor = RateGovernor(rpm=120)   # 2 次/秒，桶容量 120
+    endpoint.governor._requests.tokens = 1.0
+    start = time.monotonic()
+    for i in range(3):
+        _call(svc, f"rpm-{i}")
+    elapsed = time.monotonic() - start
+    print(f"[rpm] 3 calls with 1 token left took {elapsed:.2f}s governor={endpoint.governor.stats()}")
+    assert elapsed >= 0.9
+
+    # 8) 格式错误的响应体：按可重试的上游错误处理，调度器不会因此移除用户
+    server.configure(malformed_rate=1.0)
+    try:
+        _call(svc, "malformed")
+        raise AssertionError("expected upstream error")
+    except LLMUpstreamError as e:
+        assert e.transient
+        print(f"[malformed] {e}")
+    server.configure(malformed_rate=0.0)
+
+    server.stop()
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
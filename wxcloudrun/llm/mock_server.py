@@ -0,0 +1,425 @@
+"""
+本地 OpenAI 兼容的 LLM 模拟服务（/chat/completions），用于离线压测与验证客户端的超时、对冲、限流与熔断逻辑：
+- 延迟分布：fixed / uniform / normal / lognormal / exponential，或 replay 时使用录制的真实延迟（recorded）
+- 故障注入：挂起（模拟超时）、5xx、429 + Retry-After、格式错误的 JSON
+- 流式：请求带 "stream": true 时按 SSE 分块返回（chat.completion.chunk）
+- 录制 / 回放：record 模式把请求转发到真实上游并把请求-响应对写入 JSONL fixture；
+  replay 模式按归一化提示词查 fixture 返回，结果确定，便于基准测试
+
+    python -m wxcloudrun.llm.mock_server --port 8001 --latency 0.8 --latency-dist lognormal --jitter 0.5
+    python -m wxcloudrun.llm.mock_server --mode record --fixtures fixtures/llm.jsonl \\
+        --upstream https://api.deepseek.com --upstream-key $DEEPSEEK_API_KEY
+    python -m wxcloudrun.llm.mock_server --mode replay --fixtures fixtures/llm.jsonl --latency-dist recorded
+    DEEPSEEK_BASE_URL=http://127.0.0.1:8001 DEEPSEEK_API_KEY=sk-mock gunicorn ...
+
+也可以不单独起进程：设置 LLM_MOCK=1 时 DeepSeekV3Service 在进程内启动模拟服务并全部指向它，
+参数取自 MOCK_LLM_* 环境变量（如 MOCK_LLM_LATENCY=0.8、MOCK_LLM_MODE=replay、MOCK_LLM_FIXTURES=...）。
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from .response_cache import cache_key
+
+
+class FaultConfig:
+    """故障注入与延迟参数；各概率独立判定，优先级：hang > 429 > error > malformed"""
+
+    LATENCY_DISTS = ("fixed", "uniform", "normal", "lognormal", "exponential", "recorded")
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 500, hang_rate: float = 0.0, hang_seconds: float = 30.0,
+                 retry_after: Optional[float] = None, latency_dist: str = "uniform",
+                 rate_limit_rate: float = 0.0, malformed_rate: float = 0.0,
+                 stream_chunk_delay: float = 0.02):
+        self.latency = latency            # 基础延迟（秒）；normal / lognormal 为中位数，exponential 为均值
+        self.jitter = jitter              # uniform 为 ±秒；normal 为标准差（秒）；lognormal 为形状参数 sigma
+        self.latency_dist = latency_dist
+        self.error_rate = error_rate      # 返回 error_status 的概率
+        self.error_status = error_status
+        self.hang_rate = hang_rate        # 挂起 hang_seconds 再返回的概率（模拟超时）
+        self.hang_seconds = hang_seconds
+        self.retry_after = retry_after    # 注入错误时附带的 Retry-After 头（秒），用于模拟 429
+        self.rate_limit_rate = rate_limit_rate    # 返回 429 的概率
+        self.malformed_rate = malformed_rate      # 返回 200 但 JSON 被截断的概率
+        self.stream_chunk_delay = stream_chunk_delay  # 流式响应相邻分块的间隔（秒）
+
+    def update(self, **kwargs: Any) -> None:
+        for k, v in kwargs.items():
+            if not hasattr(self, k):
+                raise ValueError(f"unknown fault option: {k}")
+            if k == "latency_dist" and v not in self.LATENCY_DISTS:
+                raise ValueError(f"unknown latency distribution: {v}")
+            setattr(self, k, v)
+
+    @classmethod
+    def from_env(cls, prefix: str = "MOCK_LLM_") -> "FaultConfig":
+        """按 MOCK_LLM_<参数名大写> 环境变量覆盖默认值"""
+        config = cls()
+        for name, default in list(vars(config).items()):
+            raw = os.environ.get(prefix + name.upper())
+            if raw is None:
+                continue
+            if isinstance(default, str):
+                value: Any = raw
+            elif isinstance(default, int) and not isinstance(default, bool):
+                value = int(raw)
+            else:
+                value = float(raw)
+            config.update(**{name: value})
+        return config
+
+    def sample_latency(self, recorded: Optional[float] = None) -> float:
+        dist, base, spread = self.latency_dist, self.latency, self.jitter
+        if dist == "recorded" and recorded is not None:
+            value = recorded
+        elif dist == "fixed":
+            value = base
+        elif dist == "normal":
+            value = random.gauss(base, spread)
+        elif dist == "lognormal":
+            value = base * random.lognormvariate(0.0, spread)
+        elif dist == "exponential":
+            value = random.expovariate(1.0 / base) if base > 0 else 0.0
+        else:
+            value = base + random.uniform(-spread, spread)
+        return max(0.0, value)
+
+
+def fixture_key(payload: Dict[str, Any]) -> str:
+    """回放查找 key：与响应缓存相同的提示词归一化，但不含 model（录制与回放可用不同模型名）"""
+    return cache_key(dict(payload, model="", temperature=payload.get("temperature"),
+                          max_tokens=payload.get("max_tokens")))
+
+
+class FixtureStore:
+    """JSONL fixture：每行 {"key", "request", "status", "response", "latency"}；同一 key 多条时轮流返回"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursor: Dict[str, int] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries.setdefault(entry["key"], []).append(entry)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(v) for v in self._entries.values())
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                return None
+            i = self._cursor.get(key, 0)
+            self._cursor[key] = i + 1
+            return entries[i % len(entries)]
+
+    def record(self, payload: Dict[str, Any], status: int, response: Dict[str, Any], latency: float) -> None:
+        entry = {"key": fixture_key(payload), "request": payload, "status": status,
+                 "response": response, "latency": round(latency, 4)}
+        with self._lock:
+            self._entries.setdefault(entry["key"], []).append(entry)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def mock_content(messages: List[Dict[str, Any]]) -> str:
+    """按提示词类型返回符合业务解析格式的内容：Thought 决策器返回 ThoughtResult JSON，发言返回 {"text": ...}"""
+    prompt = "\n".join(str(m.get("content", "")) for m in messages)
+    if "Thought 决策器" in prompt:
+        return json.dumps({
+            "turn_action": random.choice(["SPEAK_USER_DIGITAL_AVATAR", "SPEAK_TRAVEL_PARTNER"]),
+            "guidance_list": ["推进主题", "给出一个具体选择"],
+            "topic_action": "CONTINUE_TOPIC",
+            "topic_args": {"topic": "首日路线与到达时间", "new_topic": None},
+            "confidence": 0.8,
+            "rationale": "mock",
+        }, ensure_ascii=False)
+    return json.dumps({"text": random.choice(["先定第一天的路线吧。", "下午三点到酒店可以吗？", "晚上去看夜景怎么样？"])},
+                      ensure_ascii=False)
+
+
+def completion_body(payload: Dict[str, Any], content: str) -> Dict[str, Any]:
+    prompt_tokens = sum(len(str(m.get("content", ""))) for m in payload.get("messages", []))
+    completion_tokens = len(content)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": payload.get("model", "mock-model"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def stream_chunks(body: Dict[str, Any], pieces: int = 8) -> List[Dict[str, Any]]:
+    """把一个完整应答拆成 chat.completion.chunk 序列（首块带 role，末块带 finish_reason）"""
+    content = body["choices"][0]["message"]["content"]
+    size = max(1, -(-len(content) // pieces))
+    base = {"id": body["id"], "object": "chat.completion.chunk", "created": body["created"], "model": body["model"]}
+    chunks = [dict(base, choices=[{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}])]
+    for i in range(0, len(content), size):
+        chunks.append(dict(base, choices=[{"index": 0, "delta": {"content": content[i:i + size]}, "finish_reason": None}]))
+    chunks.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}], usage=body.get("usage")))
+    return chunks
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+
+    def log_message(self, format: str, *args: Any) -> None:  # 静默默认访问日志
+        pass
+
+    def do_POST(self) -> None:
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+
+        mock = self.server.mock
+        faults = mock.faults
+        mock.count_request()
+
+        status, body, recorded_latency = mock.answer(payload)
+        if random.random() < faults.hang_rate:
+            time.sleep(faults.hang_seconds)
+        else:
+            time.sleep(faults.sample_latency(recorded_latency))
+
+        if random.random() < faults.rate_limit_rate:
+            retry_after = faults.retry_after if faults.retry_after is not None else 1.0
+            self._send_json(429, {"error": {"message": "rate limited"}}, {"Retry-After": str(retry_after)})
+            return
+        if random.random() < faults.error_rate:
+            headers = {"Retry-After": str(faults.retry_after)} if faults.retry_after is not None else None
+            self._send_json(faults.error_status, {"error": {"message": "injected failure"}}, headers)
+            return
+        if random.random() < faults.malformed_rate:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self._send_raw(200, data[:max(1, len(data) // 2)], "application/json")
+            return
+        if payload.get("stream") and status == 200:
+            self._send_stream(body, faults.stream_chunk_delay)
+            return
+        self._send_json(status, body)
+
+    def _send_stream(self, body: Dict[str, Any], chunk_delay: float) -> None:
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            for chunk in stream_chunks(body):
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(chunk_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        self._send_raw(status, json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json", headers)
+
+    def _send_raw(self, status: int, data: bytes, content_type: str,
+                  headers: Optional[Dict[str, str]] = None) -> None:
+        try:
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 客户端已放弃（超时 / 对冲失败方被 kill）
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    mock: "MockLLMServer"
+
+
+class MockLLMServer:
+    """
+    可在进程内启动的模拟服务：start() 后通过 url 访问，configure() 可在运行中调整故障参数。
+    mode：synthetic（按提示词类型合成内容）/ record（转发到 upstream 并写 fixture）/ replay（从 fixture 返回）
+    """
+    MODES = ("synthetic", "record", "replay")
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, mode: str = "synthetic",
+                 fixtures: Optional[str] = None, upstream: Optional[str] = None,
+                 upstream_key: Optional[str] = None, replay_strict: bool = False,
+                 faults: Optional[FaultConfig] = None, **fault_options: Any):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown mock mode: {mode}")
+        if mode != "synthetic" and not fixtures:
+            raise ValueError(f"mode {mode} requires a fixtures path")
+        if mode == "record" and not upstream:
+            raise ValueError("record mode requires an upstream url")
+        self.faults = faults or FaultConfig()
+        self.faults.update(**fault_options)
+        if mode == "record":
+            self.faults.update(latency_dist="recorded")  # 录制时由真实上游决定延迟，不再叠加模拟延迟
+        self.mode = mode
+        self.fixtures = FixtureStore(fixtures) if fixtures else None
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.upstream_key = upstream_key
+        self.replay_strict = replay_strict   # 回放未命中时：True 返回 404，False 退回合成内容
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.mock = self
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.requests_served = 0
+        self.replay_hits = 0
+        self.replay_misses = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def configure(self, **faults: Any) -> None:
+        self.faults.update(**faults)
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests_served += 1
+
+    def answer(self, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any], Optional[float]]:
+        """按模式生成应答：返回 (状态码, 完整应答体, 录制时的上游延迟)"""
+        if self.mode == "record":
+            return self._record(payload)
+        if self.mode == "replay":
+            entry = self.fixtures.lookup(fixture_key(payload))
+            with self._lock:
+                if entry is None:
+                    self.replay_misses += 1
+                else:
+                    self.replay_hits += 1
+            if entry is not None:
+                return entry["status"], entry["response"], entry.get("latency")
+            if self.replay_strict:
+                return 404, {"error": {"message": "no fixture for request"}}, None
+        return 200, completion_body(payload, mock_content(payload.get("messages", []))), None
+
+    def _record(self, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any], Optional[float]]:
+        import requests  # 仅录制模式需要
+
+        upstream_payload = dict(payload, stream=False)
+        start = time.monotonic()
+        try:
+            resp = requests.post(
+                f"{self.upstream}/chat/completions",
+                headers={"Authorization": f"Bearer {self.upstream_key}", "Content-Type": "application/json"},
+                json=upstream_payload, timeout=300,
+            )
+            status, body = resp.status_code, resp.json()
+        except Exception as e:
+            return 502, {"error": {"message": f"upstream failed: {e}"}}, 0.0
+        if status == 200:
+            self.fixtures.record(upstream_payload, status, body, time.monotonic() - start)
+        return status, body, 0.0   # 上游耗时已经发生，不再额外等待
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "requests_served": self.requests_served,
+                "replay_hits": self.replay_hits,
+                "replay_misses": self.replay_misses,
+                "fixtures": len(self.fixtures) if self.fixtures is not None else 0,
+            }
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self) -> None:
+        self._httpd.serve_forever()
+
+
+def server_from_env(prefix: str = "MOCK_LLM_") -> MockLLMServer:
+    """按 MOCK_LLM_* 环境变量创建模拟服务（端口默认随机）"""
+    return MockLLMServer(
+        host=os.environ.get(prefix + "HOST", "127.0.0.1"),
+        port=int(os.environ.get(prefix + "PORT", "0")),
+        mode=os.environ.get(prefix + "MODE", "synthetic"),
+        fixtures=os.environ.get(prefix + "FIXTURES"),
+        upstream=os.environ.get(prefix + "UPSTREAM"),
+        upstream_key=os.environ.get(prefix + "UPSTREAM_KEY", os.environ.get("DEEPSEEK_API_KEY")),
+        replay_strict=os.environ.get(prefix + "REPLAY_STRICT", "").lower() in ("1", "true", "yes"),
+        faults=FaultConfig.from_env(prefix),
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    defaults = FaultConfig.from_env()
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock LLM server")
+    parser.add_argument("--host", default=os.environ.get("MOCK_LLM_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("MOCK_LLM_PORT", "8001")))
+    parser.add_argument("--mode", choices=MockLLMServer.MODES, default=os.environ.get("MOCK_LLM_MODE", "synthetic"))
+    parser.add_argument("--fixtures", default=os.environ.get("MOCK_LLM_FIXTURES"))
+    parser.add_argument("--upstream", default=os.environ.get("MOCK_LLM_UPSTREAM"))
+    parser.add_argument("--upstream-key", default=os.environ.get("MOCK_LLM_UPSTREAM_KEY", os.environ.get("DEEPSEEK_API_KEY")))
+    parser.add_argument("--replay-strict", action="store_true")
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--latency-dist", choices=FaultConfig.LATENCY_DISTS, default=defaults.latency_dist)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    parser.add_argument("--hang-rate", type=float, default=defaults.hang_rate)
+    parser.add_argument("--hang-seconds", type=float, default=defaults.hang_seconds)
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after)
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate)
+    parser.add_argument("--malformed-rate", type=float, default=defaults.malformed_rate)
+    parser.add_argument("--stream-chunk-delay", type=float, default=defaults.stream_chunk_delay)
+    args = parser.parse_args(argv)
+
+    server = MockLLMServer(
+        args.host, args.port, mode=args.mode, fixtures=args.fixtures,
+        upstream=args.upstream, upstream_key=args.upstream_key, replay_strict=args.replay_strict,
+        latency=args.latency, latency_dist=args.latency_dist, jitter=args.jitter,
+        error_rate=args.error_rate, error_status=args.error_status,
+        hang_rate=args.hang_rate, hang_seconds=args.hang_seconds,
+        retry_after=args.retry_after, rate_limit_rate=args.rate_limit_rate,
+        malformed_rate=args.malformed_rate, stream_chunk_delay=args.stream_chunk_delay,
+    )
+    print(f"mock LLM server ({args.mode}) listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+from ..observability.runtime import worker_count
+
+
+class GovernorWaitAborted(Exception):
+    """排队等待配额时被取消令牌或等待超时打断"""
+
+
+class TokenBucket:
+    """令牌桶（非线程安全，由 RateGovernor 加锁访问）；limit_per_minute <= 0 表示不限"""
+
+    def __init__(self, limit_per_minute: float):
+        self.limit = limit_per_minute
+        self.capacity = float(limit_per_minute)
+        self.tokens = float(limit_per_minute)
+        self.rate = limit_per_minute / 60.0
+        self._last = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait_time(self, n: float, now: float) -> float:
+        """还需等待多少秒才能取出 n 个令牌（单次需求超过容量时按容量计，避免永远等不到）"""
+        if self.limit <= 0:
+            return 0.0
+        self._refill(now)
+        n = min(n, self.capacity)
+        return 0.0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    def take(self, n: float, now: float) -> None:
+        if self.limit <= 0:
+            return
+        self._refill(now)
+        self.tokens -= min(n, self.capacity)
+
+    def give_back(self, n: float) -> None:
+        """按实际用量修正（n 为负表示补扣）"""
+        if self.limit <= 0:
+            return
+        self.tokens = min(self.capacity, self.tokens + n)
+
+
+def estimate_tokens(payload: Dict[str, Any]) -> int:
+    """粗估一次请求消耗的 token：中文约 1 字 1 token，ASCII 约 4 字符 1 token，再加上 max_tokens"""
+    non_ascii = ascii_chars = 0
+    for m in payload.get("messages", []):
+        for ch in str(m.get("content", "")):
+            if ord(ch) < 128:
+                ascii_chars += 1
+            else:
+                non_ascii += 1
+    return non_ascii + ascii_chars // 4 + int(payload.get("max_tokens") or 0)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头（秒数或 HTTP 日期）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class RateGovernor:
+    """
+    线程安全的上游限流器：每分钟请求数（RPM）与 token 数（TPM）两个令牌桶。
+    - acquire(): 按到达顺序（FIFO）排队，轮到自己且两个桶都有配额才放行，保证公平
+    - on_rate_limited(): 收到 429 后按 Retry-After 暂停全部放行
+    - suggested_delay(): 给调度器的反馈——需要放慢多久，而不是把用户踢出队列
+    """
+    DEFAULT_RETRY_AFTER = 5.0
+
+    def __init__(self, rpm: float = 0, tpm: float = 0):
+        self._cv = threading.Condition()
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._queue: "deque[object]" = deque()
+        self._paused_until = 0.0
+        self._admitted = 0
+        self._rate_limited = 0
+        self._wait_seconds = 0.0
+
+    def acquire(self, est_tokens: int, token: Any = None, timeout: Optional[float] = None) -> None:
+        """排队获取一次请求的配额；token 为可选取消令牌"""
+        ticket = object()
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        unregister = token.add_callback(self._wake) if token is not None else (lambda: None)
+        try:
+            with self._cv:
+                self._queue.append(ticket)
+                try:
+                    while True:
+                        if token is not None and token.cancelled:
+                            raise GovernorWaitAborted("cancelled while waiting for rate limit")
+                        now = time.monotonic()
+                        wait = self._wait_for(ticket, est_tokens, now)
+                        if wait <= 0:
+                            self._requests.take(1, now)
+                            self._tokens.take(est_tokens, now)
+                            self._admitted += 1
+                            self._wait_seconds += now - start
+                            return
+                        if deadline is not None:
+                            if now >= deadline:
+                                raise GovernorWaitAborted(f"rate limit wait exceeded {timeout:.1f}s")
+                            wait = min(wait, deadline - now)
+                        self._cv.wait(timeout=wait)
+                finally:
+                    self._queue.remove(ticket)
+                    self._cv.notify_all()  # 队头变化，唤醒下一位
+        finally:
+            unregister()
+
+    def _wait_for(self, ticket: object, est_tokens: int, now: float) -> float:
+        """需持锁调用：不是队头时返回一个较短的轮询间隔，由 notify 提前唤醒"""
+        if self._queue[0] is not ticket:
+            return 1.0
+        return max(self._paused_until - now,
+                   self._requests.wait_time(1, now),
+                   self._tokens.wait_time(est_tokens, now))
+
+    def _wake(self) -> None:
+        with self._cv:
+            self._cv.notify_all()
+
+    def settle(self, est_tokens: int, actual_tokens: Optional[int]) -> None:
+        """请求完成后按响应中的实际 token 用量修正 TPM 桶"""
+        if actual_tokens is None:
+            return
+        with self._cv:
+            self._tokens.give_back(est_tokens - actual_tokens)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> float:
+        """收到 429：暂停放行 retry_after 秒（缺省 DEFAULT_RETRY_AFTER），返回实际暂停秒数"""
+        pause = retry_after if retry_after is not None else self.DEFAULT_RETRY_AFTER
+        with self._cv:
+            self._rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self._tokens.tokens = min(self._tokens.tokens, 0.0)  # 上游已判定超限，本地桶同步清空
+        return pause
+
+    def suggested_delay(self) -> float:
+        """调度器在发起新一轮 step 前应等待的秒数：429 暂停剩余时间，或排队请求按 RPM 排空所需时间"""
+        with self._cv:
+            now = time.monotonic()
+            delay = max(0.0, self._paused_until - now)
+            if self._queue and self._requests.limit > 0:
+                delay = max(delay, len(self._queue) / self._requests.rate)
+            return delay
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cv:
+            now = time.monotonic()
+            return {
+                "rpm_limit": self._requests.limit,
+                "tpm_limit": self._tokens.limit,
+                "queued": len(self._queue),
+                "admitted": self._admitted,
+                "rate_limited_429": self._rate_limited,
+                "paused_for": round(max(0.0, self._paused_until - now), 3),
+                "avg_wait_seconds": round(self._wait_seconds / self._admitted, 4) if self._admitted else 0.0,
+            }
+
+
+def per_worker(limit: float) -> float:
+    """上游配额按账号计算；多 worker 时每个进程各自限流，按 worker 数均分，合计不超过账号配额"""
+    return limit / worker_count() if limit > 0 else limit
+
+
+def governor_from_env(prefix: str = "DEEPSEEK") -> RateGovernor:
+    """按环境变量 <prefix>_RPM / <prefix>_TPM 创建限流器（默认 0 不限，需按账号配额显式开启；按 worker 数均分）"""
+    return RateGovernor(
+        rpm=per_worker(float(os.environ.get(f"{prefix}_RPM", "0"))),
+        tpm=per_worker(float(os.environ.get(f"{prefix}_TPM", "0"))),
+    )
@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+
+class LatencyTracker:
+    """线程安全：最近 N 次成功调用的耗时滑动窗口，用于计算分位数"""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self._samples: "deque[float]" = deque(maxlen=window)
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._samples.clear()
+
+    def percentile(self, p: float) -> Optional[float]:
+        """p 取 0~100；无样本返回 None"""
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        idx = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+        return ordered[idx]
+
+
+class CircuitBreaker:
+    """
+    线程安全的熔断器：
+    - closed：正常放行；连续失败达到 failure_threshold 次 → open
+    - open：快速失败，reset_timeout 秒后 → half_open
+    - half_open：只放行 half_open_probes 个探测请求；探测成功 → closed，失败 → 重新 open
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_probes: int = 1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes_inflight = 0
+        self._opened_total = 0
+        self._rejected_total = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes_inflight = 0
+        return self._state
+
+    def allow(self) -> bool:
+        """是否放行本次请求；half_open 时放行的请求即为探测请求"""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._probes_inflight < self.half_open_probes:
+                self._probes_inflight += 1
+                return True
+            self._rejected_total += 1
+            return False
+
+    def retry_after(self) -> float:
+        """距离下次允许探测的秒数"""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            if self._state == self.HALF_OPEN:
+                self._probes_inflight = max(0, self._probes_inflight - 1)
+            self._state = self.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            self._failures += 1
+            if state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if state != self.OPEN:
+                    self._opened_total += 1
+                self._state = self.OPEN
+                self._opened_at = now
+                self._probes_inflight = 0
+
+    def record_release(self) -> None:
+        """请求被取消、结果未知时归还探测名额"""
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probes_inflight = max(0, self._probes_inflight - 1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self._current_state(time.monotonic()),
+                "consecutive_failures": self._failures,
+                "opened_total": self._opened_total,
+                "rejected_total": self._rejected_total,
+            }
+
+
+class EndpointHealth:
+    """
+    单个上游端点的健康状态：延迟分布 + 熔断器 + 自适应超时 / 对冲参数。
+    - 超时：样本足够时取 p99 × TIMEOUT_FACTOR，限制在 [MIN_TIMEOUT, max_timeout]
+    - 对冲：样本足够时，请求超过 p95 仍未返回就再发一份，先返回者胜出；对冲量不超过调用量的 HEDGE_BUDGET
+    """
+    MIN_SAMPLES = 20
+    TIMEOUT_FACTOR = 3.0
+    MIN_TIMEOUT = 15.0
+    HEDGE_PERCENTILE = 95
+    HEDGE_BUDGET = 0.1
+
+    def __init__(self, max_timeout: float = 300.0, breaker: Optional[CircuitBreaker] = None):
+        self.max_timeout = max_timeout
+        self.latency = LatencyTracker()
+        self.breaker = breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+        self._timeouts = 0
+
+    def timeout(self) -> float:
+        if self.latency.count() < self.MIN_SAMPLES:
+            return self.max_timeout
+        p99 = self.latency.percentile(99)
+        return max(self.MIN_TIMEOUT, min(self.max_timeout, p99 * self.TIMEOUT_FACTOR))
+
+    def hedge_delay(self) -> Optional[float]:
+        """返回发起对冲请求前的等待秒数；样本不足返回 None（不对冲）"""
+        if self.latency.count() < self.MIN_SAMPLES:
+            return None
+        return self.latency.percentile(self.HEDGE_PERCENTILE)
+
+    def on_call(self) -> None:
+        with self._lock:
+            self._calls += 1
+
+    def try_hedge(self) -> bool:
+        """占用一次对冲名额；超出预算返回 False"""
+        with self._lock:
+            if self._hedged + 1 > self._calls * self.HEDGE_BUDGET + 1:
+                return False
+            self._hedged += 1
+            return True
+
+    def on_hedge_win(self) -> None:
+        with self._lock:
+            self._hedge_wins += 1
+
+    def on_timeout(self) -> None:
+        with self._lock:
+            self._timeouts += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {
+                "calls": self._calls,
+                "hedged": self._hedged,
+                "hedge_wins": self._hedge_wins,
+                "timeouts": self._timeouts,
+            }
+        counters.update({
+            "p50": self.latency.percentile(50),
+            "p95": self.latency.percentile(95),
+            "p99": self.latency.percentile(99),
+            "timeout": round(self.timeout(), 3),
+            "breaker": self.breaker.stats(),
+        })
+        return counters
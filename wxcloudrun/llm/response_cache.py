@@ -0,0 +1,193 @@
+import json
+import os
+import re
+import threading
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_WS_RE = re.compile(r"\s+")
+
+
+def cache_key(payload: Dict[str, Any]) -> str:
+    """按归一化后的提示词计算缓存 key：消息内容压缩空白，连同 model/temperature/max_tokens 一起哈希"""
+    messages = [
+        {"role": m.get("role"), "content": _WS_RE.sub(" ", str(m.get("content", ""))).strip()}
+        for m in payload["messages"]
+    ]
+    raw = json.dumps(
+        [payload["model"], messages, payload["temperature"], payload["max_tokens"]],
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    线程安全的 LLM 响应缓存：内存 LRU（按条数淘汰）+ TTL 过期，可选 sqlite 落盘，重启后仍可命中。
+    TTL 使用墙上时间，保证落盘条目跨进程有效。
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 3600.0,
+                 path: Optional[str] = None, max_disk_entries: Optional[int] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries or max_entries * 10
+        self._lock = threading.Lock()
+        self._mem: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()  # {key: (expires_at, response)}
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+        self._db: Optional[Any] = None   # sqlite3.Connection
+        if path:
+            self._open_disk(path)
+
+    def _open_disk(self, path: str) -> None:
+        import sqlite3  # 仅落盘时需要，不在启动时加载
+
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, response TEXT NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache(expires_at)")
+        except Exception as e:
+            logger.error(f"[LLM_CACHE] 打开磁盘缓存失败，仅使用内存缓存: {e}")
+            self._db = None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None:
+                expires_at, response = item
+                if expires_at > now:
+                    self._mem.move_to_end(key)
+                    self._hits += 1
+                    return response
+                del self._mem[key]
+                self._expired += 1
+            response = self._disk_get(key, now)
+            if response is not None:
+                self._hits += 1
+                self._disk_hits += 1
+                self._mem_put(key, response, now)
+                return response
+            self._misses += 1
+            return None
+
+    def put(self, key: str, response: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._mem_put(key, response, now)
+            self._disk_put(key, response, now)
+
+    def _mem_put(self, key: str, response: Dict[str, Any], now: float) -> None:
+        self._mem[key] = (now + self.ttl_seconds, response)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+            self._evictions += 1
+
+    def _disk_get(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT response FROM llm_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+        except Exception as e:
+            logger.warning(f"[LLM_CACHE] 读取磁盘缓存失败: {e}")
+            return None
+
+    def _disk_put(self, key: str, response: Dict[str, Any], now: float) -> None:
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, expires_at, response) VALUES (?, ?, ?)",
+                (key, now + self.ttl_seconds, json.dumps(response, ensure_ascii=False)),
+            )
+            # 超出容量时删除最早过期的条目
+            self._db.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            )
+        except Exception as e:
+            logger.warning(f"[LLM_CACHE] 写入磁盘缓存失败: {e}")
+
+    def purge_expired(self, memory: bool = True, disk: bool = True) -> int:
+        """清理内存（本进程）与磁盘（多 worker 共用）中的过期条目，返回清理条数"""
+        now = time.time()
+        with self._lock:
+            purged = 0
+            if memory:
+                stale = [k for k, (expires_at, _) in self._mem.items() if expires_at <= now]
+                for k in stale:
+                    del self._mem[k]
+                purged = len(stale)
+            if disk and self._db is not None:
+                try:
+                    purged += self._db.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,)).rowcount
+                except Exception as e:
+                    logger.warning(f"[LLM_CACHE] 清理磁盘缓存失败: {e}")
+            self._expired += purged
+            return purged
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM llm_cache")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._mem),
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "expired": self._expired,
+                "disk_enabled": self._db is not None,
+            }
+
+
+# ---- 进程级单例（按环境变量开启，默认关闭） ----
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    返回进程内共享的响应缓存；未开启时返回 None。
+    环境变量：
+      LLM_CACHE_ENABLED=1          开启缓存
+      LLM_CACHE_MAX_ENTRIES=1000   内存条数上限
+      LLM_CACHE_TTL_SECONDS=3600   过期时间
+      LLM_CACHE_PATH=              sqlite 文件路径，留空则不落盘
+    """
+    global _cache
+    if os.environ.get("LLM_CACHE_ENABLED", "0") not in ("1", "true", "True"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "1000")),
+                    ttl_seconds=float(os.environ.get("LLM_CACHE_TTL_SECONDS", "3600")),
+                    path=os.environ.get("LLM_CACHE_PATH") or None,
+                )
+    return _cache
@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import random
+import threading
+from typing import Any, Dict, List, Optional
+
+from .resilience import EndpointHealth
+from .rate_governor import RateGovernor, governor_from_env, per_worker
+
+logger = logging.getLogger(__name__)
+
+
+class LLMEndpoint:
+    """
+    一个 OpenAI 兼容的上游端点（地址 + 模型 + 密钥），自带健康状态、限流器与延迟 EWMA。
+    routes 为空表示可服务所有调用点；weight 越大越优先，cost 为相对单价（越小越优先）。
+    """
+    EWMA_ALPHA = 0.2
+    DEFAULT_LATENCY = 2.0   # 还没有样本时的估计延迟（秒）
+
+    def __init__(self, name: str, base_url: str, model: str, api_key: str,
+                 weight: float = 1.0, cost: float = 1.0, routes: Optional[List[str]] = None,
+                 governor: Optional[RateGovernor] = None, max_timeout: float = 300.0):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.weight = weight
+        self.cost = cost
+        self.routes = set(routes or [])
+        self.health = EndpointHealth(max_timeout=max_timeout)
+        self.governor = governor or RateGovernor()
+        self._lock = threading.Lock()
+        self._latency_ewma: Optional[float] = None
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/chat/completions"
+
+    def serves(self, route: str) -> bool:
+        return not self.routes or route in self.routes
+
+    def observe_latency(self, seconds: float) -> None:
+        with self._lock:
+            if self._latency_ewma is None:
+                self._latency_ewma = seconds
+            else:
+                self._latency_ewma += self.EWMA_ALPHA * (seconds - self._latency_ewma)
+
+    @property
+    def latency_ewma(self) -> float:
+        with self._lock:
+            return self._latency_ewma if self._latency_ewma is not None else self.DEFAULT_LATENCY
+
+    def available(self) -> bool:
+        """熔断器未打开（half_open 允许探测）且没有处于 429 暂停中"""
+        return self.health.breaker.state != "open" and self.governor.suggested_delay() <= 0
+
+    def score(self) -> float:
+        """选择分数：越快、越便宜、weight 越大越优先"""
+        return self.weight / (max(self.latency_ewma, 0.01) * max(self.cost, 0.01))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "model": self.model,
+            "routes": sorted(self.routes),
+            "weight": self.weight,
+            "cost": self.cost,
+            "latency_ewma": round(self.latency_ewma, 4),
+            "health": self.health.stats(),
+            "rate_limit": self.governor.stats(),
+        }
+
+
+class LLMRouter:
+    """
+    按调用点（route，如 "thought" / "speak"）在多个端点间选择：
+    - 只在声明服务该 route 的端点中选；都没有声明时退回全部端点
+    - 可用端点按 score 从高到低排序；EXPLORE_RATE 的请求随机挑一个可用端点放到最前，
+      让非首选端点也持续获得延迟样本，延迟变化后能及时切换
+    - 熔断打开或 429 暂停中的端点排在最后，作为最后的故障转移候选
+    """
+    EXPLORE_RATE = 0.1
+
+    def __init__(self, endpoints: List[LLMEndpoint]):
+        if not endpoints:
+            raise ValueError("LLMRouter requires at least one endpoint")
+        self.endpoints = endpoints
+
+    def candidates(self, route: str, explore: bool = True) -> List[LLMEndpoint]:
+        """按尝试顺序返回该 route 的候选端点；explore=False 时不做随机探索（取当前首选端点用）"""
+        pool = [ep for ep in self.endpoints if ep.serves(route)] or list(self.endpoints)
+        healthy = sorted((ep for ep in pool if ep.available()), key=lambda ep: ep.score(), reverse=True)
+        degraded = [ep for ep in pool if ep not in healthy]
+        if explore and len(healthy) > 1 and random.random() < self.EXPLORE_RATE:
+            pick = random.choices(healthy, weights=[ep.weight for ep in healthy])[0]
+            healthy.remove(pick)
+            healthy.insert(0, pick)
+        return healthy + degraded
+
+    def select(self, route: str, explore: bool = True) -> LLMEndpoint:
+        return self.candidates(route, explore)[0]
+
+    def suggested_delay(self) -> float:
+        """全部端点都在限流时才需要放慢调度：取各端点建议等待时间的最小值"""
+        return min(ep.governor.suggested_delay() for ep in self.endpoints)
+
+    def stats(self) -> Dict[str, Dict]:
+        return {ep.name: ep.stats() for ep in self.endpoints}
+
+
+def endpoints_from_env(max_timeout: float = 300.0) -> List[LLMEndpoint]:
+    """
+    从环境变量 LLM_ENDPOINTS（JSON 数组）读取端点，例如：
+        [{"name": "fast", "base_url": "https://api.deepseek.com", "model": "deepseek-chat",
+          "api_key_env": "DEEPSEEK_API_KEY", "routes": ["thought"], "cost": 1, "rpm": 600},
+         {"name": "quality", "base_url": "...", "model": "...", "api_key": "...", "routes": ["speak"]}]
+    未配置时退回单个 DeepSeek 端点（DEEPSEEK_BASE_URL / DEEPSEEK_MODEL / DEEPSEEK_API_KEY）；
+    LLM_MOCK=1 时在进程内启动模拟服务（参数见 mock_server.server_from_env）并只使用它
+    """
+    default_key = os.environ.get("DEEPSEEK_API_KEY")   # 未配置时 DeepSeekV3Service 构造即报错
+    if os.environ.get("LLM_MOCK", "").lower() in ("1", "true", "yes"):
+        from .mock_server import server_from_env
+
+        server = server_from_env().start()
+        logger.info(f"[LLM_ROUTER] LLM_MOCK 已开启，使用进程内模拟服务: {server.url} ({server.mode})")
+        return [LLMEndpoint(name="mock", base_url=server.url, model="mock-model", api_key="sk-mock",
+                            governor=governor_from_env(), max_timeout=max_timeout)]
+    raw = os.environ.get("LLM_ENDPOINTS")
+    if not raw:
+        return [LLMEndpoint(
+            name="deepseek",
+            base_url=os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
+            model=os.environ.get("DEEPSEEK_MODEL", "deepseek-chat"),
+            api_key=default_key,
+            governor=governor_from_env(),
+            max_timeout=max_timeout,
+        )]
+
+    endpoints = []
+    for i, cfg in enumerate(json.loads(raw)):
+        api_key = cfg.get("api_key") or os.environ.get(cfg.get("api_key_env", "DEEPSEEK_API_KEY"), default_key)
+        if "rpm" in cfg or "tpm" in cfg:
+            governor = RateGovernor(rpm=per_worker(float(cfg.get("rpm", 0))),
+                                    tpm=per_worker(float(cfg.get("tpm", 0))))
+        else:
+            governor = governor_from_env()
+        endpoints.append(LLMEndpoint(
+            name=cfg.get("name") or f"endpoint-{i}",
+            base_url=cfg["base_url"],
+            model=cfg["model"],
+            api_key=api_key,
+            weight=float(cfg.get("weight", 1.0)),
+            cost=float(cfg.get("cost", 1.0)),
+            routes=cfg.get("routes"),
+            governor=governor,
+            max_timeout=max_timeout,
+        ))
+    logger.info(f"[LLM_ROUTER] 已加载 {len(endpoints)} 个端点: {[ep.name for ep in endpoints]}")
+    return endpoints
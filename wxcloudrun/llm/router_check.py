@@ -0,0 +1,92 @@
+"""
+用多个本地模拟端点验证 LLM 路由的按调用点选择、延迟优先与故障转移：
+
+    python -m wxcloudrun.llm.router_check
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import time
+
+from .mock_server import MockLLMServer
+from .router import LLMEndpoint, LLMRouter
+from .ai_service import DeepSeekV3Service, set_router
+
+
+def _call(svc: DeepSeekV3Service, tag: str):
+    # 每次内容不同，避免被请求合并 / 响应缓存影响
+    return svc.chat_completion([{"role": "user", "content": f"router-check {tag} {time.monotonic()}"}], max_tokens=16)
+
+
+def _endpoint(name: str, server: MockLLMServer, **kwargs) -> LLMEndpoint:
+    endpoint = LLMEndpoint(name=name, base_url=server.url, model=f"mock-{name}", api_key="sk-mock", **kwargs)
+    endpoint.health.MIN_TIMEOUT = 0.5
+    endpoint.health.breaker.reset_timeout = 60.0
+    return endpoint
+
+
+def main() -> None:
+    fast = MockLLMServer(latency=0.02).start()
+    quality = MockLLMServer(latency=0.08).start()
+    slow = MockLLMServer(latency=0.3).start()
+    backup = MockLLMServer(latency=0.05).start()
+    servers = [fast, quality, slow, backup]
+
+    # 1) 按调用点选择：thought 走便宜快速的模型，speak 走高质量模型；backup 不限调用点但权重很低
+    set_router(LLMRouter([
+        _endpoint("fast", fast, routes=["thought"], cost=0.2),
+        _endpoint("quality", quality, routes=["speak"], cost=1.0),
+        _endpoint("backup", backup, weight=0.01),
+    ]))
+    thought, speak = DeepSeekV3Service(route="thought"), DeepSeekV3Service(route="speak")
+    for i in range(20):
+        _call(thought, f"thought-{i}")
+        _call(speak, f"speak-{i}")
+    print(f"[route] fast={fast.requests_served} quality={quality.requests_served} backup={backup.requests_served}")
+    assert fast.requests_served >= 18 and quality.requests_served >= 18
+
+    # 2) 故障转移：fast 持续 5xx，thought 调用仍成功（切到 backup），熔断后不再打到 fast
+    fast.configure(error_rate=1.0)
+    for i in range(10):
+        _call(thought, f"failover-{i}")
+    served = fast.requests_served
+    for i in range(5):
+        _call(thought, f"after-open-{i}")
+    router = thought.router
+    print(f"[failover] fast breaker={router.endpoints[0].health.breaker.state} backup={backup.requests_served}")
+    assert router.endpoints[0].health.breaker.state == "open"
+    assert fast.requests_served == served, "open endpoint must be skipped"
+
+    # 3) 延迟优先：同一调用点的两个端点，预热后大部分流量流向延迟 EWMA 更低的端点
+    for server in servers:
+        server.requests_served = 0
+    set_router(LLMRouter([
+        _endpoint("quick", quality, routes=["speak"]),
+        _endpoint("sluggish", slow, routes=["speak"]),
+    ]))
+    speak = DeepSeekV3Service(route="speak")
+    for i in range(40):
+        _call(speak, f"latency-{i}")
+    stats = speak.router.stats()
+    print(f"[latency] quick={quality.requests_served} sluggish={slow.requests_served} "
+          f"ewma={{quick: {stats['quick']['latency_ewma']}, sluggish: {stats['sluggish']['latency_ewma']}}}")
+    assert quality.requests_served > 2 * slow.requests_served
+
+    # 4) 全部端点不可用时抛出最后一个可重试错误
+    quality.configure(error_rate=1.0)
+    slow.configure(error_rate=1.0)
+    try:
+        _call(speak, "all-down")
+        raise AssertionError("expected failure")
+    except Exception as e:
+        assert getattr(e, "transient", False), e
+        print(f"[all-down] {type(e).__name__}: {e}")
+
+    set_router(None)
+    for server in servers:
+        server.stop()
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
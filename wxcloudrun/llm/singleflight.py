@@ -0,0 +1,123 @@
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class WaitAborted(Exception):
+    """等待共享结果时被调用方自己的取消令牌或超时打断"""
+
+
+class _Call:
+    __slots__ = ("done", "result", "exc", "waiters")
+
+    def __init__(self):
+        self.done = False
+        self.result: Any = None
+        self.exc: Optional[BaseException] = None
+        self.waiters: List[threading.Event] = []
+
+
+class SingleFlight:
+    """
+    线程安全：相同 key 的并发调用只真正执行一次，其余调用方等待并共享同一个结果（或异常）。
+    结果不做缓存——执行结束后 key 即被移除，后续调用会重新执行。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._total = 0
+        self._executed = 0
+        self._coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any], token: Any = None,
+           timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        执行 fn 或等待进行中的同 key 调用，返回 (结果, 是否为共享结果)。
+        token: 可选取消令牌（需有 add_callback），仅用于打断等待方；timeout 同理。
+        """
+        with self._lock:
+            self._total += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._executed += 1
+            else:
+                self._coalesced += 1
+                wake = threading.Event()
+                call.waiters.append(wake)
+
+        if leader:
+            return self._run(key, call, fn), False
+        return self._wait(call, wake, token, timeout), True
+
+    def _run(self, key: str, call: _Call, fn: Callable[[], Any]) -> Any:
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.exc = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+                call.done = True
+                waiters, call.waiters = call.waiters, []
+            for wake in waiters:
+                wake.set()
+
+    def _wait(self, call: _Call, wake: threading.Event, token: Any, timeout: Optional[float]) -> Any:
+        unregister = token.add_callback(wake.set) if token is not None else (lambda: None)
+        try:
+            wake.wait(timeout)
+        finally:
+            unregister()
+        with self._lock:
+            if not call.done:
+                if wake in call.waiters:
+                    call.waiters.remove(wake)
+                raise WaitAborted("wait for in-flight call aborted")
+        if call.exc is not None:
+            raise call.exc
+        return call.result
+
+    def stats(self) -> Dict[str, int]:
+        """calls: 总调用数；upstream: 实际执行次数；coalesced: 合并到进行中调用的次数；inflight: 当前进行中的 key 数"""
+        with self._lock:
+            return {
+                "calls": self._total,
+                "upstream": self._executed,
+                "coalesced": self._coalesced,
+                "inflight": len(self._calls),
+            }
+
+
+# 自检：100 个并发的相同调用只触发一次上游请求（python wxcloudrun/llm/singleflight.py）；
+# 经 chat_completion 打到模拟端点的完整验证见 python -m wxcloudrun.llm.singleflight_check
+if __name__ == "__main__":
+    import time
+
+    sf = SingleFlight()
+    upstream = []
+    barrier = threading.Barrier(100)
+    results = []
+
+    def fake_upstream():
+        upstream.append(1)
+        time.sleep(0.3)
+        return {"choices": [{"message": {"content": "ok"}}]}
+
+    def caller():
+        barrier.wait()
+        results.append(sf.do("same-key", fake_upstream))
+
+    threads = [threading.Thread(target=caller) for _ in range(100)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(upstream) == 1, f"expected 1 upstream call, got {len(upstream)}"
+    assert len(results) == 100 and all(r[0] is results[0][0] for r in results)
+    assert sum(1 for _, shared in results if shared) == 99
+    print("ok", sf.stats())
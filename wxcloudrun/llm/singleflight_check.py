@@ -0,0 +1,69 @@
+"""
+用本地模拟端点验证 DeepSeekV3Service.chat_completion 的请求合并（key 计算、调用点 → 模型替换、发起方取消后重发）：
+
+    python -m wxcloudrun.llm.singleflight_check
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import time
+
+import gevent
+
+from .mock_server import MockLLMServer
+from .router import LLMEndpoint, LLMRouter
+from .ai_service import DeepSeekV3Service, inflight_stats, set_router
+from ..agent.step_context import StepCancelled, StepContext
+
+
+def _messages(tag: str):
+    return [{"role": "user", "content": f"singleflight-check {tag}"}]
+
+
+def main() -> None:
+    server = MockLLMServer(latency=0.3).start()
+    set_router(LLMRouter([LLMEndpoint(name="mock", base_url=server.url, model="mock-model", api_key="sk-mock")]))
+    thought, speak = DeepSeekV3Service(route="thought"), DeepSeekV3Service(route="speak")
+
+    # 1) 100 个并发的相同调用只打一次上游，结果共享
+    before = inflight_stats()
+    jobs = [gevent.spawn(thought.chat_completion, _messages("same"), max_tokens=16) for _ in range(100)]
+    gevent.joinall(jobs, raise_error=True)
+    after = inflight_stats()
+    print(f"[coalesce] requests_served={server.requests_served} "
+          f"coalesced={after['coalesced'] - before['coalesced']}")
+    assert server.requests_served == 1, server.requests_served
+    assert all(job.value is jobs[0].value for job in jobs)
+
+    # 2) key 含调用点：同样的消息来自不同调用点（可能路由到不同模型）不合并；参数不同也不合并
+    server.requests_served = 0
+    jobs = [gevent.spawn(thought.chat_completion, _messages("route"), max_tokens=16),
+            gevent.spawn(speak.chat_completion, _messages("route"), max_tokens=16),
+            gevent.spawn(thought.chat_completion, _messages("route"), max_tokens=32)]
+    gevent.joinall(jobs, raise_error=True)
+    print(f"[keys] requests_served={server.requests_served}")
+    assert server.requests_served == 3, server.requests_served
+
+    # 3) 发起方的 step 被取消：中断其 HTTP 请求，仍有效的跟随方自己重新发起并拿到结果
+    server.requests_served = 0
+    leader_ctx = StepContext("leader")
+    leader = gevent.spawn(thought.chat_completion, _messages("cancel"), max_tokens=16, step_ctx=leader_ctx)
+    gevent.sleep(0.05)
+    follower = gevent.spawn(thought.chat_completion, _messages("cancel"), max_tokens=16)
+    gevent.sleep(0.05)
+    start = time.monotonic()
+    leader_ctx.token.cancel("user left")
+    gevent.joinall([leader, follower])
+    assert isinstance(leader.exception, StepCancelled), leader.exception
+    assert follower.successful() and follower.value.get("choices"), follower.exception
+    print(f"[cancel] leader={type(leader.exception).__name__} follower ok after "
+          f"{time.monotonic() - start:.2f}s, requests_served={server.requests_served}")
+    assert server.requests_served == 2, "cancelled request + exactly one re-issue"
+
+    set_router(None)
+    server.stop()
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
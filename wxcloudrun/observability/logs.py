@@ -0,0 +1,269 @@
+"""
+异步、可采样的结构化日志：
+
+- 业务 greenlet 只做级别判断、采样 / 限流过滤；通过过滤的记录在调用方就地求值消息（msg % args）
+  与异常堆栈（同 QueueHandler.prepare），再放进无锁队列；
+- 原生 OS 线程（不受 gevent 补丁影响）只负责拼装输出行与写 stream，不再执行业务对象的 __str__，
+  阻塞的写操作不再占用 gevent 事件循环；
+- 默认沿用原来的文本格式；LOG_FORMAT=json 时每行输出一个 JSON 对象。
+
+环境变量：
+    LOG_LEVEL=INFO
+    LOG_FORMAT=text | json
+    LOG_SAMPLE=wxcloudrun.llm.ai_service=0.1,wxcloudrun.agent.thought=0.2   # 按 logger 前缀采样 INFO 及以下
+    LOG_RATE_LIMIT=100          # 每个 logger 每秒最多放行的 INFO 及以下记录数，0 为不限
+    LOG_QUEUE_SIZE=10000        # 队列积压上限，超过后丢弃 INFO 及以下记录
+
+WARNING 及以上级别不采样、不限流、队列满也不丢弃。
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, TextIO
+
+from gevent import monkey
+
+from .metrics import REGISTRY
+
+# 原生线程与原生队列：即使已 monkey.patch_all()，也拿到未打补丁的实现
+_start_native_thread = monkey.get_original("_thread", "start_new_thread")
+_NativeQueue = monkey.get_original("queue", "SimpleQueue")
+_native_sleep = monkey.get_original("time", "sleep")
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+_EXC_FORMATTER = logging.Formatter()
+
+records_dropped = REGISTRY.counter(
+    "pw_log_records_dropped_total", "Log records dropped before formatting", ["reason"])
+
+# LogRecord 的标准属性；其余属性（logger.info(..., extra={...})）作为结构化字段输出
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录一行 JSON：ts / level / logger / msg，附带 extra 字段与异常堆栈"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    INFO 及以下：先按 logger 名前缀的采样率丢弃，再按每个 logger 的令牌桶限流。
+    丢弃计数写入 pw_log_records_dropped_total{reason}。
+    """
+
+    def __init__(self, sample_rates: Optional[Dict[str, float]] = None, rate_limit: float = 0.0,
+                 burst: Optional[float] = None):
+        super().__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.rate_limit = rate_limit
+        self.burst = burst if burst is not None else rate_limit * 2
+        self._lock = threading.Lock()
+        self._rates: Dict[str, float] = {}                 # logger 名 -> 生效采样率（缓存前缀匹配结果）
+        self._buckets: Dict[str, list] = {}                # logger 名 -> [令牌数, 上次补充时间]
+
+    def rate_for(self, name: str) -> float:
+        rate = self._rates.get(name)
+        if rate is None:
+            rate, best = 1.0, -1
+            for prefix, value in self.sample_rates.items():
+                if (name == prefix or name.startswith(prefix + ".")) and len(prefix) > best:
+                    rate, best = value, len(prefix)
+            self._rates[name] = rate
+        return rate
+
+    def _take(self, name: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = self._buckets[name] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_limit)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                return False
+            bucket[0] -= 1.0
+            return True
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        if rate < 1.0 and random.random() >= rate:
+            records_dropped.inc(reason="sampled")
+            return False
+        if self.rate_limit > 0 and not self._take(record.name):
+            records_dropped.inc(reason="rate_limited")
+            return False
+        return True
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    把记录交给原生后台线程格式化并写出。emit 不加锁（原生 SimpleQueue 本身线程安全），
+    业务侧开销只剩一次入队。
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None, max_queue: int = 10000):
+        super().__init__()
+        self.stream = stream or sys.stderr
+        self.max_queue = max_queue
+        self._queue = _NativeQueue()
+        self._running = True
+        self._idle = True
+        self.written = 0   # 只由写线程更新；不用 metrics 的锁（gevent 锁不能跨原生线程争用）
+        _start_native_thread(self._writer, ())
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # 不获取 Handler 锁：gevent 补丁后的锁不能跨原生线程使用，入队也不需要锁
+        if not self.filter(record):
+            return False
+        self.emit(record)
+        return True
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not self._running:
+            return
+        if record.levelno < logging.WARNING and self._queue.qsize() >= self.max_queue:
+            records_dropped.inc(reason="queue_full")
+            return
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self._queue.put(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        在调用方求值消息与异常堆栈（同 QueueHandler.prepare）：参数对象之后被修改或其 __str__ 依赖
+        业务状态时，写线程看到的仍是记录时刻的内容。返回副本，不影响其他 handler。
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _write(self, record: logging.LogRecord) -> None:
+        try:
+            self.stream.write(self.format(record) + "\n")
+            self.written += 1
+        except Exception:
+            # 与 logging.Handler.handleError 相同：日志失败不影响业务
+            if logging.raiseExceptions:
+                sys.stderr.write(f"--- Logging error in {record.name} ---\n")
+
+    def _writer(self) -> None:
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            self._idle = False
+            self._write(record)
+            # 积压时批量写完再 flush，减少系统调用
+            while True:
+                try:
+                    record = self._queue.get_nowait()
+                except Exception:
+                    break
+                if record is None:
+                    self._running = False
+                    break
+                self._write(record)
+            try:
+                self.stream.flush()
+            except Exception:
+                pass
+            self._idle = True
+            if not self._running:
+                break
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self, timeout: float = 2.0) -> None:
+        """等待队列写空（用于退出前 / 测试），最多等 timeout 秒"""
+        deadline = time.monotonic() + timeout
+        while (self._queue.qsize() or not self._idle) and time.monotonic() < deadline:
+            _native_sleep(0.005)
+
+    def close(self) -> None:
+        if self._running:
+            self._queue.put(None)
+            self.flush()
+            self._running = False
+        super().close()
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """'a.b=0.1,c=0.5' -> {'a.b': 0.1, 'c': 0.5}；格式不对的项忽略"""
+    rates = {}
+    for item in spec.split(","):
+        name, _, value = item.strip().partition("=")
+        try:
+            rates[name.strip()] = min(1.0, max(0.0, float(value)))
+        except ValueError:
+            continue
+    return rates
+
+
+_handler: Optional[AsyncLogHandler] = None
+
+
+def configure_logging() -> logging.Handler:
+    """按环境变量配置根 logger（只生效一次，替代 logging.basicConfig）"""
+    global _handler
+    if _handler is not None:
+        return _handler
+    level = os.environ.get("LOG_LEVEL", "INFO").upper()
+    handler = AsyncLogHandler(max_queue=int(os.environ.get("LOG_QUEUE_SIZE", "10000")))
+    if os.environ.get("LOG_FORMAT", "text").lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handler.addFilter(SamplingFilter(
+        sample_rates=parse_sample_rates(os.environ.get("LOG_SAMPLE", "")),
+        rate_limit=float(os.environ.get("LOG_RATE_LIMIT", "100")),
+    ))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level, logging.INFO))
+    atexit.register(handler.close)
+    _handler = handler
+    return handler
+
+
+def log_stats() -> Dict[str, Any]:
+    if _handler is None:
+        return {"async": False}
+    return {"async": True, "pending": _handler.pending(), "written": _handler.written}
@@ -0,0 +1,163 @@
+"""
+gevent 事件循环阻塞检测：
+
+- 心跳 greenlet 每 interval 秒更新一次时间戳；
+- 原生监视线程（不受 gevent 调度影响）发现心跳超过 threshold 未更新时，抓取 hub 所在线程
+  当前的调用栈——也就是正占着事件循环不让出的那个 greenlet；
+- 循环恢复后由心跳 greenlet 计算实际阻塞时长，按调用点累计计数 / 耗时并告警。
+
+监视线程只写一个普通属性，指标、日志都在 hub 侧完成，避免在原生线程里争用打过补丁的锁。
+指标：pw_loop_blocks_total{site}、pw_loop_blocked_seconds_total{site}、pw_loop_block_seconds。
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Tuple
+
+import gevent
+from gevent import monkey
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+_start_native_thread = monkey.get_original("_thread", "start_new_thread")
+_native_sleep = monkey.get_original("time", "sleep")
+_native_get_ident = monkey.get_original("_thread", "get_ident")
+
+_APP_DIR = os.sep + "wxcloudrun" + os.sep
+MAX_STACK_FRAMES = 40
+MAX_SITES = 200
+
+loop_blocks_total = REGISTRY.counter(
+    "pw_loop_blocks_total", "Times the gevent loop was held longer than the threshold, by call site", ["site"])
+loop_blocked_seconds_total = REGISTRY.counter(
+    "pw_loop_blocked_seconds_total", "Seconds the gevent loop was held, by call site", ["site"])
+loop_block_seconds = REGISTRY.histogram(
+    "pw_loop_block_seconds", "Duration of each detected gevent loop block",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+
+def _frame_site(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    idx = filename.rfind(_APP_DIR)
+    short = filename[idx + 1:] if idx >= 0 else os.path.basename(filename)
+    return f"{short}:{code.co_name}:{frame.f_lineno}"
+
+
+def call_site(frame) -> Tuple[str, str]:
+    """(最内层的应用代码帧, 最内层帧)；应用代码帧更便于定位，最内层帧说明卡在哪个调用里"""
+    innermost = _frame_site(frame)
+    f = frame
+    while f is not None:
+        if _APP_DIR in f.f_code.co_filename:
+            return _frame_site(f), innermost
+        f = f.f_back
+    return innermost, innermost
+
+
+class LoopBlockMonitor:
+    """线程安全：检测并按调用点统计事件循环阻塞；snapshot() 供管理接口使用"""
+
+    def __init__(self, threshold: float = 0.1):
+        self.threshold = threshold
+        self.interval = max(threshold / 4.0, 0.005)
+        self._lock = threading.Lock()
+        self._sites: Dict[str, Dict[str, Any]] = {}
+        self._last_beat = time.monotonic()
+        self._pending: Optional[Tuple[float, str, str, List[str]]] = None   # (心跳时刻, 调用点, 最内层帧, 栈)
+        self._hub_ident: Optional[int] = None
+        self._running = False
+        self.blocks = 0
+
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        self._hub_ident = _native_get_ident()
+        self._last_beat = time.monotonic()
+        gevent.spawn(self._heartbeat)
+        _start_native_thread(self._watch, ())
+        logger.info(f"[LOOP] loop block monitor started: threshold={self.threshold:.3f}s")
+
+    def stop(self) -> None:
+        self._running = False
+
+    # ----- hub 侧 -----
+    def _heartbeat(self) -> None:
+        while self._running:
+            now = time.monotonic()
+            pending, self._pending = self._pending, None
+            if pending is not None:
+                self._record(pending, now)
+            self._last_beat = now
+            gevent.sleep(self.interval)
+
+    def _record(self, pending: Tuple[float, str, str, List[str]], resumed: float) -> None:
+        beat_at, site, innermost, stack = pending
+        duration = max(resumed - beat_at - self.interval, 0.0)
+        with self._lock:
+            self.blocks += 1
+            if site not in self._sites and len(self._sites) >= MAX_SITES:
+                site = "other"   # 限制调用点（也是指标标签）的数量
+            entry = self._sites.setdefault(site, {"site": site, "count": 0, "total_seconds": 0.0,
+                                                  "max_seconds": 0.0})
+            entry["count"] += 1
+            entry["total_seconds"] += duration
+            if duration >= entry["max_seconds"]:
+                entry["max_seconds"] = duration
+                entry["innermost"] = innermost
+                entry["stack"] = stack
+            entry["last_seen"] = time.time()
+        loop_blocks_total.inc(site=site)
+        loop_blocked_seconds_total.inc(duration, site=site)
+        loop_block_seconds.observe(duration)
+        logger.warning(f"[LOOP] event loop blocked {duration:.3f}s at {site} (in {innermost})")
+
+    # ----- 原生监视线程 -----
+    def _watch(self) -> None:
+        reported_beat = None
+        while self._running:
+            _native_sleep(self.interval)
+            beat = self._last_beat
+            if beat == reported_beat or time.monotonic() - beat < self.threshold + self.interval:
+                continue
+            frame = sys._current_frames().get(self._hub_ident)
+            if frame is None:
+                continue
+            site, innermost = call_site(frame)
+            stack = traceback.format_stack(frame, limit=MAX_STACK_FRAMES)
+            self._pending = (beat, site, innermost, stack)
+            reported_beat = beat
+            del frame
+
+    def snapshot(self, top: int = 20) -> Dict[str, Any]:
+        with self._lock:
+            sites = sorted(self._sites.values(), key=lambda e: -e["total_seconds"])[:top]
+            return {
+                "running": self._running,
+                "threshold": self.threshold,
+                "blocks": self.blocks,
+                "sites": [dict(e, total_seconds=round(e["total_seconds"], 4), max_seconds=round(e["max_seconds"], 4))
+                          for e in sites],
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._sites.clear()
+            self.blocks = 0
+
+
+loop_monitor = LoopBlockMonitor(float(os.environ.get("LOOP_BLOCK_THRESHOLD", "0.1")))
+
+
+def start_loop_monitor() -> bool:
+    """仅在 gevent 已打补丁的 worker 中启动（threshold <= 0 时关闭）"""
+    if loop_monitor.threshold <= 0 or not monkey.is_module_patched("threading"):
+        return False
+    loop_monitor.start()
+    return True
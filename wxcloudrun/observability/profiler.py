@@ -0,0 +1,229 @@
+"""
+按需性能剖析（仅管理接口触发，关闭时零开销）：
+
+- StackSampler：原生线程按固定间隔对所有 greenlet 与原生线程做挂钟采样，输出 collapsed stacks
+  （每行 "根;帧;帧 次数"），可直接交给 flamegraph.pl / speedscope。原生线程不依赖 gevent 调度，
+  事件循环被阻塞时仍能采到阻塞点。
+- StepProfiler：为指定用户的下 N 次 DialogueController.step 开启 cProfile，结果保存在内存中。
+"""
+import cProfile
+import gc
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from gevent import monkey
+
+try:
+    import greenlet as _greenlet_mod
+except ImportError:  # pragma: no cover - gevent 依赖 greenlet
+    _greenlet_mod = None
+
+_start_native_thread = monkey.get_original("_thread", "start_new_thread")
+_native_sleep = monkey.get_original("time", "sleep")
+_native_get_ident = monkey.get_original("_thread", "get_ident")
+
+MAX_SAMPLE_SECONDS = 60.0
+MIN_INTERVAL = 0.001
+MAX_STACK_DEPTH = 128
+
+
+class ProfilerBusy(Exception):
+    """已有一次采样在进行中"""
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _collapse(frame, root: str) -> str:
+    labels: List[str] = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(root)
+    return ";".join(reversed(labels))
+
+
+class StackSampler:
+    """
+    挂钟采样：每 interval 秒记录一次
+    - 当前正在运行的 greenlet / 原生线程的调用栈（根为 "running" / "thread:<ident>"）
+    - 其他挂起 greenlet 的调用栈（根为 "waiting"，include_waiting=False 时跳过）
+    采样期间用 greenlet.settrace 登记新创建的 greenlet；结束后恢复原来的 trace 函数。
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, seconds: float, interval: float = 0.01, include_waiting: bool = True):
+        self.seconds = min(max(seconds, interval), MAX_SAMPLE_SECONDS)
+        self.interval = max(interval, MIN_INTERVAL)
+        self.include_waiting = include_waiting
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._greenlets: "weakref.WeakSet" = weakref.WeakSet()
+        self._done = False
+        self._sampler_ident: Optional[int] = None
+
+    def _on_switch(self, event: str, args: Any) -> None:
+        if event in ("switch", "throw"):
+            self._greenlets.add(args[1])
+        if self._prev_trace is not None:
+            self._prev_trace(event, args)
+
+    def _collect_greenlets(self) -> None:
+        if _greenlet_mod is None:
+            return
+        for obj in gc.get_objects():
+            if isinstance(obj, _greenlet_mod.greenlet) and not obj.dead:
+                self._greenlets.add(obj)
+
+    def _sample_once(self, main_ident: int) -> None:
+        self.samples += 1
+        # 不用 threading.enumerate()：打补丁后它会获取 gevent 锁，不能在原生线程里调用
+        for ident, frame in sys._current_frames().items():
+            if ident == self._sampler_ident:
+                continue
+            root = "running" if ident == main_ident else f"thread:{ident}"
+            self.stacks[_collapse(frame, root)] += 1
+        if not self.include_waiting:
+            return
+        for _ in range(3):
+            try:
+                greenlets = list(self._greenlets)
+                break
+            except RuntimeError:  # 主线程同时在登记新 greenlet
+                greenlets = []
+        for gr in greenlets:
+            frame = gr.gr_frame   # 正在运行的 greenlet 为 None，已在上面按线程采到
+            if frame is not None and not gr.dead:
+                self.stacks[_collapse(frame, "waiting")] += 1
+
+    def _run(self, main_ident: int) -> None:
+        self._sampler_ident = _native_get_ident()
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                self._sample_once(main_ident)
+                _native_sleep(self.interval)
+        finally:
+            self._done = True
+
+    def run(self, wait: Callable[[float], Any]) -> "StackSampler":
+        """阻塞到采样结束；wait 为调用方所在环境的 sleep（请求内传 gevent.sleep，让出事件循环）"""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("a sampling profile is already running")
+        self._prev_trace = None
+        try:
+            if self.include_waiting and _greenlet_mod is not None:
+                self._collect_greenlets()
+                self._prev_trace = _greenlet_mod.gettrace()
+                _greenlet_mod.settrace(self._on_switch)
+            _start_native_thread(self._run, (_native_get_ident(),))
+            while not self._done:
+                wait(0.05)
+        finally:
+            if self.include_waiting and _greenlet_mod is not None:
+                _greenlet_mod.settrace(self._prev_trace)
+            self._lock.release()
+        return self
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class StepProfiler:
+    """
+    为指定用户的下 N 次 step 开启 cProfile。未布置任何目标时 armed 为 False，
+    DialogueController.step 只多一次属性判断。
+
+    注意：cProfile 按 OS 线程生效，step 等待 LLM 期间切换到的其他 greenlet 也会被计入；
+    按 cumulative 排序查看 step 本身的调用链即可。同一线程只能挂一个 profile 钩子，
+    因此同一时刻只剖析一个 step：已有 step 在剖析时，其他 step 照常执行，目标保持布置、等下一次。
+    """
+    SORT_KEYS = tuple(pstats.Stats.sort_arg_dict_default)
+
+    def __init__(self, keep: int = 20):
+        self._lock = threading.Lock()
+        self._targets: Dict[str, int] = {}      # user_id -> 剩余要剖析的 step 次数
+        self._active = False                    # 是否有 step 正在剖析
+        self.results: Deque[Dict[str, Any]] = deque(maxlen=keep)
+        self.armed = False
+
+    def arm(self, user_id: str, steps: int = 1) -> None:
+        with self._lock:
+            self._targets[user_id] = max(1, steps)
+            self.armed = True
+
+    def disarm(self, user_id: Optional[str] = None) -> None:
+        with self._lock:
+            if user_id is None:
+                self._targets.clear()
+            else:
+                self._targets.pop(user_id, None)
+            self.armed = bool(self._targets)
+
+    def targets(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._targets)
+
+    def _claim(self, user_id: str) -> bool:
+        with self._lock:
+            remaining = self._targets.get(user_id)
+            if not remaining or self._active:
+                return False
+            self._active = True
+            if remaining <= 1:
+                del self._targets[user_id]
+            else:
+                self._targets[user_id] = remaining - 1
+            self.armed = bool(self._targets)
+            return True
+
+    def run(self, user_id: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        if not self._claim(user_id):
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        started = time.time()
+        start = time.monotonic()
+        outcome = "ok"
+        try:
+            profile.enable()
+            return fn(*args, **kwargs)
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            profile.disable()
+            with self._lock:
+                self._active = False
+            self.results.append({
+                "user_id": user_id,
+                "started_at": started,
+                "seconds": round(time.monotonic() - start, 4),
+                "outcome": outcome,
+                "profile": profile,
+            })
+
+    def reports(self, user_id: Optional[str] = None, sort: str = "cumulative", limit: int = 40) -> List[Dict[str, Any]]:
+        """已完成的剖析结果（pstats 文本），最新的在前；sort 不在 SORT_KEYS 中时抛 ValueError"""
+        if sort not in self.SORT_KEYS:
+            raise ValueError(f"unknown sort key {sort!r}, expected one of: {', '.join(self.SORT_KEYS)}")
+        reports = []
+        for result in reversed(list(self.results)):
+            if user_id is not None and result["user_id"] != user_id:
+                continue
+            out = io.StringIO()
+            pstats.Stats(result["profile"], stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+            reports.append({k: v for k, v in result.items() if k != "profile"} | {"stats": out.getvalue()})
+        return reports
+
+
+step_profiler = StepProfiler()
@@ -0,0 +1,93 @@
+import gc
+import os
+import resource
+import sys
+import time
+import types
+from typing import Any, Dict, Optional
+
+try:
+    from greenlet import greenlet as _greenlet_type
+except ImportError:  # pragma: no cover - gevent 依赖 greenlet，正常部署都有
+    _greenlet_type = None
+
+_started_at = time.time()
+
+
+def worker_count() -> int:
+    """同一容器内的 gunicorn worker 数（Dockerfile 导出 GUNICORN_WORKERS）；进程内共享的配额按它均分"""
+    try:
+        return max(1, int(os.environ.get("GUNICORN_WORKERS", "1")))
+    except ValueError:
+        return 1
+
+
+def process_rss_bytes() -> Optional[int]:
+    """当前进程常驻内存（Linux 读 /proc，其他平台退回峰值 ru_maxrss）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def greenlet_count() -> Optional[int]:
+    """存活的 greenlet 数（遍历 gc 对象，开销随堆大小增长，仅用于诊断 / 压测接口）"""
+    if _greenlet_type is None:
+        return None
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, _greenlet_type) and not obj.dead)
+
+
+def open_fd_count() -> Optional[int]:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def deep_sizeof(obj: Any, max_objects: int = 100000) -> int:
+    """
+    对象及其可达内容的近似内存占用（字节）：遍历容器、__dict__ 与 __slots__，同一对象只计一次。
+    跳过模块、类、函数与 SQLAlchemy 的实例状态（_sa_*），避免沿会话 / 引擎把整个进程算进去。
+    """
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack and len(seen) < max_objects:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o, 0)
+        if isinstance(o, (str, bytes, bytearray, int, float, bool)) or o is None:
+            continue
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        attrs = getattr(o, "__dict__", None)
+        if isinstance(attrs, dict):
+            total += sys.getsizeof(attrs, 0)
+            stack.extend(v for k, v in attrs.items() if not k.startswith("_sa_"))
+        for name in getattr(type(o), "__slots__", ()):
+            value = getattr(o, name, None)
+            if value is not None:
+                stack.append(value)
+    return total
+
+
+def runtime_stats() -> Dict[str, Any]:
+    """进程级运行时指标：内存、greenlet、文件描述符、GC 计数"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "pid": os.getpid(),
+        "uptime_seconds": round(time.time() - _started_at, 1),
+        "rss_bytes": process_rss_bytes(),
+        "greenlets": greenlet_count(),
+        "open_fds": open_fd_count(),
+        "cpu_user_seconds": round(usage.ru_utime, 3),
+        "cpu_system_seconds": round(usage.ru_stime, 3),
+        "gc_counts": gc.get_count(),
+    }
@@ -0,0 +1,196 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 同一作用域内同一条语句执行次数达到该值即视为 N+1 / 重复查询
+REPEAT_THRESHOLD = int(os.environ.get("SQL_REPEAT_THRESHOLD", "3"))
+# 记录的语句文本最大长度
+MAX_STATEMENT_CHARS = 300
+
+scope_statements = REGISTRY.histogram(
+    "pw_scope_sql_statements", "SQL statements executed per request / dialogue step", ["kind"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100))
+scope_sql_seconds = REGISTRY.histogram(
+    "pw_scope_sql_seconds", "Total DB time per request / dialogue step", ["kind"])
+repeated_scopes_total = REGISTRY.counter(
+    "pw_sql_repeated_scopes_total", "Requests / dialogue steps that repeated a statement", ["kind"])
+
+# gevent 打补丁后 threading.local 为 greenlet 级：每个请求 / 调度器循环各自独立
+_local = threading.local()
+
+
+def _short(statement: str) -> str:
+    text = " ".join(statement.split())
+    return text if len(text) <= MAX_STATEMENT_CHARS else text[:MAX_STATEMENT_CHARS] + "..."
+
+
+class QueryScope:
+    """一个 Flask 请求或一轮 dialogue step 内执行的 SQL：语句数、DB 耗时、每条语句的次数"""
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind          # request / step
+        self.name = name          # 请求为路由规则，step 为来源（dispatch / opening）
+        self.statements = 0
+        self.db_time = 0.0
+        self.by_statement: Dict[str, int] = {}
+        self.identical: Dict[Tuple[str, str], int] = {}   # (语句, 参数) 完全相同的次数
+
+    def record(self, statement: str, parameters: Any, seconds: float) -> None:
+        self.statements += 1
+        self.db_time += seconds
+        self.by_statement[statement] = self.by_statement.get(statement, 0) + 1
+        key = (statement, repr(parameters))
+        self.identical[key] = self.identical.get(key, 0) + 1
+
+    def repeated(self) -> List[Tuple[str, int, int]]:
+        """达到阈值的语句：(语句, 次数, 其中参数完全相同的最大次数)"""
+        result = []
+        for statement, count in self.by_statement.items():
+            if count >= REPEAT_THRESHOLD:
+                same = max(n for (s, _), n in self.identical.items() if s == statement)
+                result.append((statement, count, same))
+        return sorted(result, key=lambda r: -r[1])
+
+
+class SQLStats:
+    """线程安全：按作用域名汇总语句数 / DB 耗时，并累计 N+1 重复语句排行"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._since = time.time()
+            self._scopes: Dict[Tuple[str, str], Dict[str, float]] = {}
+            self._offenders: Dict[str, Dict[str, Any]] = {}
+            self.unscoped_statements = 0
+
+    def observe_unscoped(self) -> None:
+        with self._lock:
+            self.unscoped_statements += 1
+
+    def observe_scope(self, scope: QueryScope, repeated: List[Tuple[str, int, int]]) -> None:
+        with self._lock:
+            agg = self._scopes.setdefault((scope.kind, scope.name), {
+                "count": 0, "statements": 0, "db_time": 0.0, "max_statements": 0, "repeated_scopes": 0})
+            agg["count"] += 1
+            agg["statements"] += scope.statements
+            agg["db_time"] += scope.db_time
+            agg["max_statements"] = max(agg["max_statements"], scope.statements)
+            if repeated:
+                agg["repeated_scopes"] += 1
+            for statement, count, same in repeated:
+                off = self._offenders.setdefault(statement, {
+                    "statement": _short(statement), "scopes": 0, "executions": 0,
+                    "max_per_scope": 0, "max_identical": 0, "seen_in": set()})
+                off["scopes"] += 1
+                off["executions"] += count
+                off["max_per_scope"] = max(off["max_per_scope"], count)
+                off["max_identical"] = max(off["max_identical"], same)
+                off["seen_in"].add(f"{scope.kind}:{scope.name}")
+
+    def snapshot(self, top: int = 20) -> Dict[str, Any]:
+        with self._lock:
+            scopes = []
+            for (kind, name), agg in self._scopes.items():
+                scopes.append({
+                    "kind": kind,
+                    "name": name,
+                    "count": agg["count"],
+                    "statements": agg["statements"],
+                    "avg_statements": round(agg["statements"] / agg["count"], 2),
+                    "max_statements": agg["max_statements"],
+                    "db_time": round(agg["db_time"], 4),
+                    "avg_db_time": round(agg["db_time"] / agg["count"], 4),
+                    "repeated_scopes": agg["repeated_scopes"],
+                })
+            offenders = sorted(self._offenders.values(), key=lambda o: (-o["executions"], -o["scopes"]))[:top]
+            return {
+                "since": self._since,
+                "repeat_threshold": REPEAT_THRESHOLD,
+                "unscoped_statements": self.unscoped_statements,
+                "scopes": sorted(scopes, key=lambda s: -s["statements"])[:top],
+                "offenders": [dict(o, seen_in=sorted(o["seen_in"])) for o in offenders],
+            }
+
+
+sql_stats = SQLStats()
+
+
+def current_scope() -> Optional[QueryScope]:
+    return getattr(_local, "scope", None)
+
+
+def begin_scope(kind: str, name: str) -> QueryScope:
+    scope = QueryScope(kind, name)
+    _local.scope = scope
+    return scope
+
+
+def end_scope(scope: Optional[QueryScope] = None) -> Optional[QueryScope]:
+    """结束当前作用域：写入汇总与直方图，出现重复语句时告警一次"""
+    scope = scope or current_scope()
+    if getattr(_local, "scope", None) is scope:
+        _local.scope = None
+    if scope is None:
+        return None
+    repeated = scope.repeated()
+    sql_stats.observe_scope(scope, repeated)
+    scope_statements.observe(scope.statements, kind=scope.kind)
+    scope_sql_seconds.observe(scope.db_time, kind=scope.kind)
+    if repeated:
+        repeated_scopes_total.inc(kind=scope.kind)
+        statement, count, same = repeated[0]
+        logger.warning(f"[SQL] {scope.kind} {scope.name}: {scope.statements} statements, "
+                       f"{len(repeated)} repeated (top x{count}, identical x{same}): {_short(statement)}")
+    return scope
+
+
+@contextmanager
+def sql_scope(kind: str, name: str) -> Iterator[QueryScope]:
+    """在 with 块内统计 SQL；可嵌套，内层结束后恢复外层作用域"""
+    outer = current_scope()
+    scope = begin_scope(kind, name)
+    try:
+        yield scope
+    finally:
+        end_scope(scope)
+        _local.scope = outer
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("pw_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("pw_query_start")
+    elapsed = time.perf_counter() - starts.pop() if starts else 0.0
+    scope = current_scope()
+    if scope is None:
+        sql_stats.observe_unscoped()
+        return
+    scope.record(statement, parameters, elapsed)
+
+
+_installed = False
+
+
+def install() -> None:
+    """在 Engine 类上登记游标事件（对所有引擎生效，重复调用无副作用）"""
+    global _installed
+    if _installed:
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    _installed = True
@@ -0,0 +1,79 @@
+"""
+冷启动计时与就绪状态。
+
+各阶段记录为“距包开始导入的秒数”，只记录第一次：
+    import         wxcloudrun 包导入完成（create_app 开始）
+    create_app     create_app 返回，开始接受请求（/ping 可用）
+    db_warm / llm_warm / ...   后台预热各步骤完成
+    dispatcher     调度器启动
+    ready          预热完成，/ready 返回 200
+    first_turn     第一条回复投递给客户端
+process_age 为进程启动到包开始导入的时间（解释器启动 + gevent 补丁，取自 /proc，非 Linux 为 None）。
+指标：pw_startup_seconds{phase}。
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from .metrics import REGISTRY
+
+_IMPORT_STARTED = time.monotonic()
+
+startup_seconds = REGISTRY.gauge("pw_startup_seconds", "Seconds from package import to each startup phase", ["phase"])
+
+
+def _process_age() -> Optional[float]:
+    """进程已运行的秒数（Linux：/proc/self/stat 的 starttime 与 /proc/uptime 之差）"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimeline:
+    """线程安全：启动各阶段时间点、预热检查结果与就绪标志"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.process_age = _process_age()
+        self._lock = threading.Lock()
+        self.phases: Dict[str, float] = {}
+        self.checks: Dict[str, Dict[str, Any]] = {}
+        self.ready = False
+
+    def mark(self, phase: str) -> None:
+        if phase in self.phases:   # 热路径（first_turn）：已记录时不加锁
+            return
+        with self._lock:
+            if phase in self.phases:
+                return
+            seconds = time.monotonic() - self.started
+            self.phases[phase] = seconds
+        startup_seconds.set(seconds, phase=phase)
+
+    def check(self, name: str, ok: bool, seconds: float, error: Optional[str] = None, **extra: Any) -> None:
+        """记录一项预热检查的结果"""
+        with self._lock:
+            self.checks[name] = dict(extra, ok=ok, seconds=round(seconds, 4), error=error)
+
+    def set_ready(self) -> None:
+        self.mark("ready")
+        with self._lock:
+            self.ready = True
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "process_age_at_import": round(self.process_age, 3) if self.process_age is not None else None,
+                "phases": {k: round(v, 4) for k, v in sorted(self.phases.items(), key=lambda kv: kv[1])},
+                "checks": {k: dict(v) for k, v in self.checks.items()},
+            }
+
+
+startup = StartupTimeline(_IMPORT_STARTED)
@@ -0,0 +1,83 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 一轮 step 的阶段：构建上下文 → Thought LLM → 解析校验 → 发言 LLM → 更新上下文 → 推送
+STEP_PHASES = ("context_build", "thought_llm", "parse_validate", "speak_llm", "context_update", "ws_send")
+
+step_phase_seconds = REGISTRY.histogram(
+    "pw_step_phase_seconds", "Duration of each phase of a dialogue step", ["phase"])
+step_seconds = REGISTRY.histogram(
+    "pw_step_seconds", "End-to-end duration of a dialogue step by outcome", ["outcome"])
+steps_total = REGISTRY.counter(
+    "pw_steps_total", "Dialogue steps finished by outcome", ["outcome"])
+
+
+class StepTrace:
+    """
+    一轮 step 的结构化 span 记录：每个 span 结束时写入阶段直方图，finish() 时写入整轮耗时，
+    并在 DEBUG 级别输出一行 JSON 汇总（阶段耗时按出现顺序，同名阶段累加）
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self.spans: List[Tuple[str, float, float]] = []   # (phase, 相对开始的偏移, 耗时)
+        self.finished = False
+
+    @contextmanager
+    def span(self, phase: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            self.spans.append((phase, start - self.started, duration))
+            step_phase_seconds.observe(duration, phase=phase)
+
+    def phase_totals(self) -> Dict[str, float]:
+        totals: Dict[str, float] = {}
+        for phase, _, duration in self.spans:
+            totals[phase] = totals.get(phase, 0.0) + duration
+        return totals
+
+    def finish(self, outcome: str) -> float:
+        """outcome: ok / empty / cancelled / timeout / error；重复调用只记录第一次"""
+        total = time.monotonic() - self.started
+        if self.finished:
+            return total
+        self.finished = True
+        step_seconds.observe(total, outcome=outcome)
+        steps_total.inc(outcome=outcome)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[TRACE] %s", json.dumps({
+                "user_id": self.user_id,
+                "outcome": outcome,
+                "total": round(total, 4),
+                "phases": {k: round(v, 4) for k, v in self.phase_totals().items()},
+            }, ensure_ascii=False))
+        return total
+
+
+@contextmanager
+def span(trace: Optional[StepTrace], phase: str) -> Iterator[None]:
+    """记录一个阶段；没有所属 step（如测试接口直接调用）时只写阶段直方图"""
+    if trace is not None:
+        with trace.span(phase):
+            yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        step_phase_seconds.observe(time.monotonic() - start, phase=phase)
+
+
+def trace_of(step_ctx: Any) -> Optional[StepTrace]:
+    return getattr(step_ctx, "trace", None) if step_ctx is not None else None
@@ -0,0 +1,208 @@
+import hmac
+import logging
+import os
+
+import gevent
+from flask import Blueprint, Response, request, jsonify, current_app
+
+from wxcloudrun.observability.sql_stats import sql_stats
+from wxcloudrun.observability.profiler import StackSampler, ProfilerBusy, step_profiler
+from wxcloudrun.observability.loop_monitor import loop_monitor
+from wxcloudrun.observability.runtime import deep_sizeof
+from wxcloudrun.agent.scheduler import dispatch_control, dispatch_stats
+from wxcloudrun.agent.coordination import coordination_stats
+
+logger = logging.getLogger(__name__)
+
+# 运维诊断蓝图：需在请求头 X-Admin-Token 中携带环境变量 ADMIN_TOKEN；未配置时整体关闭
+admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+@admin_bp.before_request
+def check_admin_token():
+    expected = os.environ.get("ADMIN_TOKEN", "")
+    if not expected:
+        return jsonify({'code': -1, 'errorMsg': 'admin endpoints are disabled'}), 404
+    provided = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(provided.encode(), expected.encode()):
+        logger.warning(f"[ADMIN] rejected request to {request.path} from {request.remote_addr}")
+        return jsonify({'code': -1, 'errorMsg': 'invalid admin token'}), 403
+    return None
+
+
+@admin_bp.route('/sql-stats', methods=['GET'])
+def get_sql_stats():
+    """
+    每个请求 / dialogue step 的 SQL 语句数与 DB 耗时汇总，以及 N+1 重复语句排行
+
+    查询参数：top（默认 20）、reset=1（返回后清零，开始新的观察窗口）
+    """
+    top = request.args.get('top', 20, type=int)
+    data = sql_stats.snapshot(top=top)
+    if request.args.get('reset') == '1':
+        sql_stats.reset()
+    return jsonify({'code': 0, 'data': data})
+
+
+@admin_bp.route('/profile', methods=['GET'])
+def sample_profile():
+    """
+    对整个 worker 做挂钟栈采样，返回 collapsed stacks（text/plain，可直接生成火焰图）
+
+    查询参数：seconds（默认 10，最多 60）、interval（采样间隔秒，默认 0.01）、
+             waiting=0（只采正在运行的栈，不含挂起的 greenlet）
+    例：curl -H "X-Admin-Token: $ADMIN_TOKEN" "$HOST/admin/profile?seconds=30" | flamegraph.pl > cpu.svg
+    """
+    seconds = request.args.get('seconds', 10.0, type=float)
+    interval = request.args.get('interval', 0.01, type=float)
+    include_waiting = request.args.get('waiting', '1') != '0'
+    sampler = StackSampler(seconds, interval=interval, include_waiting=include_waiting)
+    try:
+        sampler.run(wait=gevent.sleep)
+    except ProfilerBusy as e:
+        return jsonify({'code': -1, 'errorMsg': str(e)}), 409
+    logger.info(f"[ADMIN] stack sampling finished: {sampler.samples} samples, {len(sampler.stacks)} stacks")
+    return Response(sampler.collapsed(), mimetype='text/plain')
+
+
+@admin_bp.route('/profile/step', methods=['POST'])
+def arm_step_profile():
+    """
+    为指定用户的下 N 次 DialogueController.step 开启 cProfile
+
+    请求体：{"user_id": "...", "steps": 1}；{"user_id": "...", "cancel": true} 取消布置
+    """
+    data = request.get_json(silent=True) or {}
+    user_id = data.get('user_id')
+    if not user_id:
+        return jsonify({'code': -1, 'errorMsg': 'user_id is required'}), 400
+    if data.get('cancel'):
+        step_profiler.disarm(user_id)
+    else:
+        step_profiler.arm(user_id, int(data.get('steps', 1)))
+    return jsonify({'code': 0, 'data': {'targets': step_profiler.targets()}})
+
+
+@admin_bp.route('/profile/step', methods=['GET'])
+def get_step_profiles():
+    """
+    已完成的 step 剖析结果（pstats 文本，最新的在前）
+
+    查询参数：user_id（可选）、sort（默认 cumulative，可选 tottime / ncalls 等）、limit（默认 40 行）
+    """
+    try:
+        reports = step_profiler.reports(
+            user_id=request.args.get('user_id'),
+            sort=request.args.get('sort', 'cumulative'),
+            limit=request.args.get('limit', 40, type=int),
+        )
+    except ValueError as e:
+        return jsonify({'code': -1, 'errorMsg': str(e)}), 400
+    return jsonify({'code': 0, 'data': {'targets': step_profiler.targets(), 'reports': reports}})
+
+
+@admin_bp.route('/loop-blocks', methods=['GET'])
+def get_loop_blocks():
+    """
+    事件循环阻塞排行：按调用点统计次数、总 / 最长阻塞时长，附最长一次的调用栈
+
+    查询参数：top（默认 20）、reset=1（返回后清零）
+    """
+    data = loop_monitor.snapshot(top=request.args.get('top', 20, type=int))
+    if request.args.get('reset') == '1':
+        loop_monitor.reset()
+    return jsonify({'code': 0, 'data': data})
+
+
+def _context_summary(context, with_size: bool):
+    summary = {
+        "history_len": len(context.history),
+        "topics": sum(len(v) for v in context.topic_history.values()),
+        "current_topic": context.current_topic,
+    }
+    if with_size:
+        summary["context_bytes"] = deep_sizeof(context)
+    return summary
+
+
+@admin_bp.route('/users', methods=['GET'])
+def list_users():
+    """
+    在线用户的调度状态与内存估算：队列位置、是否可调度、进行中 step、上一轮 step 时间、未确认消息数、
+    连接接收缓冲，以及 DialogueContext 的历史长度与近似占用字节数；
+    orphan_contexts 为仍缓存着上下文、但已不在线的用户
+
+    查询参数：limit（默认 200）、sizes=0（不估算内存，用户很多时更快）、sort=size（按上下文大小倒序）
+    """
+    limit = request.args.get('limit', 200, type=int)
+    with_size = request.args.get('sizes', '1') != '0'
+    registry = current_app.extensions['alive_chat_users']
+    contexts = dict(current_app.extensions['dialogue_controller'].user_context)
+
+    users = registry.user_states()
+    online = set()
+    for state in users:
+        online.add(state["user_id"])
+        context = contexts.get(state["user_id"])
+        state["context"] = _context_summary(context, with_size) if context is not None else None
+    orphans = [dict(_context_summary(ctx, with_size), user_id=uid) for uid, ctx in contexts.items() if uid not in online]
+
+    total_bytes = None
+    if with_size:
+        total_bytes = (sum((u["context"] or {}).get("context_bytes", 0) for u in users)
+                       + sum(o["context_bytes"] for o in orphans))
+        if request.args.get('sort') == 'size':
+            users.sort(key=lambda u: -(u["context"] or {}).get("context_bytes", 0))
+            orphans.sort(key=lambda o: -o["context_bytes"])
+    return jsonify({'code': 0, 'data': {
+        'users_total': len(users),
+        'contexts_total': len(contexts),
+        'context_bytes_total': total_bytes,
+        'users': users[:limit],
+        'orphan_contexts': orphans[:limit],
+    }})
+
+
+@admin_bp.route('/users/<user_id>/evict', methods=['POST'])
+def evict_user_context(user_id):
+    """丢弃用户缓存的 DialogueContext，下次 step 从数据库重建；step 进行中时拒绝（409），稍后重试"""
+    if current_app.extensions['alive_chat_users'].has_step(user_id):
+        return jsonify({'code': -1, 'errorMsg': 'step in progress, retry later'}), 409
+    evicted = current_app.extensions['dialogue_controller'].evict_context(user_id)
+    logger.info(f"[ADMIN] evict context user={user_id} evicted={evicted}")
+    return jsonify({'code': 0, 'data': {'user_id': user_id, 'evicted': evicted}})
+
+
+@admin_bp.route('/dispatch', methods=['GET', 'POST'])
+def dispatch_settings():
+    """
+    查看 / 调整调度器：并发度与全局暂停（暂停只停止发起新的 step，进行中的照常完成）
+
+    POST 请求体（字段均可选）：{"concurrency": 4, "paused": true}
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if 'concurrency' in data:
+            try:
+                dispatch_control.set_concurrency(int(data['concurrency']))
+            except (TypeError, ValueError):
+                return jsonify({'code': -1, 'errorMsg': 'concurrency must be an integer'}), 400
+        if 'paused' in data:
+            if data['paused']:
+                dispatch_control.pause(reason=str(data.get('reason') or 'admin'))
+            else:
+                dispatch_control.resume()
+        logger.warning(f"[ADMIN] dispatch control updated: {dispatch_control.snapshot()}")
+    return jsonify({'code': 0, 'data': {
+        'control': dispatch_control.snapshot(),
+        'dispatch': dispatch_stats.snapshot(),
+        'registry': current_app.extensions['alive_chat_users'].stats(),
+    }})
+
+
+@admin_bp.route('/coordination', methods=['GET'])
+def get_coordination():
+    """本 worker 的多进程协调状态：worker 数、拥有的用户数、是否为 leader 及 leader 任务执行情况"""
+    data = coordination_stats()
+    data['standby_users'] = current_app.extensions['alive_chat_users'].stats()['standby_users']
+    return jsonify({'code': 0, 'data': data})
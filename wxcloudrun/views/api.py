@@ -1,8 +1,39 @@
-from flask import Flask
+from flask import Flask, Response, jsonify
+
+from ..observability.metrics import REGISTRY, CONTENT_TYPE
+from ..observability.startup import startup
+
+# 抓取时按当前状态更新的调度 / 在线指标
+_live_users = REGISTRY.gauge("pw_live_users", "Users with at least one live WebSocket connection")
+_connections = REGISTRY.gauge("pw_ws_connections", "Live /ws/chat connections")
+_queue_depth = REGISTRY.gauge("pw_dispatch_queue_depth", "Users ready to be scheduled by the dispatcher")
+_parked_users = REGISTRY.gauge("pw_parked_users", "Users parked because every device is in the background")
+_window_blocked = REGISTRY.gauge("pw_window_blocked_users", "Users waiting for client acks")
+_inflight_steps = REGISTRY.gauge("pw_inflight_steps", "Dialogue steps currently running")
+
 
 def register_api_routes(app):
     """注册API路由"""
     
     @app.get("/ping")
     def ping():
+        """存活探针：进程在接受请求即可，不访问数据库"""
         return "pong"
+
+    @app.get("/ready")
+    def ready():
+        """就绪探针：后台预热（连接池、LLM 客户端）完成、调度器已启动后返回 200，之前返回 503；附启动各阶段耗时"""
+        data = startup.snapshot()
+        return jsonify({'code': 0 if data["ready"] else -1, 'data': data}), 200 if data["ready"] else 503
+
+    @app.get("/metrics")
+    def metrics():
+        """Prometheus 文本格式：step 各阶段耗时直方图 + 调度 / 在线状态"""
+        stats = app.extensions["alive_chat_users"].stats()
+        _live_users.set(stats["users"])
+        _connections.set(stats["connections"])
+        _queue_depth.set(stats["ready_users"])
+        _parked_users.set(stats["parked_users"])
+        _window_blocked.set(stats["window_blocked_users"])
+        _inflight_steps.set(stats["inflight_steps"])
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
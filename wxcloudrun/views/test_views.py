@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 import logging
 import time
 from wxcloudrun.agent.dialogue_context import DialogueContext
@@ -18,7 +18,8 @@ def test_step():
     
     请求体示例:
     {
-        "user_id": "test_user_123"
+        "user_id": "test_user_123",
+        "use_cache": true      // 可选：允许本轮 LLM 调用走响应缓存（需开启 LLM_CACHE_ENABLED）
     }
     
     返回示例:
@@ -42,10 +43,12 @@ def test_step():
         
         # 创建 DialogueController 实例
         from wxcloudrun.agent.dialogue_controller import DialogueController
+        from wxcloudrun.agent.step_context import StepContext
         controller = DialogueController()
         
         # 执行 step 方法
-        reply = controller.step(user_id)
+        step_ctx = StepContext(user_id, llm_cache=bool(data.get('use_cache')))
+        reply = controller.step(user_id, step_ctx=step_ctx)
         
         if reply is None:
             return jsonify({
@@ -82,6 +85,48 @@ def test_step():
         }), 500
 
 
+@test_bp.route('/llm-stats', methods=['GET'])
+def llm_stats():
+    """
+    查看 LLM 客户端统计：请求合并、响应缓存命中、端点健康与限流情况
+    """
+    from wxcloudrun.llm.ai_service import (inflight_stats, response_cache_stats,
+                                           endpoint_health_stats, rate_governor_stats)
+    return jsonify({
+        'code': 0,
+        'data': {
+            'singleflight': inflight_stats(),
+            'response_cache': response_cache_stats(),
+            'endpoints': endpoint_health_stats(),
+            'rate_limits': rate_governor_stats()
+        }
+    })
+
+
+@test_bp.route('/runtime', methods=['GET'])
+def runtime():
+    """
+    查看进程运行时与调度统计（压测报告使用）：内存、greenlet 数、启动各阶段耗时、在线用户 / 连接、step 耗时分位数与吞吐、会话缓存命中率
+    传 ?reset=1 时返回后清零调度统计，便于按压测阶段分段统计
+    """
+    from wxcloudrun.observability.runtime import runtime_stats
+    from wxcloudrun.agent.scheduler import dispatch_stats
+    from wxcloudrun.observability.logs import log_stats
+    from wxcloudrun.observability.startup import startup
+    from wxcloudrun.dbops.session_cache import session_cache
+    data = {
+        'process': runtime_stats(),
+        'startup': startup.snapshot(),
+        'logging': log_stats(),
+        'users': current_app.extensions['alive_chat_users'].stats(),
+        'dispatch': dispatch_stats.snapshot(),
+        'sessions': session_cache.stats(),
+    }
+    if request.args.get('reset') in ('1', 'true'):
+        dispatch_stats.reset()
+    return jsonify({'code': 0, 'data': data})
+
+
 @test_bp.route('/context', methods=['POST'])
 def test_context():
     """
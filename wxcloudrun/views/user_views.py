@@ -8,6 +8,7 @@ from ..dbops.dao import insert_digital_avatar, insert_travel_partner, insert_tra
 from ..dbops.model import DigitalAvatar, TravelPartner, TravelSettings
 from ..wechat_config import WeChatCloudConfig
 from ..idgeneration import id_gen
+from ..agent.opening_turn import schedule_opening_turn
 
 # 初始化日志
 logger = logging.getLogger(__name__)
@@ -33,7 +34,7 @@ def make_err_response(err_msg):
 @user_bp.route('/user', methods=['POST'])
 def create_user():
     """
-    创建/更新用户记录
+    创建/更新用户记录：默认复用最近活跃的会话，传 new_session=true 时开启新行程
     :return: 创建结果
     """
     try:
@@ -47,13 +48,18 @@ def create_user():
         if not user_id.strip():
             return make_err_response('用户ID不能为空')
         
-        # 创建用户记录
-        user = insert_user(user_id)
+        # 获取或创建用户会话
+        new_session = bool(params.get('new_session'))
+        user = insert_user(user_id, new_session=new_session)
+        if new_session:
+            # 新行程：丢弃本 worker 里基于旧会话构建的上下文；归属其他 worker 时由其 step 比对 session_id 后重建
+            current_app.extensions['dialogue_controller'].evict_context(user_id)
         
         return make_succ_response({
             'message': '用户记录创建成功',
             'user_id': user_id,
-            'user_db_id': user.id
+            'user_db_id': user.id,
+            'session_id': user.session_id
         })
         
     except Exception as e:
@@ -64,7 +70,7 @@ def create_user():
 @user_bp.route('/save-all', methods=['POST'])
 def save_all_data():
     """
-    一次性保存所有数据（分身+伙伴+设置）
+    一次性保存所有数据（分身+伙伴+设置）；传 new_session=true 时同时开启新行程
     :return: 保存结果
     """
     try:
@@ -88,8 +94,8 @@ def save_all_data():
         if not user_id.strip():
             return make_err_response('用户ID不能为空')
         
-        # 创建用户记录
-        user = insert_user(user_id)
+        # 获取或创建用户会话（开场消息预生成时会丢弃旧上下文）
+        user = insert_user(user_id, new_session=bool(params.get('new_session')))
 
         # 保存分身信息
         avatar = DigitalAvatar(
@@ -120,6 +126,9 @@ def save_all_data():
             preference=settings_data['preference'],
         )
         insert_travel_settings(settings)
+
+        # 后台预生成开场消息，首次连接 /ws/chat 时即可立即下发
+        schedule_opening_turn(current_app._get_current_object(), user_id)
         
         return make_succ_response({
             'message': '所有数据保存成功',
@@ -3,6 +3,10 @@ from flask_sock import Sock
 import json, logging
 from flask import current_app
 from gevent import spawn, sleep
+from ..agent.scheduler import deliver
+from ..agent.opening_turn import persist_opening_turn
+from ..agent.step_context import CancelToken
+from ..agent.coordination import frame_relay, user_affinity, STANDBY_FRAME
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +16,22 @@ def _close_ws_safely(ws):
     except Exception as e:
         logger.warning(f"[WS] 关闭WebSocket连接失败: {e}")
 
+def _abort_handshake(ws, user_id, registered):
+    """握手未完成：撤销已做的登记（轮询队列中的本连接、归属锁），再关闭连接"""
+    if user_id:
+        try:
+            alive_chat_users = current_app.extensions["alive_chat_users"]
+            if registered:
+                gone = alive_chat_users.remove(user_id, ws)
+            else:
+                gone = not alive_chat_users.get_conns(user_id)
+            if gone:
+                # 本 worker 上已无该用户连接：交出归属，否则其他 worker 上的连接会一直 standby
+                user_affinity.release(user_id)
+        except Exception as e:
+            logger.error(f"[WS] 撤销握手登记失败 (user_id={user_id}): {e}")
+    _close_ws_safely(ws)
+
 def register_websocket_routes(app, sock: Sock):
     """注册 WebSocket 路由"""
 
@@ -19,8 +39,11 @@ def register_websocket_routes(app, sock: Sock):
     def ws_chat(ws):
         logger.info("[WS] client connected")
         user_id = ""
+        registered = False
+        handshake_ok = False
+        opening_hold = None   # 开场消息投递期间占住调度的令牌
 
-        # 1) 首包握手（客户端应立即发送 {"user_id": "..."}）
+        # 1) 首包握手（客户端应立即发送 {"user_id": "...", "acks": true}；acks 表示会对每条消息回 ack）
         try:
             client_data = ws.receive(timeout=15)  # Flask-Sock API 支持超时
             data = json.loads(client_data or "{}")
@@ -28,14 +51,51 @@ def register_websocket_routes(app, sock: Sock):
             if not user_id:
                 raise ValueError("empty user_id")
             
-            # 添加到轮询队列
+            # 多 worker 部署：用户归属于其他 worker 时本连接进入 standby，归属方全部下线后自动接管
+            owner = user_affinity.claim(user_id)
+
+            # 添加到轮询队列（同一用户的多个设备共享一个轮询位置）
             alive_chat_users = current_app.extensions["alive_chat_users"]
-            alive_chat_users.add(user_id, ws)
+            alive_chat_users.add(user_id, ws, acks=bool(data.get("acks")), standby=not owner)
+            registered = True
+
+            # 有预生成的开场消息时先占住该用户：送达并落库前调度器不为其生成，否则重建的历史里缺这一条
+            opening = current_app.extensions["opening_turns"].pop(user_id) if owner else None
+            if opening is not None and (alive_chat_users.has_step(user_id)
+                                        or current_app.extensions["dialogue_controller"].has_context(user_id)):
+                opening = None   # 调度器已在为该用户生成（其他设备已在线），开场白不再需要
+            if opening is not None:
+                opening_hold = CancelToken()
+                alive_chat_users.begin_step(user_id, opening_hold)
             
-            logger.info(f"[WS] user added to queue: user={user_id}")
+            logger.info(f"[WS] user added to queue: user={user_id}, devices={len(alive_chat_users.get_conns(user_id))}, "
+                        f"standby={not owner}")
+            if not owner:
+                # 容器内多 worker：向归属 worker 订阅，本连接照常收到消息；否则告知客户端处于 standby
+                if frame_relay.active:
+                    frame_relay.subscribe(user_id)
+                else:
+                    ws.send(STANDBY_FRAME)
+
+            # 有预生成的开场消息则立即下发，送达后才落库，实时调度从它之后继续生成
+            if opening is not None:
+                if not deliver(alive_chat_users, user_id, [ws], json.dumps(opening, ensure_ascii=False), opening,
+                               source="opening"):
+                    raise ConnectionError("opening turn send failed")
+                try:
+                    persist_opening_turn(user_id, opening)
+                except Exception as e:
+                    logger.error(f"[WS] 开场消息落库失败 (user_id={user_id}): {e}")
+            handshake_ok = True
         except Exception as e:
             logger.error(f"[WS] handshake failed: {e}")
-            _close_ws_safely(ws)
+        finally:
+            if opening_hold is not None:
+                alive_chat_users.end_step(user_id, opening_hold, counted=False)
+            if not handshake_ok:
+                # 登记后发送失败（standby 帧 / 开场消息）或协程被终止：移除本连接并交出归属
+                _abort_handshake(ws, user_id, registered)
+        if not handshake_ok:
             return
 
         # 2) 接收协程：处理心跳与业务指令
@@ -48,6 +108,7 @@ def register_websocket_routes(app, sock: Sock):
                     msg = ws.receive(timeout=35)  # 超时→继续轮询
                     if not msg:
                         continue
+                    alive_chat_users.touch(user_id)
                     obj = json.loads(msg)
                     typ = obj.get("type")
                     if typ == "ping":
@@ -56,6 +117,13 @@ def register_websocket_routes(app, sock: Sock):
                         except Exception as e:
                             logger.warning(f"[WS] 发送pong失败: {e}")
                             break
+                    elif typ == "ack":
+                        # 客户端已渲染到 message_id（累计确认），释放发送窗口
+                        alive_chat_users.ack(user_id, str(obj.get("message_id", "")))
+                    elif typ in ("pause", "resume"):
+                        # 小程序 onHide/onShow：所有设备都在后台时停放该用户，不再占用调度与 LLM
+                        parked = alive_chat_users.set_visible(user_id, ws, typ == "resume")
+                        logger.info(f"[WS] visibility {typ}: user={user_id}, parked={parked}")
                     elif typ == "stop":
                         break
                     elif typ == "input":
@@ -87,9 +155,10 @@ def register_websocket_routes(app, sock: Sock):
             
             if user_id:
                 try:
-                    # 从轮询队列中移除用户
+                    # 仅移除本连接；该用户其他设备仍在线时继续轮询
                     alive_chat_users = current_app.extensions["alive_chat_users"]
-                    alive_chat_users.remove(user_id)
+                    if alive_chat_users.remove(user_id, ws):
+                        user_affinity.release(user_id)   # 本 worker 上已无该用户连接，交出归属
                 except Exception as e:
                     logger.error(f"[WS] 清理用户连接失败 (user_id={user_id}): {e}")
             
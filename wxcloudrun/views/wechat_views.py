@@ -1,4 +1,3 @@
-import requests
 import logging
 from flask import Blueprint, request, jsonify
 from ..wechat_config import WECHAT_CONFIG
@@ -28,6 +27,8 @@ def make_err_response(message, code=-1):
 @wechat_bp.route('/wechat-login', methods=['POST'])
 def wechat_login():
     """微信登录，通过code获取openid"""
+    import requests  # 仅登录接口使用，不在启动时加载
+
     try:
         data = request.get_json()
         code = data.get('code')
@@ -57,10 +58,10 @@ def wechat_login():
             openid = result['openid']
             logger.info(f'微信登录成功，openid: {openid}')
             
-            # 直接创建用户记录
+            # 获取或创建用户会话（最近活跃的会话直接复用）
             try:
                 user = insert_user(openid)
-                logger.info(f'用户记录创建成功，user_id: {openid}, session_id: {user.session_id}, db_id: {user.id}')
+                logger.info(f'用户会话就绪，user_id: {openid}, session_id: {user.session_id}, db_id: {user.id}')
             except Exception as e:
                 logger.error(f'创建用户记录失败: {e}')
                 return make_err_response(f'创建用户记录失败: {str(e)}')
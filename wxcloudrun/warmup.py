@@ -0,0 +1,80 @@
+"""
+后台预热：create_app 返回后立即开始接受请求（/ping 存活探针可用），以下步骤在后台完成后才标记就绪
+（/ready 返回 200）并启动调度器，流量与调度都不再为冷启动买单：
+
+1. db_warm：建立连接池并预先打开 WARMUP_DB_CONNECTIONS 个连接（默认 2，不超过 pool_size）。
+   数据库暂不可用（如 CynosDB Serverless 恢复中）时退避重试，最长 WARMUP_DB_TIMEOUT 秒（默认 30）；
+   超时仍连不上时照常就绪（checks.db_warm.ok=false），与此前首个请求再连库的行为一致，避免实例永远不接流量。
+2. llm_warm：加载 HTTP 客户端与 LLM 路由（LLM_MOCK=1 时启动本地模拟服务）。
+3. 启动调度器，标记就绪。
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Optional, Tuple
+
+from .observability.startup import startup
+
+logger = logging.getLogger(__name__)
+
+
+def start_warmup(app: Any, on_warm: Callable[[], None]) -> None:
+    """在后台线程（gevent 下为协程）中预热，完成后调用 on_warm（启动调度器）并标记就绪"""
+    threading.Thread(target=_warmup, args=(app, on_warm), daemon=True).start()
+
+
+def _warmup(app: Any, on_warm: Callable[[], None]) -> None:
+    for name, step in (("db_warm", _warm_db), ("llm_warm", _warm_llm)):
+        start = time.monotonic()
+        try:
+            ok, error, extra = step(app)
+        except Exception as e:
+            ok, error, extra = False, str(e), {}
+            logger.error(f"[WARMUP] {name} failed: {e}", exc_info=True)
+        startup.check(name, ok, time.monotonic() - start, error, **extra)
+        startup.mark(name)
+    try:
+        on_warm()
+        startup.mark("dispatcher")
+    finally:
+        startup.set_ready()
+        logger.info(f"[WARMUP] worker ready: {startup.snapshot()['phases']}")
+
+
+def _warm_db(app: Any) -> Tuple[bool, Optional[str], dict]:
+    from sqlalchemy import text
+    from . import db
+
+    pool_size = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}).get("pool_size", 5)
+    connections = max(1, min(int(os.environ.get("WARMUP_DB_CONNECTIONS", "2")), pool_size))
+    deadline = time.monotonic() + float(os.environ.get("WARMUP_DB_TIMEOUT", "30"))
+    delay, attempts = 0.5, 0
+    while True:
+        attempts += 1
+        try:
+            with app.app_context():
+                opened = []
+                try:
+                    for _ in range(connections):
+                        opened.append(db.engine.connect())
+                    opened[0].execute(text("SELECT 1"))
+                finally:
+                    for conn in opened:
+                        conn.close()   # 归还连接池，供首批请求直接复用
+            return True, None, {"attempts": attempts, "connections": connections}
+        except Exception as e:
+            if time.monotonic() + delay > deadline:
+                logger.error(f"[WARMUP] database still unavailable after {attempts} attempts: {e}")
+                return False, str(e), {"attempts": attempts}
+            logger.warning(f"[WARMUP] database not ready (attempt {attempts}), retry in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+
+def _warm_llm(app: Any) -> Tuple[bool, Optional[str], dict]:
+    import requests  # noqa: F401  LLM / 微信接口使用的 HTTP 客户端，不在导入阶段加载
+    from .llm.ai_service import get_router
+
+    router = get_router()
+    return True, None, {"endpoints": [ep.name for ep in router.endpoints]}